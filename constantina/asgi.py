@@ -0,0 +1,254 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import logging
+
+from constantina.compression import GzipHeader, GzipStream, gzip_fragments
+from constantina.constantina import ConstantinaPage, FreshPages, Generation, ScrollSeparator, Speculation, add_server_timing, added_page, card_fragment, choose_page, count_request, get_file, metrics_page, next_state, page_encoding, pooled_page, request_values, revalidate_page, scroll_cards, scroll_envelope, scroll_json, theme_segments
+from constantina.context import RequestContext
+from constantina.metrics import Metrics
+from constantina.shared import GlobalConfig
+from constantina.state import ConstantinaState
+
+log = logging.getLogger('constantina.asgi')
+
+# Blocking work (card file I/O, libmagic, PIL, mutagen, Whoosh) runs on a
+# bounded pool of threads shared by every request, so that the event loop
+# is free to hold many slow connections open at once.
+Executor = ThreadPoolExecutor(
+    max_workers=GlobalConfig.getint("concurrency", "asgi_workers", fallback=4),
+    thread_name_prefix="constantina-asgi")
+
+
+def asgi_environ(scope):
+    """
+    Make the parts of a WSGI environment Constantina reads, out of an
+    ASGI http scope, so both entry points share request parsing.
+    """
+    query = scope.get('query_string', b'').decode('latin-1')
+    path = scope.get('raw_path') or scope.get('path', '/').encode('utf-8')
+    uri = path.decode('latin-1')
+    if query != '':
+        uri = uri + '?' + query
+    env = {
+        'QUERY_STRING': query,
+        'REQUEST_URI': uri,
+        'REQUEST_METHOD': scope.get('method', 'GET'),
+    }
+    if scope.get('client') is not None:
+        env['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        key = 'HTTP_' + name.decode('latin-1').upper().replace('-', '_')
+        env[key] = value.decode('latin-1')
+    return env
+
+
+def asgi_headers(headers):
+    """WSGI-style header tuples to ASGI byte pairs"""
+    return [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+
+async def run_blocking(function, *args):
+    """Run a blocking function on the shared executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(Executor, function, *args)
+
+
+async def send_wsgi(send, respond):
+    """
+    The file trampoline and the metrics page are WSGI responses, so
+    capture what respond(start_response) starts its response with, and
+    send that, followed by the body.
+    """
+    response = {}
+
+    def start_response(status, headers):
+        response['status'] = int(status.split(' ')[0])
+        response['headers'] = headers
+
+    body = await run_blocking(respond, start_response)
+    await send({'type': 'http.response.start',
+                'status': response['status'],
+                'headers': asgi_headers(response['headers'])})
+
+    # Files sent by Constantina itself are read a block at a time
+    blocks = iter(body or [])
+    try:
+        while True:
+            block = await run_blocking(next, blocks, None)
+            if block is None:
+                break
+            await send({'type': 'http.response.body', 'body': block, 'more_body': True})
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def send_page(send, state):
+    """
+    Build the page's cards on the executor, and then stream the page out.
+    Every card is drawn on the executor at once, and each card is sent as
+    soon as it and all the cards before it are drawn. Scroll pages the
+    client asks for as JSON are sent as a JSON array of cards. Scroll pages
+    drawn ahead of time are sent whole.
+    """
+    as_json = scroll_json(state)
+    state.headers.append(('Content-Type', 'application/json' if as_json is True else 'text/html'))
+    encoding = page_encoding(state)
+    if await run_blocking(revalidate_page, state, "json" if as_json is True else "") is True:
+        add_server_timing(state)
+        await send({'type': 'http.response.start',
+                    'status': 304,
+                    'headers': asgi_headers(state.headers)})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    generation = None
+    variant = "json" if as_json is True else "html"
+    if Speculation.enabled is True:
+        generation = await run_blocking(Generation.current)
+        if added_page(state) is True:
+            speculated = await run_blocking(Speculation.take, (state.in_state, variant, generation))
+            if speculated is not None:
+                fragments, following = speculated
+                if following is not None:
+                    Speculation.schedule((following, variant, generation))
+                await send_fragments(send, state, encoding, fragments)
+                return
+
+    state, whole_page = await run_blocking(choose_page, state)
+    page = await run_blocking(ConstantinaPage, state)
+
+    head = None
+    tail = None
+    cards = page.cards[page.cur_len:]
+    as_json = as_json and (whole_page is False)
+    if whole_page is True:
+        head, tail = await run_blocking(theme_segments, state)
+    elif as_json is True:
+        cards = scroll_cards(page)
+        head, tail = scroll_envelope(page)
+
+    def draw(card):
+        """Draw a card, and compress it too if it'll be sent compressed"""
+        fragment = card_fragment(page, card, whole_page, as_json)
+        if encoding == "gzip":
+            fragment.deflated()
+        return fragment
+
+    loop = asyncio.get_running_loop()
+    fragments = [loop.run_in_executor(Executor, draw, card)
+                 for card in cards]
+
+    # Cards are drawn as they stream out, so only the phases up to
+    # here are in the Server-Timing header
+    add_server_timing(state)
+    if encoding != "identity":
+        state.headers.append(('Content-Encoding', encoding))
+    await send({'type': 'http.response.start',
+                'status': 200,
+                'headers': asgi_headers(state.headers)})
+
+    # A gzipped page is one stream, joined from each fragment's deflate data
+    stream = GzipStream()
+    if encoding == "gzip":
+        await send({'type': 'http.response.body', 'body': GzipHeader, 'more_body': True})
+
+    def encoded(fragment):
+        """The bytes to send for a fragment"""
+        if encoding == "gzip":
+            return stream.add(fragment)
+        return fragment.data
+
+    if head is not None:
+        await send({'type': 'http.response.body', 'body': encoded(head), 'more_body': True})
+    for i, fragment in enumerate(fragments):
+        fragment = await fragment
+        body = b''
+        if as_json is True and i > 0:
+            body = encoded(ScrollSeparator)
+        body = body + encoded(fragment)
+        await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    end = b''
+    if tail is not None:
+        end = encoded(tail)
+    if encoding == "gzip":
+        end = end + stream.trailer()
+    await send({'type': 'http.response.body', 'body': end})
+
+    # The client's script asks for the page after a whole page as JSON
+    following = next_state(page)
+    if generation is not None and following is not None:
+        Speculation.schedule((following, "json" if whole_page is True else variant, generation))
+
+
+async def send_fragments(send, state, encoding, fragments):
+    """Send a page that's already drawn, all at once"""
+    add_server_timing(state)
+    if encoding != "identity":
+        state.headers.append(('Content-Encoding', encoding))
+    await send({'type': 'http.response.start',
+                'status': 200,
+                'headers': asgi_headers(state.headers)})
+    if encoding == "gzip":
+        body = gzip_fragments(fragments)
+    else:
+        body = "".join([fragment.text for fragment in fragments]).encode('utf-8')
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    """Start up and shut down the executor with the ASGI server"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            FreshPages.stop()
+            Executor.shutdown(wait=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """
+    ASGI entry point, serving the same fresh, scroll, search, permalink
+    and file trampoline requests as the WSGI application.
+    """
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    start = perf_counter()
+    env = asgi_environ(scope)
+    if Metrics.wanted(env) is True:
+        await send_wsgi(send, lambda start_response: metrics_page(env, start_response))
+        return
+
+    context = RequestContext(env)
+    in_state, in_uri = request_values(env)
+
+    if in_state is None and in_uri is None:
+        fresh_page = FreshPages.take()
+        if fresh_page is not None:
+            headers, body = pooled_page(env, fresh_page)
+            await send({'type': 'http.response.start',
+                        'status': 200,
+                        'headers': asgi_headers(headers)})
+            await send({'type': 'http.response.body', 'body': body})
+            Metrics.observe("constantina_request_seconds", {'mode': 'fresh_mode'}, perf_counter() - start)
+            return
+    def build_state():
+        with context.timer.phase("state"):
+            return ConstantinaState(in_state, env, context)
+    state = await run_blocking(build_state)
+
+    if in_state is None and in_uri is not None:
+        await send_wsgi(send, lambda start_response: get_file(in_uri, start_response, state))
+    else:
+        with Speculation.serving():
+            await send_page(send, state)
+    count_request(state, in_uri, start)
@@ -0,0 +1,6 @@
+"""
+Constantina benchmarks: a synthetic card corpus generator, a harness
+that drives the WSGI application in-process for each kind of page, an
+access log replay, cold-start import timing, and an in-process client
+for the ASGI entry point.
+"""
@@ -0,0 +1,192 @@
+import asyncio
+import gzip
+import json
+import re
+
+# The state of the page after this one, in a whole page's tombstone card
+TombstoneState = re.compile(r'id="state"[^>]*>([^<]+)<')
+
+
+class AsgiResponse:
+    """
+    What an ASGI application sent for one request: the status, headers,
+    and each body chunk as it was sent. Messages sent out of order are
+    noted in problems, rather than stopping the request.
+    """
+    def __init__(self):
+        self.status = None
+        self.headers = {}     # Lowercased header name -> value
+        self.chunks = []      # Each http.response.body message's bytes
+        self.complete = False
+        self.problems = []
+
+    def receive(self, message):
+        """Check and keep one message the application sent"""
+        if self.complete is True:
+            self.problems.append("%s sent after the response was complete" % message['type'])
+        elif message['type'] == 'http.response.start':
+            if self.status is not None:
+                self.problems.append("response started twice")
+            self.status = message['status']
+            self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                            for name, value in message.get('headers', [])}
+        elif message['type'] == 'http.response.body':
+            if self.status is None:
+                self.problems.append("body sent before the response started")
+            if not isinstance(message.get('body', b''), bytes):
+                self.problems.append("body chunk isn't bytes")
+            self.chunks.append(message.get('body', b''))
+            self.complete = message.get('more_body', False) is False
+        else:
+            self.problems.append("unexpected message %s" % message['type'])
+
+    def body(self):
+        """The whole body, uncompressed if it was sent gzipped"""
+        data = b''.join(self.chunks)
+        if self.headers.get('content-encoding') == 'gzip':
+            return gzip.decompress(data)
+        return data
+
+
+async def asgi_request(application, path, query="", headers=None):
+    """
+    Call an ASGI application in this process, the way a server would
+    for one GET request, and return its AsgiResponse.
+    """
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0', 'spec_version': '2.3'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode('latin-1'),
+        'query_string': query.encode('latin-1'),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in (headers or {}).items()],
+        'client': ('127.0.0.1', 0),
+        'server': ('127.0.0.1', 80),
+    }
+    requested = []
+
+    async def receive():
+        if requested == []:
+            requested.append(True)
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        return {'type': 'http.disconnect'}
+
+    response = AsgiResponse()
+
+    async def send(message):
+        response.receive(message)
+
+    await application(scope, receive, send)
+    if response.complete is False:
+        response.problems.append("response never completed")
+    return response
+
+
+class AsgiCheck:
+    """
+    Constantina ASGI Check.
+
+    Drives the ASGI entry point in-process with a few requests of each
+    kind: a fresh page as it is and gzipped, a scroll page as JSON, a
+    private file, a missing file, and a file revalidated by its ETag.
+    Each check looks at the status, headers, and streamed body chunks,
+    and returns a list of what went wrong.
+    """
+    def __init__(self, application, image="/images/example.png"):
+        self.application = application
+        self.image = image
+        self.results = []     # (name, response, failures) for each check
+
+    def request(self, path, query="", headers=None):
+        """One request, run on its own event loop"""
+        return asyncio.run(asgi_request(self.application, path, query, headers))
+
+    def record(self, name, response, failures):
+        """Keep a check's result, along with any protocol problems"""
+        failures = response.problems + failures
+        self.results.append((name, response, failures))
+        return failures
+
+    def fresh_page(self, encoding="identity"):
+        """A whole page, streamed a card at a time"""
+        response = self.request("/", headers={'Accept-Encoding': encoding})
+        failures = []
+        if response.status != 200:
+            failures.append("status %s" % response.status)
+        if response.headers.get('content-type') != 'text/html':
+            failures.append("content-type %s" % response.headers.get('content-type'))
+        if encoding == "gzip" and response.headers.get('content-encoding') not in [None, 'gzip']:
+            failures.append("content-encoding %s" % response.headers.get('content-encoding'))
+        try:
+            html = response.body().decode('utf-8')
+        except (OSError, UnicodeDecodeError) as error:
+            return self.record("fresh " + encoding, response, failures + ["body: %s" % error])
+        if html.find('</html>') == -1:
+            failures.append("page isn't complete")
+        if len([chunk for chunk in response.chunks if chunk != b'']) < 2:
+            failures.append("page wasn't streamed")
+        return self.record("fresh " + encoding, response, failures)
+
+    def scroll_json(self, html):
+        """The next page after a whole page, asked for as JSON"""
+        match = TombstoneState.search(html)
+        if match is None:
+            return self.record("scroll json", AsgiResponse(), ["no next state on the fresh page"])
+        response = self.request("/", match.group(1), {'Accept': 'application/json'})
+        failures = []
+        if response.status != 200:
+            failures.append("status %s" % response.status)
+        if response.headers.get('content-type') != 'application/json':
+            failures.append("content-type %s" % response.headers.get('content-type'))
+        try:
+            page = json.loads(response.body().decode('utf-8'))
+            if not isinstance(page.get('cards'), list):
+                failures.append("no cards in the JSON page")
+        except (OSError, ValueError) as error:
+            failures.append("body: %s" % error)
+        return self.record("scroll json", response, failures)
+
+    def files(self):
+        """A file, a missing file, and the file again by its ETag"""
+        response = self.request(self.image)
+        failures = []
+        if response.status != 200:
+            failures.append("status %s" % response.status)
+        etag = response.headers.get('etag')
+        if etag is None:
+            failures.append("no etag")
+        self.record("file", response, failures)
+
+        missing = self.request(self.image + ".missing")
+        failures = []
+        if missing.status != 404:
+            failures.append("status %s" % missing.status)
+        if missing.body() != b'':
+            failures.append("404 has a body")
+        self.record("missing file", missing, failures)
+
+        if etag is not None:
+            cached = self.request(self.image, headers={'If-None-Match': etag})
+            self.record("revalidated file", cached,
+                        [] if cached.status == 304 else ["status %s" % cached.status])
+
+    def run(self):
+        """Run every check. Returns True if they all passed."""
+        self.fresh_page()
+        name, response, failures = self.results[-1]
+        html = response.body().decode('utf-8', 'replace') if failures == [] else ""
+        self.fresh_page("gzip")
+        self.scroll_json(html)
+        self.files()
+        return all([failures == [] for name, response, failures in self.results])
+
+    def report(self, report=print):
+        """One line per check, with its status, chunks, and any failures"""
+        for name, response, failures in self.results:
+            line = "%-18s %5s %4d chunks %8d bytes" % (
+                name, response.status, len(response.chunks), len(b''.join(response.chunks)))
+            report(line + ("  ok" if failures == [] else "  FAILED: " + "; ".join(failures)))
@@ -0,0 +1,166 @@
+import os
+from random import Random
+import shutil
+import time
+
+from PIL import Image
+
+
+# Words that news paragraphs, quotes and titles are drawn from. Search
+# benchmarks look for these, so every word appears somewhere in the corpus.
+Vocabulary = [
+    "archive", "balloon", "candle", "dinner", "engine", "forest", "garden",
+    "harbor", "island", "journey", "kettle", "lantern", "meadow", "network",
+    "orchard", "pepper", "quartz", "river", "signal", "thunder", "umbrella",
+    "valley", "window", "yellow", "zephyr", "bicycle", "compass", "daylight",
+    "evening", "feather", "granite", "horizon", "library", "morning", "notebook",
+    "orange", "puzzle", "railway", "saddle", "teapot", "village", "weather",
+]
+
+# Topics that news cards are tagged with, and that topic cards are named for
+Topics = ["Travel", "Cooking", "Music", "Gardening", "Software", "Weather",
+          "Bicycles", "Libraries"]
+
+# Medusa card directories, under private/, from the shipped medusa.ini
+CardPaths = {
+    'ads': "medusa/gracias",
+    'features': "medusa/features",
+    'heading': "medusa/headers",
+    'images': "medusa/pictures",
+    'media': "medusa/embedded",
+    'news': "medusa/news",
+    'quotes': "medusa/interjections",
+    'songs': "medusa/songs",
+    'topics': "medusa/encyclopedia",
+}
+
+# One MPEG-1 Layer III frame: 128kbps, 44.1kHz, no padding, silent
+Mp3Frame = b'\xff\xfb\x90\x00' + b'\x00' * 413
+
+# Written into every generated root, so that it can be replaced safely later
+CorpusMarker = ".constantina-bench-corpus"
+
+
+def paragraph(rng, words):
+    """A paragraph of vocabulary words, as one line of HTML"""
+    text = " ".join([rng.choice(Vocabulary) for i in range(0, words)])
+    return "<p>" + text.capitalize() + ".</p>"
+
+
+def write_text(path, lines):
+    """Write a card file, creating its directory if needed"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as cfile:
+        cfile.write("\n".join(lines) + "\n")
+
+
+def write_image(path, rng, size):
+    """A small solid-color picture, in whatever format the filename says"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    color = (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))
+    Image.new("RGB", size, color).save(path)
+
+
+def write_mp3(path, seconds):
+    """A silent MP3 that mutagen can read a length out of"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Each frame is 1152 samples at 44.1kHz
+    frames = int(seconds * 44100 / 1152)
+    with open(path, 'wb') as mfile:
+        mfile.write(Mp3Frame * max(frames, 1))
+
+
+def check_root(root, template_root, force=False):
+    """
+    Refuse to replace a directory that isn't a corpus generated before,
+    unless forced, and never replace the template data root.
+    """
+    real_root = os.path.realpath(root)
+    real_template = os.path.realpath(template_root)
+    if real_root == real_template or real_template.startswith(real_root + os.sep):
+        raise ValueError("%s holds the template data root %s" % (root, template_root))
+    if force is True or os.path.isdir(root) is False or os.listdir(root) == []:
+        return
+    if os.path.exists(root + "/" + CorpusMarker) is False:
+        raise ValueError("%s isn't a generated corpus; use --force to replace it" % root)
+
+
+def generate_corpus(root, template_root, news_count, seed=0, force=False):
+    """
+    Write a synthetic Constantina data root with news_count news cards, and
+    pictures, quotes, songs and topics in proportion to the shipped card
+    counts. Themes and page headers come from template_root, which should be
+    an installed data root. Generating the same size and seed twice makes
+    the same cards. An existing root is only replaced if it was generated
+    before, or force is set.
+
+    Returns the news card filenames, newest first.
+    """
+    rng = Random(seed)
+    private = root + "/private"
+    check_root(root, template_root, force)
+    if os.path.lexists(root):
+        shutil.rmtree(root)
+    os.makedirs(private)
+    with open(root + "/" + CorpusMarker, 'w', encoding='utf-8') as marker:
+        marker.write("seed %d, %d news cards\n" % (seed, news_count))
+    for ctype, path in CardPaths.items():
+        os.makedirs(private + "/" + path, exist_ok=True)
+
+    # Themes and scripts don't change how the pages scale, so share them
+    os.symlink(os.path.abspath(template_root + "/public"), root + "/public")
+    shutil.copytree(template_root + "/private/" + CardPaths['heading'],
+                    private + "/" + CardPaths['heading'], dirs_exist_ok=True)
+    os.makedirs(private + "/index")
+    for ignore in ["ignore-words", "ignore-symbols"]:
+        shutil.copy(template_root + "/private/index/" + ignore, private + "/index/" + ignore)
+
+    # News cards are named for their utime, an hour apart, ending now. One
+    # in four leads with an inline image, half of those large enough to expand.
+    inline_images = max(news_count // 8, 1)
+    for i in range(0, inline_images):
+        size = (640, 480) if i % 2 == 0 else (120, 90)
+        write_image(private + "/images/bench/%d.png" % i, rng, size)
+
+    now = int(time.time())
+    news_files = []
+    for i in range(0, news_count):
+        filename = str(now - i * 3600)
+        lines = [" ".join([rng.choice(Vocabulary) for j in range(0, 4)]).title(),
+                 ", ".join(rng.sample(Topics, 2)),
+                 ""]
+        if i % 4 == 0:
+            lines.append('<img src="/images/bench/%d.png" class="InlineNewsCenterFocus" />' %
+                         rng.randint(0, inline_images - 1))
+        lines.extend([paragraph(rng, rng.randint(20, 80)) for j in range(0, rng.randint(2, 6))])
+        write_text(private + "/" + CardPaths['news'] + "/" + filename, lines)
+        news_files.append(filename)
+
+    # Pictures, and quotes with more than one line to them. The hidden
+    # directories must have something in them to pick from.
+    for i in range(0, max(news_count * 3 // 10, 4)):
+        extension = "jpg" if i % 2 == 0 else "png"
+        write_image(private + "/%s/p%d.%s" % (CardPaths['images'], i, extension), rng, (320, 240))
+    write_image(private + "/%s/hidden/h0.jpg" % CardPaths['images'], rng, (320, 240))
+
+    for i in range(0, max(news_count * 4 // 10, 4)):
+        write_text(private + "/%s/q%d" % (CardPaths['quotes'], i),
+                   ["Quote %d" % i, "Quotes", "", paragraph(rng, rng.randint(6, 20))])
+    write_text(private + "/%s/hidden/h0" % CardPaths['quotes'],
+               ["Hidden Quote", "Quotes", "", paragraph(rng, 8)])
+
+    # Playlists of a few short songs each, kept in a folder per playlist
+    for i in range(0, max(news_count // 10, 2)):
+        playlist = "playlist%d" % i
+        tracks = []
+        for j in range(0, rng.randint(1, 4)):
+            track = playlist + "/track%d.mp3" % j
+            write_mp3(private + "/" + CardPaths['songs'] + "/" + track, rng.randint(2, 10))
+            tracks.append(track)
+        write_text(private + "/%s/%s.m3u" % (CardPaths['songs'], playlist), tracks)
+
+    for topic in Topics:
+        write_text(private + "/%s/%s" % (CardPaths['topics'], topic.lower()),
+                   [topic, topic, "", paragraph(rng, 40), paragraph(rng, 40)])
+
+    return news_files
@@ -0,0 +1,146 @@
+import re
+from time import perf_counter
+import tracemalloc
+
+from constantina.bench.corpus import Vocabulary, generate_corpus
+from constantina.constantina import FreshPages, application
+from constantina.shared import BaseFiles, GlobalConfig
+
+# Every kind of page the harness can ask for
+Modes = ["fresh", "scroll", "search", "filter", "permalink"]
+
+# The next-page state, as written into a page's tombstone card
+StatePattern = re.compile(r'<p id="state">([^<]*)</p>')
+
+
+def percentile(latencies, fraction):
+    """Nearest-rank percentile of a sorted list of latencies"""
+    rank = max(int(round(fraction * len(latencies))) - 1, 0)
+    return latencies[rank]
+
+
+class ModeResult:
+    """Latencies and peak memory for one mode, against one corpus size"""
+    def __init__(self, mode, size, latencies, elapsed, peak):
+        self.mode = mode
+        self.size = size
+        self.latencies = sorted(latencies)   # Seconds per request
+        self.elapsed = elapsed               # Seconds for all requests
+        self.peak = peak                     # Bytes, during one request
+
+    def percentile(self, fraction):
+        """Nearest-rank percentile of the request latencies, in seconds"""
+        return percentile(self.latencies, fraction)
+
+    def throughput(self):
+        """Requests per second, one request at a time"""
+        return len(self.latencies) / self.elapsed
+
+    def row(self):
+        """One line of the suite's report"""
+        return "%8d  %-10s %6d %9.2f %9.2f %9.2f %9.1f %9.1f" % (
+            self.size, self.mode, len(self.latencies),
+            self.percentile(0.50) * 1000,
+            self.percentile(0.95) * 1000,
+            self.percentile(0.99) * 1000,
+            self.throughput(),
+            self.peak / 1048576.0)
+
+
+ReportHeader = "%8s  %-10s %6s %9s %9s %9s %9s %9s" % (
+    "news", "mode", "reqs", "p50 ms", "p95 ms", "p99 ms", "req/s", "peak MB")
+
+
+def request(in_state):
+    """Run one request through the WSGI application, and return its HTML"""
+    uri = '/?' + in_state if in_state != '' else '/'
+    env = {'QUERY_STRING': in_state, 'REQUEST_URI': uri}
+    return b''.join(application(env, lambda status, headers: None)).decode('utf-8')
+
+
+def scroll_state(pages):
+    """
+    The state for scrolling pages deep into the site, found by following
+    each page's tombstone state from a fresh page. If the site runs out of
+    pages first, the last page's state is used.
+    """
+    in_state = ''
+    for i in range(0, pages):
+        match = StatePattern.search(request(in_state))
+        if match is None:
+            break
+        in_state = match.group(1)
+    return in_state
+
+
+class BenchSuite:
+    """
+    Constantina End-to-End Benchmark.
+
+    For each corpus size, generate a synthetic data root, point the
+    configuration at it, and time whole requests through application() for
+    each mode: a fresh page, a page scrolled several pages deep, a search,
+    a card-type filter, and a news permalink. The fresh page pool is turned
+    off, so every fresh page is drawn while the clock runs.
+
+    Each mode is run once to warm up caches and the search index, then
+    timed, then run once more under tracemalloc to find its peak memory.
+    Tracing slows requests down, so it's kept out of the timed runs.
+    """
+    def __init__(self, work_root, template_root, count=100, page=3, seed=0, force=False):
+        self.work_root = work_root
+        self.template_root = template_root
+        self.count = count
+        self.page = page
+        self.seed = seed
+        self.force = force
+
+    def states(self, news_files):
+        """The state string each mode asks for"""
+        return {
+            'fresh': '',
+            'scroll': scroll_state(self.page),
+            'search': 'xs' + Vocabulary[self.seed % len(Vocabulary)],
+            'filter': 'xonews',
+            'permalink': 'xn' + news_files[0],
+        }
+
+    def run_mode(self, mode, size, in_state):
+        """Time one mode's requests against the current corpus"""
+        request(in_state)
+
+        latencies = []
+        start = perf_counter()
+        for i in range(0, self.count):
+            request_start = perf_counter()
+            request(in_state)
+            latencies.append(perf_counter() - request_start)
+        elapsed = perf_counter() - start
+
+        tracemalloc.start()
+        request(in_state)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return ModeResult(mode, size, latencies, elapsed, peak)
+
+    def run_size(self, size, modes):
+        """Generate a corpus with this many news cards, and run each mode"""
+        root = "%s/news%d" % (self.work_root, size)
+        news_files = generate_corpus(root, self.template_root, size, self.seed, self.force)
+        GlobalConfig.set("paths", "data_root", root)
+        BaseFiles.clear()
+        FreshPages.size = 0
+
+        states = self.states(news_files)
+        return [self.run_mode(mode, size, states[mode]) for mode in modes]
+
+    def run(self, sizes, modes=Modes, report=print):
+        """Run every mode at every size, reporting each result as it's done"""
+        results = []
+        report(ReportHeader)
+        for size in sizes:
+            for result in self.run_size(size, modes):
+                report(result.row())
+                results.append(result)
+        return results
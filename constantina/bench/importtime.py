@@ -0,0 +1,74 @@
+import re
+import subprocess
+import sys
+from time import perf_counter
+
+from constantina.bench.harness import percentile
+
+# Dependencies that should only be loaded by the requests that use them
+HeavyModules = ["whoosh", "tinysegmenter", "whooshjp", "mutagen", "PIL", "magic", "urllib.request"]
+
+# One line of python -X importtime output:
+#   import time: self [us] | cumulative | imported package
+ImportLine = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+# Run in a new interpreter: load the application, and answer one request
+# without the fresh page pool, the way a CGI request would
+ColdRequest = """
+from constantina import constantina
+constantina.FreshPages.size = 0
+in_state = %r
+env = {'QUERY_STRING': in_state, 'REQUEST_URI': '/?' + in_state if in_state else '/'}
+b''.join(constantina.application(env, lambda status, headers: None) or [])
+"""
+
+
+class ImportRun:
+    """The modules one new interpreter imported, and how long it all took"""
+    def __init__(self, seconds, stderr):
+        self.seconds = seconds     # Wall time for the whole process
+        self.modules = {}          # Module name -> cumulative import seconds
+        self.top_level = 0.0       # Seconds spent in top-level imports
+        for line in stderr.splitlines():
+            match = ImportLine.match(line)
+            if match is None:
+                continue
+            cumulative = int(match.group(2)) / 1000000
+            self.modules[match.group(4)] = cumulative
+            if len(match.group(3)) == 1:
+                self.top_level += cumulative
+
+    def loaded(self, prefix):
+        """Did this run import a module, or anything in its package?"""
+        return any([name == prefix or name.startswith(prefix + ".") for name in self.modules])
+
+
+def cold_start(in_state="", runs=5):
+    """Answer one request in each of runs new interpreters"""
+    results = []
+    for i in range(0, runs):
+        start = perf_counter()
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", ColdRequest % in_state],
+                                 stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                 universal_newlines=True, check=True)
+        results.append(ImportRun(perf_counter() - start, process.stderr))
+    return results
+
+
+def report_imports(results, top=15, report=print):
+    """
+    Median import and process times over the runs, the slowest imports
+    of the median run, and which heavy dependencies were loaded at all.
+    """
+    imports = sorted([run.top_level for run in results])
+    walls = sorted([run.seconds for run in results])
+    report("%d runs: imports p50 %.1fms, process p50 %.1fms, %d modules" % (
+        len(results), percentile(imports, 0.50) * 1000,
+        percentile(walls, 0.50) * 1000, len(results[0].modules)))
+
+    median = sorted(results, key=lambda run: run.top_level)[len(results) // 2]
+    report("%-44s %9s" % ("slowest imports", "ms"))
+    for name, seconds in sorted(median.modules.items(), key=lambda item: -item[1])[0:top]:
+        report("%-44s %9.2f" % (name, seconds * 1000))
+    for module in HeavyModules:
+        report("%-44s %9s" % (module, "loaded" if median.loaded(module) else "-"))
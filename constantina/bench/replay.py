@@ -0,0 +1,172 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import gzip
+import re
+from threading import Lock
+from time import perf_counter, sleep
+
+from constantina.bench.harness import percentile
+from constantina.constantina import application, request_values
+from constantina.context import RequestContext
+from constantina.profiling import request_mode
+from constantina.state import ConstantinaState
+
+# Nginx's combined log format, and the formats that are based on it:
+#   1.2.3.4 - - [19/Oct/2026:16:10:33 +0000] "GET /?xp1 HTTP/1.1" 200 ...
+NginxPattern = re.compile(r'\[(?P<time>[^\]]+)\] "(?P<method>[A-Z]+) (?P<uri>\S+)[^"]*"')
+NginxTime = "%d/%b/%Y:%H:%M:%S %z"
+
+# uWSGI's default request log:
+#   [pid: 1|app: 0|req: 1/1] 1.2.3.4 () {40 vars in 600 bytes}
+#   [Mon Oct 19 16:10:33 2026] GET /?xp1 => generated 9000 bytes ...
+UwsgiPattern = re.compile(r'\[(?P<time>\w{3} \w{3} +\d+ [\d:]+ \d{4})\] (?P<method>[A-Z]+) (?P<uri>\S+) =>')
+UwsgiTime = "%a %b %d %H:%M:%S %Y"
+
+
+class LogEntry:
+    """One request from an access log, and when it came in"""
+    def __init__(self, offset, uri):
+        self.offset = offset   # Seconds after the first request in the log
+        self.uri = uri
+        self.in_state = uri.partition('?')[2]
+
+
+def parse_line(line):
+    """The time and URI of a GET in a log line, or None if there isn't one"""
+    for pattern, time_format in [(UwsgiPattern, UwsgiTime), (NginxPattern, NginxTime)]:
+        match = pattern.search(line)
+        if match is None or match.group('method') != 'GET':
+            continue
+        try:
+            when = datetime.strptime(match.group('time'), time_format)
+        except ValueError:
+            continue
+        return when.timestamp(), match.group('uri')
+    return None
+
+
+def read_log(paths, files=False):
+    """
+    Read the GET requests out of nginx or uWSGI access logs, which may be
+    gzipped. Only page requests for / are kept, unless files is set, in
+    which case requests that Constantina would serve as files are too.
+    Entries are sorted by time, and offset from the first request.
+    """
+    requests = []
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, 'rt', encoding='utf-8', errors='replace') as logfile:
+            for line in logfile:
+                parsed = parse_line(line)
+                if parsed is None:
+                    continue
+                when, uri = parsed
+                if uri == '/' or uri.startswith('/?') or files is True:
+                    requests.append((when, uri))
+
+    requests.sort(key=lambda request: request[0])
+    if requests == []:
+        return []
+    first = requests[0][0]
+    return [LogEntry(when - first, uri) for when, uri in requests]
+
+
+def classify(entry, modes):
+    """
+    The page mode of a request, from the same state predicates that the
+    application uses. States repeat a lot in real traffic, so each one is
+    only parsed once.
+    """
+    if entry.uri not in modes:
+        env = {'QUERY_STRING': entry.in_state, 'REQUEST_URI': entry.uri}
+        in_state, in_uri = request_values(env)
+        if in_state is None and in_uri is not None:
+            modes[entry.uri] = "file"
+        else:
+            context = RequestContext(env)
+            modes[entry.uri] = request_mode(ConstantinaState(in_state, env, context))
+    return modes[entry.uri]
+
+
+class Replay:
+    """
+    Constantina Access Log Replay.
+
+    Send the requests from a real access log through application() in
+    this process, on a pool of concurrency threads. Requests are sent with
+    the same spacing they had in the log, divided by speed; a speed of 0
+    sends them as fast as the threads can take them. Latencies are kept
+    by page mode, so that deep scrolls, searches, and permalinks can each
+    be seen on their own.
+
+    Replays should be run against a copy of the data root, since searches
+    write to the search index.
+    """
+    def __init__(self, entries, concurrency=4, speed=1.0):
+        self.entries = entries
+        self.concurrency = concurrency
+        self.speed = speed
+        self.latencies = {}   # Mode -> seconds per request
+        self.errors = {}      # Mode -> requests that failed or returned 5xx
+        self.lag = []         # Seconds each request started behind schedule
+        self.failures = {}    # Exception name or status -> count
+        self.lock = Lock()
+
+    def __send(self, entry, mode, scheduled):
+        """Run one request, and record how long it took"""
+        started = perf_counter()
+        failure = None
+        status = []
+        env = {'QUERY_STRING': entry.in_state, 'REQUEST_URI': entry.uri}
+        try:
+            b''.join(application(env, lambda code, headers: status.append(code)) or [])
+        except Exception as error:
+            failure = error.__class__.__name__
+            if str(error) != "":
+                failure += ": " + str(error)
+        seconds = perf_counter() - started
+        if status != [] and status[0].startswith('5'):
+            failure = status[0]
+
+        with self.lock:
+            self.latencies.setdefault(mode, []).append(seconds)
+            self.lag.append(max(started - scheduled, 0))
+            if failure is not None:
+                self.errors[mode] = self.errors.get(mode, 0) + 1
+                self.failures[failure] = self.failures.get(failure, 0) + 1
+
+    def run(self):
+        """Replay every entry, and return how many seconds it took"""
+        modes = {}
+        classified = [(entry, classify(entry, modes)) for entry in self.entries]
+
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for entry, mode in classified:
+                scheduled = start
+                if self.speed > 0:
+                    scheduled = start + entry.offset / self.speed
+                    wait = scheduled - perf_counter()
+                    if wait > 0:
+                        sleep(wait)
+                pool.submit(self.__send, entry, mode, scheduled)
+        return perf_counter() - start
+
+    def report(self, elapsed, report=print):
+        """Latency percentiles and errors per mode, then overall throughput"""
+        report("%-18s %6s %6s %9s %9s %9s %9s" % (
+            "mode", "reqs", "errors", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+        for mode in sorted(self.latencies.keys()):
+            latencies = sorted(self.latencies[mode])
+            report("%-18s %6d %6d %9.2f %9.2f %9.2f %9.2f" % (
+                mode, len(latencies), self.errors.get(mode, 0),
+                percentile(latencies, 0.50) * 1000,
+                percentile(latencies, 0.95) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                latencies[-1] * 1000))
+        if self.lag != []:
+            lag = sorted(self.lag)
+            report("%d requests in %.1fs, %.1f req/s, start lag p95 %.1fms" % (
+                len(lag), elapsed, len(lag) / elapsed, percentile(lag, 0.95) * 1000))
+        for failure in sorted(self.failures.keys()):
+            report("failed: %s x%d" % (failure, self.failures[failure]))
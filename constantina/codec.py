@@ -0,0 +1,169 @@
+from urllib.parse import quote_plus, unquote_plus
+
+
+# Compact state strings begin with this sigil, followed by a single
+# version character. Legacy state strings never start with it, since
+# every legacy token is either all-digits or starts with a letter.
+CompactSigil = "~"
+CompactVersion = "1"
+Base36Digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+class StateTokens:
+    """
+    Constantina State Tokens.
+
+    A parsed form of the colon-delimited state string. The state string is
+    split exactly once per request, and every token is classified by shape:
+        - The random seed is the one all-numeric token
+        - Special states are two-letter tokens starting with "x", whose
+          values are url-decoded strings (xs, xo, xp, xa, xn...)
+        - Content card states are a single card-type letter followed by a
+          distance integer (n9, i4, q1...)
+
+    ConstantinaState and each sub-application state read their values out
+    of a shared StateTokens object, rather than re-splitting the string.
+    Tokens are remembered in the order they were added, so that encoding
+    a state back into a string is stable.
+    """
+    def __init__(self):
+        self.seed = None     # Digit string, or None
+        self.specials = {}   # "xs" -> "search terms"
+        self.cards = {}      # "n" -> 9
+        self.order = []      # Keys in the order they were added
+
+    def set_special(self, key, value):
+        """Add a special state value. The first value for any key wins."""
+        if key in self.specials:
+            return
+        self.specials[key] = value
+        self.order.append(key)
+
+    def set_card(self, letter, distance):
+        """Add a card distance value. The first value for any letter wins."""
+        if letter in self.cards:
+            return
+        self.cards[letter] = int(distance)
+        self.order.append(letter)
+
+    def get(self, query):
+        """
+        Look up a state value by its token prefix, or "seed" to return the
+        random seed digits. Returns None for values not in the state.
+        """
+        if query == "seed":
+            return self.seed
+        if query in self.specials:
+            return self.specials[query]
+        return self.cards.get(query)
+
+    def __eq__(self, other):
+        return (isinstance(other, StateTokens) and
+                self.seed == other.seed and
+                self.specials == other.specials and
+                self.cards == other.cards)
+
+
+def to_base36(number):
+    """Write a non-negative integer in lowercase base36"""
+    if number == 0:
+        return "0"
+    output = ""
+    while number > 0:
+        number, digit = divmod(number, 36)
+        output = Base36Digits[digit] + output
+    return output
+
+
+def decode_token(tokens, token):
+    """Classify a single legacy token and add it into the StateTokens."""
+    if token == '':
+        return
+    if token.isdigit():
+        if tokens.seed is None:
+            tokens.seed = token
+    elif token[0] == 'x' and len(token) >= 2:
+        tokens.set_special(token[0:2], unquote_plus(token[2:]))
+    elif token[1:].isdigit():
+        tokens.set_card(token[0], token[1:])
+    else:
+        pass   # Malformed card distance. Ignore it, as if it wasn't there
+
+
+def decode_compact_cards(tokens, run):
+    """
+    Compact card distances are a single run of letter/number pairs, since
+    the letters themselves delimit the decimal distances: "i4q1s13n9"
+    """
+    letter = None
+    digits = ""
+    for char in run + "$":
+        if char.isdigit():
+            digits += char
+            continue
+        if letter is not None and digits != "":
+            tokens.set_card(letter, digits)
+        letter = char
+        digits = ""
+
+
+def decode_state(in_state):
+    """
+    Parse a state string in a single pass. Both the legacy colon-delimited
+    form and the compact form are accepted, so that links written before
+    compact encoding was enabled continue to work.
+    """
+    tokens = StateTokens()
+    if in_state is None or in_state == '':
+        return tokens
+
+    parts = in_state.split(':')
+    if (parts[0][0:1] == CompactSigil) and (parts[0][1:2] == CompactVersion):
+        seed = parts[0][2:]
+        try:
+            # The seed was written with a leading 1, preserving leading zeros
+            tokens.seed = str(int(seed, 36))[1:] or None
+        except ValueError:
+            pass
+        if len(parts) > 1 and parts[1][0:1] != 'x':
+            decode_compact_cards(tokens, parts[1])
+            parts = parts[2:]
+        else:
+            parts = parts[1:]
+
+    for token in parts:
+        decode_token(tokens, token)
+    return tokens
+
+
+def encode_state(tokens, compact=False):
+    """
+    Write a StateTokens object back into a state string. The legacy form
+    writes the seed first, and every other token in the order it was added.
+    The compact form writes the seed in base36, and all card distances in
+    a single token, which leaves more of the 512-character state limit for
+    search terms.
+    """
+    if compact is False:
+        parts = []
+        if tokens.seed is not None:
+            parts.append(tokens.seed)
+        for key in tokens.order:
+            if key in tokens.specials:
+                parts.append(key + quote_plus(tokens.specials[key]))
+            else:
+                parts.append(key + str(tokens.cards[key]))
+        return ':'.join(parts)
+
+    head = CompactSigil + CompactVersion
+    if tokens.seed is not None and tokens.seed.isdigit():
+        head += to_base36(int("1" + tokens.seed))
+    parts = [head]
+    cards = ''.join([key + str(tokens.cards[key])
+                     for key in tokens.order if key in tokens.cards])
+    if cards != '':
+        parts.append(cards)
+    for key in tokens.order:
+        if key in tokens.specials:
+            parts.append(key + quote_plus(tokens.specials[key]))
+    return ':'.join(parts)
@@ -0,0 +1,146 @@
+from collections import OrderedDict
+import gzip
+import struct
+from threading import Lock
+import zlib
+
+from constantina.metrics import Metrics
+from constantina.shared import GlobalConfig, header_qualities
+
+# Brotli is optional. Without it, pages are only ever gzipped.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CompressionEnabled = GlobalConfig.getboolean("compression", "enabled", fallback=True)
+# Cached fragments are compressed once, so spend the CPU on a smaller size
+FragmentLevel = GlobalConfig.getint("compression", "fragment_level", fallback=9)
+# Pieces of a page that are drawn for every request get a quicker level
+RequestLevel = GlobalConfig.getint("compression", "request_level", fallback=6)
+BrotliQuality = GlobalConfig.getint("compression", "brotli_quality", fallback=11)
+
+# A gzip header for raw deflate data: no filename, no mtime, unknown OS
+GzipHeader = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+# An empty, final deflate block, to end a run of sync-flushed fragments
+FinalBlock = b'\x03\x00'
+
+
+class Fragment:
+    """
+    A piece of a page: a card, or the part of a theme before or after the
+    cards. Each fragment is deflated on its own and sync-flushed, so that
+    the deflate data for any run of fragments can be joined end to end
+    into one gzip stream, without compressing anything again.
+    """
+    def __init__(self, text, level=RequestLevel):
+        self.text = text
+        self.data = text.encode('utf-8')
+        self.level = level
+        self.__deflated = None
+
+    def deflated(self):
+        """Raw deflate data for this fragment, ending on a byte boundary"""
+        if self.__deflated is None:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            self.__deflated = compressor.compress(self.data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        return self.__deflated
+
+
+class GzipStream:
+    """
+    Join fragments into one gzip stream, a fragment at a time. Only the
+    CRC of each fragment is computed as it's added, which is far cheaper
+    than compressing it.
+    """
+    def __init__(self):
+        self.crc = 0
+        self.size = 0
+
+    def add(self, fragment):
+        """The compressed bytes for the next fragment in the stream"""
+        self.crc = zlib.crc32(fragment.data, self.crc)
+        self.size += len(fragment.data)
+        return fragment.deflated()
+
+    def trailer(self):
+        """The bytes that end the stream"""
+        return FinalBlock + struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff)
+
+
+def gzip_fragments(fragments):
+    """A whole gzip response body, joined from fragments"""
+    stream = GzipStream()
+    return GzipHeader + b''.join([stream.add(fragment) for fragment in fragments]) + stream.trailer()
+
+
+class FragmentCache:
+    """
+    Constantina Fragment Cache.
+
+    Cards and theme segments that are drawn the same way for every
+    request, kept with their compressed forms so that neither drawing
+    nor compressing is done twice. Keys include the mtime of the file the
+    fragment was drawn from, so edited cards get drawn again. The least
+    recently used fragments are dropped once there are size of them.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        """A cached fragment, or None"""
+        if self.size <= 0:
+            return None
+        with self.lock:
+            fragment = self.entries.get(key)
+            if fragment is not None:
+                self.entries.move_to_end(key)
+        if fragment is None:
+            Metrics.inc("constantina_cache_misses_total", {'cache': 'fragments'})
+        else:
+            Metrics.inc("constantina_cache_hits_total", {'cache': 'fragments'})
+        return fragment
+
+    def put(self, key, fragment):
+        """Cache a fragment, dropping the least recently used if full"""
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = fragment
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+# Fragments for every request in this process
+Fragments = FragmentCache(GlobalConfig.getint("compression", "fragment_cache", fallback=4096))
+
+
+def choose_encoding(env, offered):
+    """
+    The first of the offered content codings that the client accepts, by
+    its Accept-Encoding header, or "identity" if none of them are.
+    """
+    if CompressionEnabled is False:
+        return "identity"
+    accepted = header_qualities(env.get('HTTP_ACCEPT_ENCODING'))
+    for coding in offered:
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return "identity"
+
+
+def encoded_page(html):
+    """
+    A whole page in every coding it can be sent with, for pages that are
+    drawn once and sent many times.
+    """
+    data = html.encode('utf-8')
+    encodings = {'identity': data}
+    if CompressionEnabled is True:
+        encodings['gzip'] = gzip.compress(data, FragmentLevel)
+        if brotli is not None:
+            encodings['br'] = brotli.compress(data, quality=BrotliQuality)
+    return encodings
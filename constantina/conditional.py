@@ -0,0 +1,278 @@
+from email.utils import formatdate, parsedate_to_datetime
+from hashlib import sha1
+import os
+from stat import S_ISREG
+from threading import Lock
+import time
+import logging
+
+from constantina.context import RequestContext
+from constantina.medusa.derivatives import Derivatives
+from constantina.shared import GlobalConfig, BaseState, opendir
+
+log = logging.getLogger('constantina.conditional')
+
+
+class Validators:
+    """
+    Constantina Response Validators.
+
+    Permalink pages, search result pages and file trampoline responses only
+    change when their state string, their theme, or the content on disk
+    changes. For those responses, track an ETag and a Last-Modified time, so
+    that a returning reader or a crawler can be answered with a 304 before
+    any cards are opened or drawn.
+
+    The generation is a list of every mtime the response depends on. Page
+    ETags are weak, since the next-page state embedded in the page may carry
+    a different random seed, even when the cards are all the same.
+
+    When a theme is chosen randomly for each page load, a copy of the page
+    in any of the themes is still current. The ETags for those other themes
+    are kept in self.accepted.
+    """
+    def __init__(self, key, generation, last_modified, weak=True, alternates=[]):
+        self.last_modified = int(last_modified)
+        self.weak = weak
+        self.etag = self.__tag(key, generation)
+        self.accepted = [self.etag] + [self.__tag(alternate, generation) for alternate in alternates]
+
+    def __tag(self, key, generation):
+        """An ETag for the key, at this generation of the content"""
+        digest = sha1((key + "|" + ",".join(map(str, generation))).encode('utf-8')).hexdigest()
+        etag = '"' + digest[0:20] + '"'
+        if self.weak is True:
+            etag = 'W/' + etag
+        return etag
+
+    def headers(self):
+        """Response headers that let the client revalidate later"""
+        return [("ETag", self.etag),
+                ("Last-Modified", formatdate(self.last_modified, usegmt=True))]
+
+    def not_modified(self, env):
+        """
+        Is the client's cached copy still good? If-None-Match wins over
+        If-Modified-Since when both are given. Only GETs and HEADs get 304s.
+        """
+        if env.get('REQUEST_METHOD', 'GET') not in ['GET', 'HEAD']:
+            return False
+
+        if_none_match = env.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            # Weak comparison: W/ prefixes don't matter
+            tags = [tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')]
+            if '*' in tags:
+                return True
+            return any([etag.replace('W/', '', 1) in tags for etag in self.accepted])
+
+        if_modified_since = env.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError, IndexError):
+                return False
+            return self.last_modified <= since
+
+        return False
+
+    def range_current(self, env):
+        """
+        Should a Range request be answered with just the range? Only if the
+        If-Range validator, when there is one, still matches the file.
+        If-Range takes a strong ETag or an exact Last-Modified date.
+        """
+        if_range = env.get('HTTP_IF_RANGE')
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"'):
+            return (self.weak is False) and (if_range == self.etag)
+        try:
+            return parsedate_to_datetime(if_range).timestamp() == self.last_modified
+        except (TypeError, ValueError, IndexError):
+            return False
+
+
+def mtime(path):
+    """Modification time of a path, or 0 if it isn't there"""
+    try:
+        return int(os.path.getmtime(path))
+    except OSError:
+        return 0
+
+
+def ctype_mtimes(config, context, ctype):
+    """The mtimes of a card type's folder, and of every card in it"""
+    base_path = context.private_path(config.get("paths", ctype))
+    times = [mtime(base_path)]
+    for filename in opendir(config, ctype):
+        times.append(mtime(base_path + "/" + filename))
+    return times
+
+
+def theme_choices(state):
+    """Every theme this page could have been drawn in"""
+    theme = state.context.theme
+    if theme.random is True:
+        return [GlobalConfig.get("themes", str(i)) for i in range(0, theme.count)]
+    return [theme.theme]
+
+
+def theme_mtimes(state):
+    """Each theme's page template changes every page in that theme"""
+    return [mtime(state.context.public_path(theme + '/contents.html'))
+            for theme in theme_choices(state)]
+
+
+def page_keys(state, variant=""):
+    """
+    The state string, the chosen theme, and the variant (like a page's JSON
+    form) identify a page. Any other theme a random choice could have made
+    identifies an equally-current page.
+    """
+    key = state.in_state + "|" + state.theme + "|" + variant
+    alternates = [state.in_state + "|" + theme + "|" + variant for theme in theme_choices(state)
+                  if theme != state.theme]
+    return key, alternates
+
+
+def permalink_validators(state, variant=""):
+    """
+    A permalink page depends on its one card, and the heading cards around
+    it. News cards are named by their utime, which is when they were posted.
+    """
+    medusa = state.medusa
+    for ctype in ['news', 'features', 'topics']:
+        cnum = getattr(medusa, ctype + "_permalink")
+        if cnum is None:
+            continue
+        cnum = str(cnum)
+        card_path = state.context.private_path(medusa.config.get("paths", ctype) + "/" + cnum)
+        card_mtime = mtime(card_path)
+        generation = ([card_mtime, Derivatives.generation(state.context)] + theme_mtimes(state) +
+                      ctype_mtimes(medusa.config, state.context, 'heading'))
+        if ctype == 'news' and cnum.isdigit() is True:
+            last_modified = max(int(cnum), card_mtime)
+        else:
+            last_modified = card_mtime
+        key, alternates = page_keys(state, variant)
+        return Validators(key, generation, max([last_modified] + generation), alternates=alternates)
+    return None
+
+
+def search_validators(state, variant=""):
+    """
+    Search result pages depend on every card that could be found with a
+    search. The search index is left out, since searching updates it after
+    these validators are made. The cards are covered by the site's content
+    generation, which is only worked out again every check seconds, rather
+    than stat'ing every card on every search.
+    """
+    generation = [Generation.current()]
+    key, alternates = page_keys(state, variant)
+    return Validators(key, generation, Generation.modified, alternates=alternates)
+
+
+def site_generation(state):
+    """
+    Fresh pages can show any card, so they change when any card or theme
+    changes. Summarize all of those mtimes in one string.
+    """
+    times = []
+    for ctype in state.medusa.config.options("paths"):
+        times.extend(ctype_mtimes(state.medusa.config, state.context, ctype))
+    times.extend(theme_mtimes(state))
+    times.append(Derivatives.generation(state.context))
+    return sha1(",".join(map(str, times)).encode('utf-8')).hexdigest()[0:20]
+
+
+class ContentGeneration:
+    """
+    A cheaper summary of the site than site_generation, for pages that are
+    drawn ahead of time and looked up often. Rather than every card's mtime,
+    it covers each card directory's mtime and listing, which change when
+    a card is added, removed or published, along with the theme templates
+    and the derivatives. It's worked out again at most every check seconds.
+    Cards edited in place aren't seen until a card is added or removed.
+    The newest of those mtimes is kept too, for Last-Modified headers.
+    """
+    def __init__(self, check):
+        self.check = check
+        self.value = None
+        self.modified = 0
+        self.checked = 0
+        self.config = None
+        self.context = None
+        self.lock = Lock()
+
+    def current(self):
+        """The site's generation, as of at most check seconds ago"""
+        if self.value is None or time.time() - self.checked >= self.check:
+            with self.lock:
+                if self.value is None or time.time() - self.checked >= self.check:
+                    self.value = self.__summarize()
+                    self.checked = time.time()
+        return self.value
+
+    def after_fork(self):
+        """The lock might have been held by another thread when we forked"""
+        self.lock = Lock()
+
+    def __summarize(self):
+        """Summarize the card directories, themes and derivatives"""
+        if self.config is None:
+            self.config = BaseState(None, 'medusa.ini').config
+            self.context = RequestContext()
+        times = []
+        modified = []
+        for ctype in self.config.options("paths"):
+            base_path = self.context.private_path(self.config.get("paths", ctype))
+            try:
+                times.append(os.stat(base_path).st_mtime_ns)
+                times.append(len(opendir(self.config, ctype)))
+                modified.append(times[-2] // 1000000000)
+            except OSError:
+                times.append(0)
+        themes = [GlobalConfig.get("themes", str(i)) for i in range(0, len(GlobalConfig.items("themes")) - 1)]
+        theme_times = [mtime(self.context.public_path(theme + '/contents.html')) for theme in themes]
+        times.extend(theme_times)
+        times.append(Derivatives.generation(self.context))
+        self.modified = max(modified + theme_times + [0])
+        return sha1(",".join(map(str, times)).encode('utf-8')).hexdigest()[0:20]
+
+
+# Checked by the fresh page pool, the pages drawn ahead of time, and the
+# validators for search pages
+Generation = ContentGeneration(GlobalConfig.getint("fresh_pool", "check_seconds", fallback=30))
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=Generation.after_fork)
+
+
+def page_validators(state, variant=""):
+    """
+    Validators for a page, if the page is fully determined by its state.
+    Fresh pages and scrolled pages are shuffled differently each time, so
+    they aren't validated.
+    """
+    if state.in_state is None or state.reshuffle_mode() is True:
+        return None
+    if state.permalink_mode() is True:
+        return permalink_validators(state, variant)
+    if state.search_mode() is True:
+        return search_validators(state, variant)
+    return None
+
+
+def file_validators(static_file):
+    """
+    Validators for a file served through the trampoline. Returns None if
+    the file isn't there, or isn't a regular file.
+    """
+    try:
+        stat = os.stat(static_file)
+    except OSError:
+        return None
+    if S_ISREG(stat.st_mode) is False:
+        return None
+    return Validators(static_file, [int(stat.st_mtime), stat.st_size], stat.st_mtime, weak=False)
@@ -1,15 +1,25 @@
 import configparser
+import json
 import os
-from math import floor
-from random import randint, seed
-import syslog
-
-from constantina.shared import GlobalConfig, GlobalTime, BaseFiles, opendir, safe_path, urldecode
+from random import Random
+from time import perf_counter
+import logging
+
+from constantina.compression import CompressionEnabled, Fragment, FragmentLevel, Fragments, choose_encoding, encoded_page, gzip_fragments
+from constantina.conditional import Generation, file_validators, page_validators
+from constantina.files import file_type, send_file
+from constantina.freshpool import FreshPagePool
+from constantina.speculate import SpeculativePages
+from constantina.layout import CardLayout, LayoutRule
+from constantina.metrics import Metrics
+from constantina.profiling import RequestProfiler, request_mode
+from constantina.context import RequestContext
+from constantina.shared import GlobalConfig, card_map, contained_path, header_qualities, opendir, safe_path, urldecode
 from constantina.state import ConstantinaState
 from constantina.templates import template_contents
-from constantina.themes import GlobalTheme
+from constantina.timing import timed_phase
 from constantina.medusa.cards import *
-from constantina.medusa.search import MedusaSearch
+from constantina.medusa.derivatives import Derivatives, ImageFormats, choose_format
 
 # Look up Cards by application config name, instead of calling
 # MedusaCard/ZooCard directly. Medusa == Blog
@@ -17,7 +27,16 @@ CardClass = {
     'medusa'  : MedusaCard
 }
 
-syslog.openlog(ident='constantina')
+# Theme contents.html comment that gets replaced with the cards
+Substitute = '<!-- Contents go here -->'
+
+# Heading cards that mark where the client loads more cards from. JSON
+# scroll pages leave them out.
+ScrollMarkers = ['scrollstone', 'tombstone']
+ScrollSeparator = Fragment(",")
+ScrollTail = Fragment("]}")
+
+log = logging.getLogger('constantina')
 
 
 class ConstantinaPage:
@@ -41,6 +60,7 @@ class ConstantinaPage:
         self.cur_len = 0
         self.cards = []
         self.state = in_state
+        self.context = in_state.context
         self.out_state = ''
 
         self.search_results = ''
@@ -54,7 +74,7 @@ class ConstantinaPage:
         if self.state.fresh_mode() is True:
             # Create a new page of randomly-assorted images and quotes,
             # along with reverse-time-order News items
-            syslog.syslog("***** Completely new page-load workflow *****")
+            log.debug("***** Completely new page-load workflow *****")
             self.__get_cards()
             self.__distribute_cards()
             self.cards.insert(0, MedusaCard('heading', 'welcome', state=self.state.medusa, grab_body=True))
@@ -71,7 +91,7 @@ class ConstantinaPage:
             # This is a permalink page request. For these, use a
             # special footer card (just a header card placed at
             # the bottom of the page).
-            syslog.syslog("***** Permalink page workflow *****")
+            log.debug("***** Permalink page workflow *****")
             self.__get_permalink_card()
             self.cards.append(MedusaCard('heading', 'footer', state=self.state.medusa, grab_body=True, permalink=True))
 
@@ -80,8 +100,12 @@ class ConstantinaPage:
             # parsed by __import_state into self.state.search.
             # TODO: Tokenize all search parameters and remove non-alphanum characters
             # other than plus or hash for hashtags. All input-commas become pluses
-            syslog.syslog("***** Search/Filter card workflow *****")
-            self.search_results = MedusaSearch(self.state)
+            log.debug("***** Search/Filter card workflow *****")
+            with self.context.timer.phase("search"):
+                # Whoosh and the tokenizers are only loaded once there's
+                # something to search for
+                from constantina.medusa.search import MedusaSearch
+                self.search_results = MedusaSearch(self.state)
             self.query_terms = self.search_results.query_string
             self.filter_terms = self.search_results.filter_string
             self.filtered = self.search_results.filtered
@@ -89,7 +113,7 @@ class ConstantinaPage:
             self.__distribute_cards()
 
             # If the results have filled up the page, try and load more results
-            syslog.syslog("page:%d  maxitems:%d  max-filter:%d  cardlen:%d" % (self.state.page, self.state.max_items, self.state.max_items - self.filtered, len(self.cards)))
+            log.debug("page:%d  maxitems:%d  max-filter:%d  cardlen:%d", self.state.page, self.state.max_items, self.state.max_items - self.filtered, len(self.cards))
             # TODO: this logic has issues
             if (self.state.max_items - self.filtered) * (self.state.page + 1) <= len(self.cards):
                 # Add a hidden card to trigger loading more data when reached
@@ -105,7 +129,7 @@ class ConstantinaPage:
             # Get new cards for an existing page, tracking what the
             # previous page's state variable was in creating the list
             # of cards to display.
-            syslog.syslog("***** New cards on existing page workflow *****")
+            log.debug("***** New cards on existing page workflow *****")
             self.__get_prior_cards()
             self.__get_cards()
             self.__distribute_cards()
@@ -121,10 +145,11 @@ class ConstantinaPage:
         # Once we've constructed the new card list, update the page
         # state for insertion, for the "next_page" link.
         self.out_state = self.state.export_state(self.cards, self.query_terms, self.filter_terms, self.filtered)
-        syslog.syslog("Initial state: " + str(self.state.in_state))
-        syslog.syslog("To-load state: " + str(self.out_state))
+        log.debug("Initial state: %s", self.state.in_state)
+        log.debug("To-load state: %s", self.out_state)
 
 
+    @timed_phase("cards")
     def __get_cards(self):
         """
         Get a page's worth of news updates. Include images and
@@ -133,6 +158,7 @@ class ConstantinaPage:
         # Anything with rules for cards per page, start adding them.
         # Do not grab full data for all but the most recent cards!
         # For older cards, just track their metadata
+        wanted = []
         for application in self.applications:
             app_state = getattr(self.state, application)
             for ctype in app_state.ctypes:
@@ -159,13 +185,23 @@ class ConstantinaPage:
                     start = int(self.state.page * card_count)
 
                 for i in range(start, start + card_count):
-                    # TODO: specify generic card class for obtaining
-                    card = CardClass[application](ctype, i, state=app_state, grab_body=True)
-                    # Don't include cards that failed to load content
-                    if card.topics != []:
-                        self.cards.append(card)
+                    # Seeds for any hidden-card choices are drawn here, in page order
+                    wanted.append((application, ctype, i, Random(app_state.rng.random())))
+
+        # Open all the cards at once, and keep them in the order they were wanted
+        def load_card(spec):
+            application, ctype, i, rng = spec
+            app_state = getattr(self.state, application)
+            # TODO: specify generic card class for obtaining
+            return CardClass[application](ctype, i, state=app_state, grab_body=True, rng=rng)
 
+        for card in card_map(load_card, wanted, serial=self.context.profiling):
+            # Don't include cards that failed to load content
+            if card.topics != []:
+                self.cards.append(card)
 
+
+    @timed_phase("cards")
     def __get_search_result_cards(self):
         """
         Get all available search updates. Include only the sorted, arranged list
@@ -183,6 +219,7 @@ class ConstantinaPage:
                 encyclopedia = MedusaCard('topics', self.query_terms.lower(), state=self.state.medusa, grab_body=True, search_result=True)
                 self.cards.append(encyclopedia)
 
+        wanted = []
         for each_app in self.applications:
             app_state = getattr(self.state, each_app)
 
@@ -195,7 +232,7 @@ class ConstantinaPage:
                 if app_state.exclude_cardtype(ctype) is True:
                     continue
 
-                syslog.syslog("ctype: " + ctype + " filter: " + str(getattr(app_state, ctype).filtertype) + " card_filter_state: " + str(app_state.card_filter))
+                log.debug("ctype: %s filter: %s card_filter_state: %s", ctype, getattr(app_state, ctype).filtertype, app_state.card_filter)
                 start = 0
                 end_dist = len(self.search_results.hits[ctype])
                 # No results for this search type
@@ -206,19 +243,29 @@ class ConstantinaPage:
                     grab_file = self.search_results.hits[ctype][j]
                     # If the hits[ctype][j] is a file name, figure out which Nth file this is
                     if grab_file.isdigit() is False:
-                        for k in range(0, len(BaseFiles[ctype])):
-                            # syslog.syslog("compare:" + grab_file + "==" + BaseFiles[ctype][k])
-                            if BaseFiles[ctype][k] == grab_file:
+                        type_files = opendir(app_state.config, ctype)
+                        for k in range(0, len(type_files)):
+                            # log.debug("compare:" + grab_file + "==" + type_files[k])
+                            if type_files[k] == grab_file:
                                 grab_file = k
                                 break
 
-                    card = CardClass[each_app](ctype, grab_file, state=app_state, grab_body=True, search_result=True)
-                    # News articles without topic strings won't load. Other card types that
-                    # don't have embedded topics will load just fine.
-                    if (card.topics != []) or (ctype == 'quotes') or (ctype == 'topics'):
-                        self.cards.append(card)
+                    wanted.append((each_app, ctype, grab_file))
+
+        # Open all the result cards at once, keeping the search result order
+        def load_card(spec):
+            each_app, ctype, grab_file = spec
+            app_state = getattr(self.state, each_app)
+            return CardClass[each_app](ctype, grab_file, state=app_state, grab_body=True, search_result=True)
 
+        for card in card_map(load_card, wanted, serial=self.context.profiling):
+            # News articles without topic strings won't load. Other card types that
+            # don't have embedded topics will load just fine.
+            if (card.topics != []) or (card.ctype == 'quotes') or (card.ctype == 'topics'):
+                self.cards.append(card)
 
+
+    @timed_phase("cards")
     def __get_permalink_card(self):
         """
         Given a utime or card filename, return a permalink page of that type.
@@ -237,6 +284,7 @@ class ConstantinaPage:
                     self.cards.append(CardClass[each_app](ctype, cnum, state=app_state, grab_body=True, permalink=True))
 
 
+    @timed_phase("prior")
     def __get_prior_cards(self):
         """
         Describe all prior cards based on the state object
@@ -277,7 +325,7 @@ class ConstantinaPage:
             dist = getattr(self.state.medusa, ctype).distance
             if (len(getattr(self.state.medusa, ctype).clist) == 0) or (dist is None):
                 continue
-            syslog.syslog("ctype, len, and dist: " + str(ctype) + " " + str(len(self.cards)) + " " + str(dist))
+            log.debug("ctype, len, and dist: %s %d %s", ctype, len(self.cards), dist)
             put = len(self.cards) - 1 - int(dist)
             # TODO: don't put all the shuffled range clist cards in. Just go back 
             # the maximum number of cards necessary.
@@ -292,234 +340,355 @@ class ConstantinaPage:
         self.cur_len = len(self.cards)
 
 
+    @timed_phase("distribute")
     def __distribute_cards(self):
         """
         Distribute cards evenly in the array in order to
         describe the ordering of a page. Use slight random jitter
-        in placement to guarantee fresh page ordering every time
+        in placement to guarantee fresh page ordering every time.
+        Only the new cards after cur_len are rearranged.
         """
-        total = len(self.cards)
         lstop = self.cur_len
-        p_dist = total - lstop
-        # Distance from last ctype'd card on the previous page
-        c_dist = {}
-        # "hold-aside" hash to help shuffle the main run of cards
-        c_redist = {}
-        # non-redist set (news articles)
-        c_nodist = {}
+        new_cards = self.cards[lstop:]
+        del self.cards[lstop:]
 
         for application in self.applications:
             app_state = getattr(self.state, application)
-            for ctype, spacing in app_state.config.items("card_spacing"):
-                # Spacing rules from the last page. Subtract the distance from
-                # the end of the previous page. For all other cards, follow the
-                # strict card spacing rules from the config file, plus jitter
-                spacing = int(spacing)
-                distance = getattr(app_state, ctype).distance
-                if distance is None:
-                    distance = 0
-
-                if distance >= spacing:   # Prev page ctype card not close
-                    c_dist[ctype] = 0
-                elif (lstop == 0) and (distance == 0):   # No pages yet
-                    c_dist[ctype] = 0
-                else:   # Implement spacing from the beginning of the new page
-                    c_dist[ctype] = spacing - distance
-                # syslog.syslog("*** initial spacing: ctype:%s  spacing:%d  c_dist:%d  distance:%d  lstop:%d" % ( ctype, spacing, c_dist[ctype], distance, lstop))
-                c_redist[ctype] = []
-                c_nodist[ctype] = []
-
-            # Make arrays of each card type, so we can random-jump their inserts later.
-            for i in range(lstop, total):
-                ctype = self.cards[i].ctype
-                # News cards don't get redistributed, and cards that we
-                # already adjusted don't get moved either
-                if (ctype == 'news') or (ctype == 'topics'):
-                    c_nodist[ctype].append(self.cards[i])
-                else:
-                    # Take all non-news cards out
-                    c_redist[ctype].append(self.cards[i])
-
-            # Erase this snippet of the cards array, so we can reconstruct
-            # it manually. Keep popping from the point where we snipped things
-            for i in range(lstop, total):
-                self.cards.pop(lstop)
-
-            # Now, add the news cards back
-            for j in range(0, len(c_nodist['news'])):
-                self.cards.insert(lstop + j, c_nodist['news'][j])
-
-            # Now, for each type of non-news card, figure out the starting point
-            # where cards can be inserted, follow the spacing rules, and redist
-            # them throughout the cards.
-            # TODO: lowest card-count ctype inserts happen first, so there is better
-            # spacing for higher-card-count types
-            for ctype in sorted(c_redist, key=lambda ctype: len(c_redist[ctype])):
-                if c_redist[ctype] == []:
-                    continue   # Empty
-                # Are we doing cardtype filtering, and this isn't an included card type?
-                if app_state.exclude_cardtype(ctype) is True:
-                    continue
+            # Spacing rules from the last page, and the configured card
+            # spacing for each card type in this application
+            rules = [LayoutRule(ctype=ctype,
+                                spacing=spacing,
+                                distance=getattr(app_state, ctype).distance,
+                                exclude=app_state.exclude_cardtype(ctype))
+                     for ctype, spacing in app_state.config.items("card_spacing")]
+
+            # Let jumps be non-deterministic
+            layout = CardLayout(rules, first_page=(lstop == 0), rng=self.state.jitter)
+            self.cards.extend(layout.distribute(new_cards))
+
 
-                # Max distance between cards of this type on a page
-                norm_dist = getattr(app_state, ctype).spacing
-                # Number of input cards we're working with
-                # (should never be more than getattr(self.state, ctype).count
-                card_count = len(c_redist[ctype])
-                # For spacing purposes, page starts at the earliest page we can
-                # put a card on this page, w/o being too close to a same-type
-                # card on the previous page. This shortens the effective page dist
-                effective_pdist = p_dist - c_dist[ctype]
-                max_dist = effective_pdist
-                if card_count >= 1:
-                    max_dist = floor(effective_pdist / card_count)
-
-                # If less cards on the page then expected, degrade
-                if max_dist < norm_dist:
-                    max_dist = norm_dist
-                    norm_dist = max_dist - 1
-
-                # Let jumps be non-deterministic
-                seed()
-
-                # Start with an initial shorter distance for shuffling.
-                # The furthest initial insert spot isn't the "first space", but
-                # the maximum insert distance before spacing rules are not possible
-                # to properly follow.
-                start_jrange = c_dist[ctype]
-                cur_p_dist = len(self.cards) - lstop
-                next_cnt = 1
-                cards_ahead = card_count - next_cnt
-                end_jrange = cur_p_dist - (cards_ahead * norm_dist)
-                # syslog.syslog("*** dist initial: ctype:%s  cnt:%d  spacing:%d cur_pd:%d  sj:%d  ej:%d" % ( ctype, len(c_redist[ctype]), norm_dist, cur_p_dist, start_jrange, end_jrange))
-                # Add back the cards. NOTE all jumpranges must be offsets from lstop,
-                # not specific indexes that refer to the insert points in the array
-                for k in range(0, card_count):
-                    # Not many items in the array?
-                    if start_jrange >= end_jrange:
-                        jump = start_jrange
-                    else:
-                        jump = randint(start_jrange, end_jrange)
-
-                    ins_index = lstop + jump
-
-                    card = c_redist[ctype][k]
-                    self.cards.insert(ins_index, card)
-                    # syslog.syslog("k:%d  ins_index:%d  jump:%d  cur_pd:%d  sj:%d  ej:%d" % ( k, ins_index, jump, cur_p_dist, start_jrange, end_jrange))
-                    # For next iteration, spacing is at least space distance away from
-                    # the current insert, and no further than the distance by which
-                    # future spacing rules are not possible to follow.
-                    start_jrange = jump + norm_dist
-                    cur_p_dist = len(self.cards) - lstop
-                    next_cnt = next_cnt + 1
-                    cards_ahead = card_count - next_cnt
-                    end_jrange = cur_p_dist - (cards_ahead * norm_dist)
-
-            # Return seed to previous deterministic value, if it existed
-            if self.state.seed:
-                seed(self.state.seed)
-
-        # Lastly, add the topics cards back
-        for j in range(0, len(c_nodist['topics'])):
-            self.cards.insert(lstop + j, c_nodist['topics'][j])
-
-
-
-def create_page(page):
-    """Given a ConstantinaPage object, draw all the cards with content in
-    them, Each card type has unique things it must do to process
-    the data before it's drawn to screen.
 
-    If a state is provided, return JSON-formatted data ready for
-    insertion into the DOM. Otherwise, return the initial HTML.
-    This is done with decorators for each of the card functions
+def create_card(page, card):
+    """
+    Draw a single card from a ConstantinaPage. Each card type has unique
+    things it must do to process the data before it's drawn to screen.
     """
     output = ""
-    total = len(page.cards)
-    start_point = page.cur_len
-
-    for i in range(start_point, total):
-        if ((page.cards[i].ctype == "news") or
-            (page.cards[i].ctype == "topics") or
-            (page.cards[i].ctype == "features")):
-            # TODO: export_display_state is gone, replaced by theme state
-            output += create_medusa_textcard(page.cards[i], page.state.export_theme_state())
+    if ((card.ctype == "news") or
+        (card.ctype == "topics") or
+        (card.ctype == "features")):
+        # TODO: export_display_state is gone, replaced by theme state
+        output += create_medusa_textcard(card, page.state.export_theme_state())
 
-        if ((page.cards[i].ctype == "quotes") or
-            (page.cards[i].ctype == "heading")):
-            output += create_medusa_simplecard(page.cards[i], page.out_state, page.state.medusa)
+    if ((card.ctype == "quotes") or
+        (card.ctype == "heading")):
+        output += create_medusa_simplecard(card, page.out_state, page.state.medusa)
 
-        if (page.cards[i].ctype == "images"):
-            output += create_medusa_imagecard(page.cards[i])
+    if (card.ctype == "images"):
+        output += create_medusa_imagecard(card)
 
-        if (page.cards[i].ctype == "songs"):
-            output += create_medusa_songcard(page.cards[i])
+    if (card.ctype == "songs"):
+        output += create_medusa_songcard(card)
 
     return output
 
 
-def contents_page(start_response, state):
+def card_fragment(page, card, whole_page, as_json=False):
     """
-    Three types of states:
-    1) Normal page creation (randomized elements)
-    2) A permalink page (state variable has an x in it)
-        One news or feature, footer, link to the main page
-    3) Easter eggs
+    Draw a single card as a page Fragment. Cards that don't carry the
+    page's state are cached, along with their compressed form, until
+    their file changes. Cards added to an open page get the theme's
+    template values filled in, and cards in a whole page don't. Cards
+    for a JSON scroll page are drawn as JSON strings.
     """
-    substitute = '<!-- Contents go here -->'
+    key = None
+    if card.ctype != "heading":
+        try:
+            card_mtime = os.stat(page.context.private_path(card.cfile)).st_mtime
+            key = (card.ctype, card.cfile, card_mtime, card.permalink, card.search_result,
+                   page.state.export_theme_state(), page.context.theme.theme, whole_page,
+                   as_json, Derivatives.generation(page.context))
+        except OSError:
+            pass
+        fragment = Fragments.get(key) if key is not None else None
+        if fragment is not None:
+            return fragment
+
+    html = create_card(page, card)
+    if whole_page is False:
+        html = template_contents(html, page.context.theme)
+    if as_json is True:
+        html = json.dumps(html)
+    if key is None:
+        return Fragment(html)
+    fragment = Fragment(html, FragmentLevel)
+    Fragments.put(key, fragment)
+    return fragment
+
+
+def create_page(page, whole_page=True, as_json=False):
+    """Given a ConstantinaPage object, draw all the cards with content in
+    them, Each card type has unique things it must do to process
+    the data before it's drawn to screen.
 
-    # Read in headers from authentication if they exist
-    state.headers.append(('Content-Type', 'text/html'))
+    Returns a Fragment for each card, in page order.
+    """
+    cards = page.cards[page.cur_len:]
+    if as_json is True:
+        cards = scroll_cards(page)
+    # Cards are drawn at once on the card pool, and kept in page order
+    with page.context.timer.phase("render"):
+        return card_map(lambda card: card_fragment(page, card, whole_page, as_json), cards,
+                        serial=page.context.profiling)
+
+
+def scroll_marker(card):
+    """Is this card the scrollstone or the tombstone?"""
+    return card.ctype == 'heading' and card.num in ScrollMarkers
+
+
+def scroll_cards(page):
+    """
+    The cards sent in a JSON scroll page. The scrollstone and tombstone
+    markers are left out, since the client moves its own markers instead.
+    """
+    return [card for card in page.cards[page.cur_len:] if scroll_marker(card) is False]
+
+
+def next_state(page):
+    """The state of the page after this one, or None on the last page"""
+    for card in page.cards[page.cur_len:]:
+        if card.ctype == 'heading' and card.num == 'tombstone':
+            return page.out_state
+    return None
 
+
+def scroll_envelope(page):
+    """
+    The JSON around a scroll page's cards, as Fragments. The next state is
+    null on the last page, and scroll is how many of the cards come before
+    the place the client should move its scrollstone to.
+    """
+    scroll = None
+    sent = 0
+    for card in page.cards[page.cur_len:]:
+        if scroll_marker(card) is False:
+            sent += 1
+        elif card.num == 'scrollstone':
+            scroll = sent
+    head = '{"state": %s, "scroll": %s, "cards": [' % (json.dumps(next_state(page)), json.dumps(scroll))
+    return Fragment(head), ScrollTail
+
+
+def json_fragments(head, cards, tail):
+    """Card fragments, separated into a JSON array"""
+    fragments = [head]
+    for i, card in enumerate(cards):
+        if i > 0:
+            fragments.append(ScrollSeparator)
+        fragments.append(card)
+    fragments.append(tail)
+    return fragments
+
+
+def choose_page(state):
+    """
+    Decide what kind of page a state asks for. Returns the state to build
+    the page from, and whether the cards are wrapped in a full HTML page
+    from the theme, rather than returned bare for adding to a page that's
+    already open. An empty search replaces the state with a fresh one.
+    """
     # Fresh new HTML, no previous state provided
     if state.fresh_mode() is True:
-        page = ConstantinaPage(state)
-        base = open(GlobalTheme.theme + '/contents.html', 'r', encoding='utf-8')
-        html = base.read()
-        html = template_contents(html)
-        html = html.replace(substitute, create_page(page))
-        start_response('200 OK', state.headers)
+        return state, True
 
     # Permalink page of some kind
     elif state.permalink_mode() is True:
-        syslog.syslog("***** Permalink Mode *****")
-        page = ConstantinaPage(state)
-        base = open(GlobalTheme.theme + '/contents.html', 'r', encoding='utf-8')
-        html = base.read()
-        html = template_contents(html)
-        html = html.replace(substitute, create_page(page))
-        start_response('200 OK', state.headers)
+        log.debug("***** Permalink Mode *****")
+        return state, True
 
     # Empty search
     elif state.reshuffle_mode() is True:
-        syslog.syslog("***** Empty Search / Reshuffle Mode *****")
-        state = ConstantinaState(None)
-        page = ConstantinaPage(state)
-        base = open(GlobalTheme.theme + '/contents.html', 'r', encoding='utf-8')
-        html = base.read()
-        html = template_contents(html)
-        html = html.replace(substitute, create_page(page))
-        start_response('200 OK', state.headers)
+        log.debug("***** Empty Search / Reshuffle Mode *****")
+        fresh = ConstantinaState(None, state.context.env, state.context, state.jitter)
+        fresh.headers = state.headers
+        return fresh, True
 
     # Doing a search or a filter process
-    elif state.search_mode() is True and state.page == 0:
-        syslog.syslog("***** New Search Page Results *****")
-        page = ConstantinaPage(state)
-        base = open(GlobalTheme.theme + '/contents.html', 'r', encoding='utf-8')
-        html = base.read()
-        html = template_contents(html)
-        html = html.replace(substitute, create_page(page))
-        start_response('200 OK', state.headers)
+    elif added_page(state) is False:
+        log.debug("***** New Search Page Results *****")
+        return state, True
 
     # Otherwise, there is state, but no special headers.
     else:
-        page = ConstantinaPage(state)
-        html = create_page(page)
-        html = template_contents(html)
-        start_response('200 OK', state.headers)
+        return state, False
+
+
+def added_page(state):
+    """
+    Are this state's cards added to a page that's already open? Fresh
+    pages, permalinks, empty searches, and the first page of a search are
+    whole pages instead.
+    """
+    if (state.fresh_mode() is True or state.permalink_mode() is True or
+        state.reshuffle_mode() is True):
+        return False
+    return not (state.search_mode() is True and state.page == 0)
+
+
+def scroll_json(state):
+    """
+    Should this page be sent as JSON? Scroll pages are, when the client's
+    script asks for JSON. Either way, scroll pages vary by Accept.
+    """
+    if added_page(state) is False:
+        return False
+    state.headers.append(('Vary', 'Accept'))
+    return header_qualities(state.context.env.get('HTTP_ACCEPT')).get('application/json', 0) > 0
+
+
+def theme_template(state):
+    """Read the chosen theme's contents.html, templated for this request"""
+    path = state.context.public_path(state.context.theme.theme + '/contents.html')
+    with open(path, 'r', encoding='utf-8') as base:
+        return template_contents(base.read(), state.context.theme)
+
+
+def theme_segments(state):
+    """
+    The chosen theme's page, before and after the cards, as Fragments.
+    These are cached until the theme's contents.html changes.
+    """
+    path = state.context.public_path(state.context.theme.theme + '/contents.html')
+    key = ("theme", path, os.stat(path).st_mtime)
+    segments = Fragments.get(key)
+    if segments is None:
+        head, _, tail = theme_template(state).partition(Substitute)
+        segments = (Fragment(head, FragmentLevel), Fragment(tail, FragmentLevel))
+        Fragments.put(key, segments)
+    return segments
+
+
+def page_fragments(state, as_json=False):
+    """
+    Build and draw the page a state asks for, as a list of Fragments.
+    Returns the fragments, and the ConstantinaPage they were drawn from.
+    Only scroll pages are drawn as JSON.
+    """
+    state, whole_page = choose_page(state)
+    as_json = as_json and (whole_page is False)
+    page = ConstantinaPage(state)
+    fragments = create_page(page, whole_page, as_json)
+    if whole_page is True:
+        head, tail = theme_segments(state)
+        fragments = [head] + fragments + [tail]
+    elif as_json is True:
+        head, tail = scroll_envelope(page)
+        fragments = json_fragments(head, fragments, tail)
+    return fragments, page
+
+
+def speculated_fragments(state, as_json=False):
+    """
+    The fragments for the page a state asks for, taken from the pages drawn
+    ahead of time if this one was. Then queue the page after it to be drawn
+    ahead of time too. Whole pages are followed by the client's script
+    asking for the next page as JSON.
+    """
+    if Speculation.enabled is False:
+        fragments, page = page_fragments(state, as_json)
+        return fragments
+
+    generation = Generation.current()
+    variant = "json" if as_json is True else "html"
+    speculated = None
+    if added_page(state) is True:
+        speculated = Speculation.take((state.in_state, variant, generation))
+    if speculated is not None:
+        fragments, following = speculated
+    else:
+        fragments, page = page_fragments(state, as_json)
+        following = next_state(page)
+        if added_page(state) is False:
+            variant = "json"
+    if following is not None:
+        Speculation.schedule((following, variant, generation))
+    return fragments
+
 
-    # Load html contents into the page with javascript
-    return html
+def render_page(state):
+    """
+    Build and draw the page a state asks for. Returns the page's HTML, and
+    the ConstantinaPage it was drawn from.
+    """
+    fragments, page = page_fragments(state)
+    return "".join([fragment.text for fragment in fragments]), page
+
+
+def revalidate_page(state, variant=""):
+    """
+    If the page is fully determined by its state, add ETag and Last-Modified
+    headers for it. Returns True if the client's copy is still current.
+    Each variant of a page, like its JSON form, has ETags of its own.
+    """
+    validators = page_validators(state, variant)
+    if validators is None:
+        return False
+    state.headers.append(('Cache-Control', 'no-cache'))
+    state.headers.extend(validators.headers())
+    if validators.not_modified(state.context.env) is True:
+        Metrics.inc("constantina_not_modified_total")
+        return True
+    return False
+
+
+def add_server_timing(state):
+    """If phase timing is turned on, report the request's phases"""
+    server_timing = state.context.timer.finish()
+    if server_timing is not None:
+        state.headers.append(('Server-Timing', server_timing))
+
+
+def contents_page(start_response, state):
+    """
+    Three types of states:
+    1) Normal page creation (randomized elements)
+    2) A permalink page (state variable has an x in it)
+        One news or feature, footer, link to the main page
+    3) Easter eggs
+    """
+    # Read in headers from authentication if they exist
+    as_json = scroll_json(state)
+    state.headers.append(('Content-Type', 'application/json' if as_json is True else 'text/html'))
+    encoding = page_encoding(state)
+
+    # Permalinks and search results can be answered before any cards load
+    if revalidate_page(state, "json" if as_json is True else "") is True:
+        add_server_timing(state)
+        start_response('304 Not Modified', state.headers)
+        return b""
+
+    fragments = speculated_fragments(state, as_json)
+    add_server_timing(state)
+    if encoding != "identity":
+        state.headers.append(('Content-Encoding', encoding))
+    start_response('200 OK', state.headers)
+
+    # Cached cards are already compressed, and are just joined together
+    if encoding == "gzip":
+        return gzip_fragments(fragments)
+    return "".join([fragment.text for fragment in fragments]).encode('utf-8')
+
+
+def page_encoding(state):
+    """
+    Pick how a drawn page will be compressed. Pages are put together from
+    separately compressed fragments, which only works for gzip.
+    """
+    if CompressionEnabled is False:
+        return "identity"
+    state.headers.append(('Vary', 'Accept-Encoding'))
+    return choose_encoding(state.context.env, ["gzip"])
 
 
 def get_file(in_uri, start_response, state):
@@ -527,32 +696,161 @@ def get_file(in_uri, start_response, state):
     If there is a file we can return, do that instead of running any page
     generation stuff.
     """
-    data_root = GlobalConfig.get("paths", "data_root")
     in_uri = urldecode(in_uri)   # No url-encoded characters
-    # Use X-Sendfile/the private directory for files behind auth
-    static_file = "private" + in_uri
-    output_file = "/private" + in_uri
-    # syslog.syslog(static_file)
     headers = []   # Don't process any computed headers from state
 
-    os.chdir(data_root)
-    try:
-        # Return X-Sendfile/X-Accel-Redirect headers, along
-        # with Content-Size headers, to help your webserver
-        # fetch the file. 
-        # static_size = str(os.path.getsize(static_file))
-        http_response = '200 OK'
-        # headers.append(("Content-Size", static_size)) 
-        headers.append(("X-Sendfile", output_file))
-        headers.append(("X-Accel-Redirect", output_file))
-        headers.append(("Cache-Control", "max-age=31536000"))
-        start_response(http_response, headers)
-        return
-    except Exception:
-        # If no files available, return 404. This might be a lie
+    # Pictures may also be encoded as WebP or AVIF, for browsers that
+    # accept those. The choice depends on the Accept header.
+    formats = ImageFormats.lookup(state.context, in_uri)
+    if formats is not None and formats['types'] != {}:
+        headers.append(("Vary", "Accept"))
+        in_uri = choose_format(state.context.env, formats) or in_uri
+
+    # Use X-Sendfile/the private directory for files behind auth. Files
+    # may be sent by Constantina itself, so they must stay under it.
+    static_file = contained_path(state.context.private_root, in_uri)
+    output_file = "/private" + in_uri
+    # log.debug(static_file)
+
+    validators = None
+    if static_file is not None:
+        validators = file_validators(static_file)
+    if validators is None:
+        # If no files available, return 404
         http_response = '404 Not Found'
         start_response(http_response, headers)
-        return
+        return []
+
+    headers.append(("Cache-Control", "max-age=31536000"))
+    headers.extend(validators.headers())
+    if validators.not_modified(state.context.env) is True:
+        Metrics.inc("constantina_not_modified_total")
+        start_response('304 Not Modified', headers)
+        return []
+
+    # Without a front-end web server to hand the file to, send it ourselves
+    if GlobalConfig.getboolean("files", "accelerated", fallback=True) is False:
+        return send_file(state.context.env, start_response, static_file, headers, validators)
+
+    # Return X-Sendfile/X-Accel-Redirect headers, along
+    # with the file's type, to help your webserver
+    # fetch the file.
+    http_response = '200 OK'
+    headers.append(("Content-Type", file_type(static_file)))
+    headers.append(("X-Sendfile", output_file))
+    headers.append(("X-Accel-Redirect", output_file))
+    start_response(http_response, headers)
+    return []
+
+
+def render_fresh():
+    """Draw a fresh page for the pool, with its own seed and theme"""
+    context = RequestContext()
+    state = ConstantinaState(None, context.env, context)
+    html, page = render_page(state)
+    return encoded_page(html)
+
+
+def pooled_page(env, encodings):
+    """The headers and body for sending a pooled page, compressed ahead of time"""
+    headers = [('Content-Type', 'text/html')]
+    if CompressionEnabled is False:
+        return headers, encodings['identity']
+    encoding = choose_encoding(env, [coding for coding in ['br', 'gzip'] if coding in encodings])
+    headers.append(('Vary', 'Accept-Encoding'))
+    if encoding != "identity":
+        headers.append(('Content-Encoding', encoding))
+    return headers, encodings[encoding]
+
+
+# Visitors without a state get a page from this pool, if it's ready
+FreshPages = FreshPagePool(render_fresh, Generation.current)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=FreshPages.after_fork)
+
+
+
+def render_speculative(key):
+    """
+    Draw a scroll page ahead of time, along with the state of the page after
+    it. Gzipped pages are joined from deflated fragments, so deflate them now.
+    """
+    in_state, variant, generation = key
+    context = RequestContext({'QUERY_STRING': in_state, 'REQUEST_URI': '/?' + in_state})
+    state = ConstantinaState(in_state, context.env, context)
+    fragments, page = page_fragments(state, variant == "json")
+    if CompressionEnabled is True:
+        for fragment in fragments:
+            fragment.deflated()
+    return fragments, next_state(page)
+
+
+# Scroll pages that visitors will probably ask for next, drawn ahead of time
+Speculation = SpeculativePages(render_speculative)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=Speculation.after_fork)
+
+# Picks out requests to profile, if profiling is turned on
+Profiler = RequestProfiler()
+
+
+def metrics_page(env, start_response):
+    """
+    Every worker's counters and latencies as Prometheus text, along with
+    the card counts and search index generation. Only local scrapers
+    get an answer.
+    """
+    if Metrics.allowed(env) is False:
+        start_response('404 Not Found', [])
+        return []
+
+    from constantina.medusa.search import index_generation
+    context = RequestContext(env)
+    state = ConstantinaState(None, env, context)
+    gauges = []
+    for ctype in state.medusa.config.options("paths"):
+        try:
+            gauges.append(('constantina_cards', {'ctype': ctype}, len(opendir(state.medusa.config, ctype))))
+        except OSError:
+            pass   # No directory for this card type
+    gauges.append(('constantina_index_generation', {}, index_generation(state)))
+
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+    return [Metrics.exposition(gauges).encode('utf-8')]
+
+
+def count_request(state, in_uri, start):
+    """Count the request's latency under its page mode"""
+    if Metrics.enabled is True:
+        mode = "file" if in_uri is not None else request_mode(state)
+        Metrics.observe("constantina_request_seconds", {'mode': mode}, perf_counter() - start)
+
+
+def request_values(env):
+    """
+    Read the state and the URI out of a request environment. Either one
+    is None if it isn't something Constantina should act on.
+    """
+    in_state = env.get('QUERY_STRING')
+    in_uri = env.get('REQUEST_URI')
+
+    # Normalize the state and truncate if the query string is
+    # longer than 512 characters. 4096 characters is the upper limit
+    # for many browsers, but we don't trust browsers :)
+    if (in_state is not None) and (in_state != ''):
+        # Truncate state variable at 512 characters
+        in_state = in_state[0:512]
+    else:
+        in_state = None
+
+    # Normalize the inbound URI, for purpose of deciding whether to
+    # serve dynamic HTML or load a file.
+    if in_uri == '/' or in_uri[0] != '/' or in_uri[1] == '?':
+        in_uri = None
+    elif safe_path(urldecode(in_uri)) is False:
+        in_uri = "unsafe"
+
+    return in_state, in_uri
 
 
 def application(env, start_response, instance="default"):
@@ -572,47 +870,56 @@ def application(env, start_response, instance="default"):
     generate a special randomized page just for that link,
     with an introduction, footers, an image, and more...
     """
-    root_dir = GlobalConfig.get("paths", "data_root") + "/public"
-    os.chdir(root_dir)
-    in_state = env.get('QUERY_STRING')
-    in_uri = env.get('REQUEST_URI')
-    GlobalTime.update()   # Set timer value throughout the request
+    start = perf_counter()
+    if Metrics.wanted(env) is True:
+        return metrics_page(env, start_response)
+
+    # Paths and theme for this request. No global state is
+    # changed, so requests can be served concurrently.
+    context = RequestContext(env)
+    in_state, in_uri = request_values(env)
+
+    # Fresh pages are usually already drawn, ready to be handed out. A CGI
+    # process answers one request, so it never starts drawing a pool.
+    if in_state is None and in_uri is None and env.get('wsgi.run_once') is not True:
+        fresh_page = FreshPages.take()
+        if fresh_page is not None:
+            headers, body = pooled_page(env, fresh_page)
+            start_response('200 OK', headers)
+            Metrics.observe("constantina_request_seconds", {'mode': 'fresh_mode'}, perf_counter() - start)
+            return [body]
+
+    # Slow pages can be profiled in production, if it's turned on
+    with Speculation.serving():
+        if in_uri is None and Profiler.wanted(env, in_state) is True:
+            body, state = Profiler.profile(context, lambda: respond(env, start_response, context, in_state, in_uri))
+        else:
+            body, state = respond(env, start_response, context, in_state, in_uri)
+    count_request(state, in_uri, start)
+    return body
 
-    # Normalize the state and truncate if the query string is
-    # longer than 512 characters. 4096 characters is the upper limit
-    # for many browsers, but we don't trust browsers :)
-    if (in_state is not None) and (in_state != ''):
-        # Truncate state variable at 512 characters
-        in_state = in_state[0:512]
-    else:
-        in_state = None
 
+def respond(env, start_response, context, in_state, in_uri):
+    """
+    Serve a page or a file for the application, and return the response
+    body along with the request's state.
+    """
     # Create a state object, and determine what authentication data
     # has been made available on this page load. Since we don't make
     # an authentication object if auth is unnecessary, track the
     # authentication mode straight from the config.
-    state = ConstantinaState(in_state, env)
-
-    # Normalize the inbound URI, for purpose of deciding whether to
-    # serve dynamic HTML or load a file.
-    if in_uri == '/' or in_uri[0] != '/' or in_uri[1] == '?':
-        in_uri = None
-    elif safe_path(in_uri) is False:
-        in_uri = "unsafe"
+    with context.timer.phase("state"):
+        state = ConstantinaState(in_state, env, context)
 
     # based on configured mode and in_uri, do a thing.
-    html = ""
-
     if in_state is None and in_uri is not None:
         # How to characterize application GETs from file GETs?
         #   file gets have no state.
         #   file gets are not for /
-        return get_file(in_uri, start_response, state)
+        return get_file(in_uri, start_response, state), state
     else:
         # Load basic blog contents.
-        html = contents_page(start_response, state)
-
-    return [html.encode('utf8')]
+        return [contents_page(start_response, state)], state
 
 
 
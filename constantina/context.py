@@ -0,0 +1,36 @@
+import os
+
+from constantina.shared import GlobalConfig
+from constantina.themes import ConstantinaTheme
+from constantina.timing import PhaseTimer
+
+
+class RequestContext:
+    """
+    Constantina Request Context.
+
+    Everything a single request needs that used to be process-global: the
+    absolute data roots, the theme chosen for this page, and the request's
+    phase timer. The context is made once in application(), and carried
+    through the state, the page, the cards and the renderers. Nothing in a request changes the working directory, so
+    several requests can be served at once in one process.
+
+    Cached directory listings (BaseFiles) are still shared by the whole
+    process, since they don't change between requests.
+    """
+    def __init__(self, env=None):
+        self.env = env or {}
+        self.data_root = os.path.abspath(GlobalConfig.get("paths", "data_root"))
+        self.public_root = self.data_root + "/public"
+        self.private_root = self.data_root + "/private"
+        self.theme = ConstantinaTheme() # Chosen during state import
+        self.timer = PhaseTimer()       # Off unless [timing] enabled
+        self.profiling = False          # Draw cards in one thread if profiled
+
+    def public_path(self, path):
+        """Absolute path to a file under the public directory"""
+        return self.public_root + "/" + path.lstrip("/")
+
+    def private_path(self, path):
+        """Absolute path to a file under the private directory"""
+        return self.private_root + "/" + path.lstrip("/")
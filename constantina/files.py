@@ -0,0 +1,99 @@
+from functools import lru_cache
+import mimetypes
+import os
+import re
+
+from constantina.shared import GlobalConfig
+
+# A single byte range. Several ranges in one request get the whole file.
+RangePattern = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Read files this many bytes at a time, when there's no file_wrapper
+BlockSize = GlobalConfig.getint("files", "block_size", fallback=65536)
+
+
+@lru_cache(maxsize=256)
+def file_type(path):
+    """The Content-Type for a file, from its extension"""
+    ctype, encoding = mimetypes.guess_type(path)
+    if ctype is None:
+        return 'application/octet-stream'
+    return ctype
+
+
+def byte_range(header, size):
+    """
+    The (start, end) bytes asked for by a Range header, inclusive. Returns
+    None to send the whole file, and False if the range can't be served.
+    """
+    if header is None:
+        return None
+    match = RangePattern.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.group(1), match.group(2)
+    if first == '' and last == '':
+        return None
+    if first == '':
+        # The last N bytes of the file
+        if int(last) == 0:
+            return False
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    end = size - 1 if last == '' else min(int(last), size - 1)
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def read_blocks(path, start, length):
+    """Stream length bytes of a file, starting at start"""
+    with open(path, 'rb') as sfile:
+        sfile.seek(start)
+        while length > 0:
+            block = sfile.read(min(BlockSize, length))
+            if block == b'':
+                return
+            length -= len(block)
+            yield block
+
+
+def send_file(env, start_response, static_file, headers, validators):
+    """
+    Send a file's contents as the response, or just the part a Range
+    header asks for. Whole files go through the server's file_wrapper,
+    which uwsgi backs with sendfile(). The headers already hold the
+    file's validators, and If-None-Match has already been checked.
+    """
+    size = os.path.getsize(static_file)
+    headers.append(("Content-Type", file_type(static_file)))
+    headers.append(("Accept-Ranges", "bytes"))
+    head = env.get('REQUEST_METHOD', 'GET') == 'HEAD'
+
+    wanted = None
+    if (env.get('REQUEST_METHOD', 'GET') in ['GET', 'HEAD'] and
+        validators.range_current(env) is True):
+        wanted = byte_range(env.get('HTTP_RANGE'), size)
+
+    if wanted is False:
+        headers.append(("Content-Range", "bytes */%d" % size))
+        start_response('416 Range Not Satisfiable', headers)
+        return []
+
+    if wanted is not None:
+        start, end = wanted
+        headers.append(("Content-Range", "bytes %d-%d/%d" % (start, end, size)))
+        headers.append(("Content-Length", str(end - start + 1)))
+        start_response('206 Partial Content', headers)
+        if head is True:
+            return []
+        return read_blocks(static_file, start, end - start + 1)
+
+    headers.append(("Content-Length", str(size)))
+    start_response('200 OK', headers)
+    if head is True:
+        return []
+    file_wrapper = env.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        return file_wrapper(open(static_file, 'rb'), BlockSize)
+    return read_blocks(static_file, 0, size)
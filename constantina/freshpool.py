@@ -0,0 +1,103 @@
+from threading import Event, Lock, Thread
+import time
+import logging
+
+from constantina.metrics import Metrics
+from constantina.shared import GlobalConfig
+
+log = logging.getLogger('constantina.freshpool')
+
+
+class FreshPagePool:
+    """
+    Constantina Fresh Page Pool.
+
+    Visitors without a state get a fresh page with a new random seed, and
+    that's the most common request. Rather than building each one, keep a
+    pool of fully-drawn fresh pages, each with its own seed and its own
+    next-page state, and hand them out in turn.
+
+    A background thread draws the pool the first time a page is asked for,
+    and draws a whole new pool every refresh_seconds, or sooner if the
+    cards or themes change. Until the first pool is ready, take() returns
+    None and the page is drawn for the visitor as usual. The thread starts
+    on first use, so each forked app server process draws its own pool.
+    """
+    def __init__(self, render, generation):
+        self.render = render            # Draws one fresh page's HTML
+        self.generation = generation    # Summary of card and theme mtimes
+        self.size = GlobalConfig.getint("fresh_pool", "pages", fallback=8)
+        self.refresh = GlobalConfig.getint("fresh_pool", "refresh_seconds", fallback=300)
+        self.check = GlobalConfig.getint("fresh_pool", "check_seconds", fallback=30)
+
+        self.pages = []
+        self.next_page = 0
+        self.drawn_at = 0
+        self.drawn_generation = None
+        self.lock = Lock()
+        self.thread = None
+        self.stopped = Event()
+
+    def take(self):
+        """The next page from the pool, or None if there's no pool yet"""
+        if self.size <= 0:
+            return None
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.__maintain, name="constantina-freshpool", daemon=True)
+                self.thread.start()
+            if self.pages == []:
+                Metrics.inc("constantina_cache_misses_total", {'cache': 'fresh_pool'})
+                return None
+            Metrics.inc("constantina_cache_hits_total", {'cache': 'fresh_pool'})
+            page = self.pages[self.next_page % len(self.pages)]
+            self.next_page = self.next_page + 1
+            return page
+
+    def stop(self):
+        """Stop redrawing the pool"""
+        self.stopped.set()
+
+    def warm(self):
+        """
+        Draw the pool now, in this thread, without starting the redrawing
+        thread. A preforking server does this before it forks, so every
+        worker starts with a full pool.
+        """
+        if self.size <= 0:
+            return
+        self.drawn_generation = self.generation()
+        self.__fill()
+        self.drawn_at = time.time()
+
+    def after_fork(self):
+        """
+        A forked worker keeps the pages drawn before the fork, but not the
+        thread that redraws them. It starts its own on first use.
+        """
+        self.lock = Lock()
+        self.thread = None
+        self.stopped = Event()
+
+    def __fill(self):
+        """Draw a whole new pool, and swap it in for the old one"""
+        pages = [self.render() for i in range(0, self.size)]
+        with self.lock:
+            self.pages = pages
+            self.next_page = 0
+
+    def __maintain(self):
+        """Redraw the pool on a timer, or when the content changes"""
+        while self.stopped.is_set() is False:
+            try:
+                generation = self.generation()
+                if ((generation != self.drawn_generation) or
+                    (time.time() - self.drawn_at >= self.refresh)):
+                    self.__fill()
+                    self.drawn_at = time.time()
+                    self.drawn_generation = generation
+                    log.info("fresh pool: drew %d pages", self.size)
+            except Exception as error:
+                # Keep serving the old pool, and try again later
+                log.error("fresh pool: failed to draw pages: %s", error)
+            self.stopped.wait(self.check)
@@ -0,0 +1,164 @@
+from math import floor
+import random
+
+
+# News cards hold their reverse-time order, and are the run of cards that
+# all other card types get distributed through. Topic cards always lead
+# the new cards, since they're exact-match search results.
+FixedTypes = ['news']
+LeadingTypes = ['topics']
+
+
+class LayoutRule:
+    """
+    Spacing rules for a single card type, as applied to one page of cards.
+        - spacing is the configured [card_spacing] for this card type
+        - distance is how far the last card of this type on the previous
+          page was from the end of that page, or None if there was none
+        - exclude is whether a card filter is hiding this card type
+    """
+    def __init__(self, ctype, spacing, distance=None, exclude=False):
+        self.ctype = ctype
+        self.spacing = int(spacing)
+        self.distance = distance
+        self.exclude = exclude
+
+
+class CardLayout:
+    """
+    Constantina Card Layout.
+
+    Given one page's worth of newly-loaded cards, decide the order they
+    appear in. News cards keep their order, and every other card type is
+    spread across the news cards according to its spacing rules, with a
+    little random jitter so that each page load looks fresh.
+
+    Card types are placed one at a time, fewest cards first, so that card
+    types with more cards get the better spacing. Rather than inserting each
+    card into a list, the insert positions for every card type are computed
+    from the card counts alone. Then the cards are written into a slot array
+    in one sweep per card type, starting with the last-placed card type,
+    whose positions are final.
+    """
+    def __init__(self, rules, first_page=False, rng=random):
+        self.rules = rules            # LayoutRules, in config order
+        self.first_page = first_page  # No cards shown before this page
+        self.rng = rng                # Anything that supports randint
+
+    def start_offset(self, rule):
+        """
+        How far into the new page the first card of this type can go,
+        without being too close to a same-type card on the previous page.
+        """
+        distance = rule.distance
+        if distance is None:
+            distance = 0
+        distance = int(distance)
+
+        if distance >= rule.spacing:   # Prev page ctype card not close
+            return 0
+        elif self.first_page is True and distance == 0:   # No pages yet
+            return 0
+        else:   # Implement spacing from the beginning of the new page
+            return rule.spacing - distance
+
+    def positions(self, rule, card_count, page_length, run_length):
+        """
+        Choose insert positions for card_count cards of one type, into a
+        run of run_length cards. The positions returned are indexes into the
+        run after all of these cards have been inserted, and always increase.
+        page_length is the count of all new cards on the page, which is how
+        the spacing between same-type cards is chosen.
+        """
+        start_jrange = self.start_offset(rule)
+
+        # Max distance between cards of this type on a page. For spacing
+        # purposes, the page starts at the earliest spot we can put a card
+        # on this page. This shortens the effective page distance.
+        norm_dist = rule.spacing
+        effective_pdist = page_length - start_jrange
+        max_dist = floor(effective_pdist / card_count)
+
+        # If less cards on the page then expected, degrade
+        if max_dist < norm_dist:
+            max_dist = norm_dist
+            norm_dist = max_dist - 1
+
+        # Two cards can't share a position, so the next insert is at least
+        # one past the previous one, even if the spacing rules degraded.
+        step = max(norm_dist, 1)
+
+        output = []
+        for k in range(0, card_count):
+            # The furthest insert spot is the last one that still lets the
+            # cards after this one follow the spacing rules.
+            cards_ahead = card_count - k - 1
+            end_jrange = run_length - (cards_ahead * norm_dist)
+            if start_jrange >= end_jrange:
+                jump = start_jrange
+            else:
+                jump = self.rng.randint(start_jrange, end_jrange)
+            # Inserting past the end of the run just adds to the end
+            output.append(min(jump, run_length))
+            start_jrange = jump + step
+            run_length = run_length + 1
+        return output
+
+    def distribute(self, cards):
+        """
+        Return the given cards in page order. Cards of an excluded type are
+        left out, as are card types with no layout rule.
+        """
+        fixed = []
+        leading = []
+        spread = {}
+        for rule in self.rules:
+            spread[rule.ctype] = []
+
+        for card in cards:
+            if card.ctype in FixedTypes:
+                fixed.append(card)
+            elif card.ctype in LeadingTypes:
+                leading.append(card)
+            elif card.ctype in spread:
+                spread[card.ctype].append(card)
+
+        # Lowest card-count ctype inserts happen first, so there is better
+        # spacing for higher-card-count types
+        order = [rule for rule in sorted(self.rules, key=lambda rule: len(spread[rule.ctype]))
+                 if spread[rule.ctype] != [] and rule.exclude is False]
+
+        # Work out where each card type would be inserted into the run
+        # of cards, as the run grows from just the fixed cards
+        placements = []
+        run_length = len(fixed)
+        for rule in order:
+            card_count = len(spread[rule.ctype])
+            placements.append((rule.ctype, self.positions(rule, card_count, len(cards), run_length)))
+            run_length = run_length + card_count
+
+        # The last card type placed sits at its final positions. Each earlier
+        # card type's positions count only the slots still free, since the
+        # later card types were inserted around them.
+        slots = [None] * run_length
+        for ctype, positions in reversed(placements):
+            free = 0
+            next_card = 0
+            for i in range(0, run_length):
+                if next_card == len(positions):
+                    break
+                if slots[i] is not None:
+                    continue
+                if free == positions[next_card]:
+                    slots[i] = spread[ctype][next_card]
+                    next_card = next_card + 1
+                free = free + 1
+
+        # News cards fill in the remaining slots, in their original order
+        next_card = 0
+        for i in range(0, run_length):
+            if slots[i] is None:
+                slots[i] = fixed[next_card]
+                next_card = next_card + 1
+
+        return leading + slots
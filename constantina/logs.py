@@ -0,0 +1,147 @@
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+from queue import Full, Queue
+import syslog
+
+from constantina.metrics import Metrics
+
+# Python logging levels, and the syslog priorities they're sent with
+Priorities = {
+    logging.DEBUG: syslog.LOG_DEBUG,
+    logging.INFO: syslog.LOG_INFO,
+    logging.WARNING: syslog.LOG_WARNING,
+    logging.ERROR: syslog.LOG_ERR,
+    logging.CRITICAL: syslog.LOG_CRIT,
+}
+
+# The listener that writes queued log records to syslog, once configured
+Listener = None
+
+
+class SyslogHandler(logging.Handler):
+    """
+    Write log records with the syslog module, the way Constantina always
+    has. This only ever runs on the listener thread, so the syscall never
+    holds up a request.
+    """
+    def emit(self, record):
+        try:
+            priority = Priorities.get(record.levelno, syslog.LOG_INFO)
+            syslog.syslog(priority, self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Put log records on a bounded queue without waiting. If the syslog
+    writer falls behind, records are dropped and counted, rather than
+    making requests wait. Once there's room again, a warning says how
+    many were dropped.
+    """
+    def __init__(self, log_queue):
+        QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+        self.reported = 0
+
+    def enqueue(self, record):
+        try:
+            if self.dropped > self.reported:
+                self.queue.put_nowait(self.dropped_record())
+                self.reported = self.dropped
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+            Metrics.inc("constantina_log_records_dropped_total")
+
+    def dropped_record(self):
+        """A warning about the records dropped since the last one"""
+        return logging.LogRecord('constantina.logs', logging.WARNING, __file__, 0,
+                                 "logs: dropped %d records, the syslog writer fell behind",
+                                 (self.dropped - self.reported,), None)
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keep only one of every rate debug records. Records at info and above
+    always pass, so that sampling only thins out request tracing.
+    """
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = max(rate, 1)
+        self.seen = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate == 1:
+            return True
+        self.seen += 1
+        return self.seen % self.rate == 0
+
+
+def restart_listener():
+    """
+    Threads don't survive a fork, and the queue's locks might have been
+    held by the parent's listener. Give a forked process a fresh queue
+    and a listener of its own, writing to the same handlers.
+    """
+    global Listener
+    if Listener is None:
+        return
+    handler = [h for h in logging.getLogger('constantina').handlers
+               if isinstance(h, DroppingQueueHandler)][0]
+    log_queue = Queue(maxsize=handler.queue.maxsize)
+    handler.queue = log_queue
+    handler.dropped = 0
+    handler.reported = 0
+    Listener = QueueListener(log_queue, *Listener.handlers)
+    Listener.start()
+
+
+def stop_listener():
+    """Write out any queued records before the process exits"""
+    global Listener
+    if Listener is not None:
+        Listener.stop()
+        Listener = None
+
+
+def configure_logging(config):
+    """
+    Set up Constantina's loggers from the [logging] and [log_levels]
+    sections of constantina.ini. Every logger under "constantina" writes
+    through a bounded queue to a listener thread, which sends the records
+    to syslog. Levels are checked before any message is formatted, so
+    debug tracing costs almost nothing when it's off.
+    """
+    global Listener
+    if Listener is not None:
+        return
+
+    syslog.openlog(ident='constantina')
+    root = logging.getLogger('constantina')
+    root.setLevel(config.get("logging", "level", fallback="info").upper())
+    root.propagate = False
+
+    # Categories can be turned up or down on their own, i.e.
+    #   constantina.medusa.search = debug
+    if config.has_section("log_levels"):
+        for category, level in config.items("log_levels"):
+            logging.getLogger(category).setLevel(level.upper())
+
+    log_queue = Queue(maxsize=config.getint("logging", "queue_size", fallback=10000))
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SampleFilter(config.getint("logging", "sample_debug", fallback=1)))
+    root.addHandler(queue_handler)
+
+    syslog_handler = SyslogHandler()
+    syslog_handler.setFormatter(logging.Formatter("%(name)s: %(message)s"))
+    Listener = QueueListener(log_queue, syslog_handler)
+    Listener.start()
+    atexit.register(stop_listener)
+
+    # App server workers that fork after loading Constantina need a
+    # listener of their own
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=restart_listener)
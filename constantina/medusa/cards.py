@@ -1,19 +1,18 @@
 from math import floor
-from random import random, randint, seed, shuffle
-from mutagen.mp3 import MP3
 from defusedxml.ElementTree import fromstring, tostring
-from xml.sax.saxutils import unescape
-from PIL import Image
+from xml.etree.ElementTree import Element
 from datetime import datetime
 import os
-import magic
 from urllib.parse import unquote_plus
-import syslog
+import logging
 import configparser
 
-from constantina.shared import GlobalConfig, BaseFiles, BaseCardType, BaseState, count_ptags, opendir, unroll_newlines, escape_amp
+from constantina.medusa.derivatives import Derivatives, DerivativeSizes, image_srcset
+from constantina.medusa.ingest import parse_blocks, parsed_card
+from constantina.metrics import Metrics
+from constantina.shared import GlobalConfig, BaseFiles, BaseCardType, BaseState, count_ptags, opendir, unroll_newlines, escape_amp, unescape_tags
 
-syslog.openlog(ident='constantina.medusa.cards')
+log = logging.getLogger('constantina.medusa.cards')
 
 
 class MedusaCard:
@@ -24,8 +23,9 @@ class MedusaCard:
     link. We track whether the image or link may be duplicated within
     the card, as well as what its page index and type are.
     """
-    def __init__(self, ctype, num, state, grab_body=True, permalink=False, search_result=False):
+    def __init__(self, ctype, num, state, grab_body=True, permalink=False, search_result=False, rng=None):
         self.config = state.config
+        self.context = state.context
 
         self.title = self.config.get("card_defaults", "title")
         self.topics = []
@@ -35,6 +35,11 @@ class MedusaCard:
         self.num = num
         # If we need to access data from the state object, for card shuffling
         self.state = state
+        # Hidden cards are chosen with this. Cards loaded at the same time
+        # each get their own, so the choice doesn't depend on load order
+        if rng is None:
+            rng = state.rng
+        self.rng = rng
         self.songs = []
         self.cfile = self.config.get("card_defaults", "file")
         self.cdate = self.config.get("card_defaults", "date")
@@ -77,10 +82,9 @@ class MedusaCard:
             if which_file == 'x':
                 self.hidden = True
                 type_files = opendir(self.config, self.ctype, self.hidden)
-                # syslog.syslog(str(BaseFiles.keys()))
-                hidden_cards = range(0, len(BaseFiles[self.ctype + "/hidden"]))
-                self.num = hidden_cards[randint(0, len(hidden_cards)-1)]
-                # syslog.syslog("open hidden file: " + str(self.num) + "/" + str(hidden_cards))
+                hidden_cards = range(0, len(type_files))
+                self.num = hidden_cards[self.rng.randint(0, len(hidden_cards)-1)]
+                # log.debug("open hidden file: " + str(self.num) + "/" + str(hidden_cards))
                 which_file = self.num
             else:
                 pass
@@ -99,7 +103,7 @@ class MedusaCard:
             else:
                 chosen_file = which_file
         except (ValueError, IndexError):
-            syslog.syslog("Card \"" + str(self.num) + "\" (" + self.ctype + ") is not a filename or an Nth file.")
+            log.warning('Card "%s" (%s) is not a filename or an Nth file.', self.num, self.ctype)
 
         return self.__interpretfile(chosen_file)
 
@@ -107,8 +111,7 @@ class MedusaCard:
     def __songfiles(self):
         """Create an array of song objects for this card"""
         for songpath in self.body.splitlines():
-            card_root = GlobalConfig.get("paths", "data_root") + "/private"
-            songpath = card_root + "/" + self.config.get("paths", "songs") + "/" + songpath
+            songpath = self.context.private_path(self.config.get("paths", "songs") + "/" + songpath)
             self.songs.append(MedusaSong(songpath))
 
 
@@ -124,10 +127,11 @@ class MedusaCard:
         Prove these heuristics with a Python file-type check. Anything
         that doesn't pass muster returns "wrongtype".
         """
+        # libmagic is loaded on the first card, not when Constantina starts
+        import magic
         magi = magic.Magic(mime=True)
 
-        card_root = GlobalConfig.get("paths", "data_root") + "/private"
-        base_path = card_root + "/" + self.config.get("paths", self.ctype)
+        base_path = self.context.private_path(self.config.get("paths", self.ctype))
         fpath = base_path + "/" + thisfile
         if self.hidden is True:
             fpath = base_path + "/hidden/" + thisfile
@@ -182,6 +186,7 @@ class MedusaCard:
 
         except IOError:        # File got moved in between dirlist caching and us reading it
             self.topics = []   # Makes the card go away if we had an error reading content
+            Metrics.inc("constantina_card_load_failures_total", {'ctype': self.ctype})
             return self.config.get("card_defaults", "file")
 
         if self.hidden is True:
@@ -202,6 +207,8 @@ class MedusaSong:
     def __init__(self, filename):
         self.songfile = filename
         self.songtitle = filename.split("/")[-1].replace(".mp3", "")
+        # Only pages with songs on them need mutagen
+        from mutagen.mp3 import MP3
         audio = MP3(filename)
         time = audio.info.length
         minutes = time // 60
@@ -276,32 +283,49 @@ def create_medusa_textcard(card, display_state):
     output += """   </div>\n"""
 
     passed = {}
-    body_lines = card.body.splitlines()
-    processed_lines = unroll_newlines(body_lines)
-    first_line = processed_lines[0]
 
-    # Count all the <p> tags. If there's less than three paragraphs, don't do the
-    # "Read More" logic for that item.
-    ptags = count_ptags(processed_lines)
-    for line in processed_lines:
+    # Cards checked by constantina_ingest.py are already split into blocks.
+    # Otherwise, parse them now. Count all the <p> tags. If there's less
+    # than three paragraphs, don't do the "Read More" logic for that item.
+    record = parsed_card(card.context, card.cfile)
+    if record is not None:
+        blocks = record['blocks']
+        ptags = record['paragraphs']
+    else:
+        processed_lines = unroll_newlines(card.body.splitlines())
+        blocks = parse_blocks(processed_lines)
+        ptags = count_ptags(processed_lines)
+
+    for block in blocks:
         # Parsing the whole page only works for full HTML pages
         # Pass tags we don't care about
-        if line.find('<img') != 0 and line.find('<p') != 0:
-            output += line + "\n"
+        if block['type'] == 'text':
+            output += block['html']
             continue
 
-        # syslog.syslog(line)
-        e = fromstring(escape_amp(line))
-        if e.tag == 'img':
-            if (line == first_line) and ('img' not in passed):
+        if block['type'] == 'img':
+            if 'line' in block:
+                e = fromstring(escape_amp(block['line']))
+            else:
+                e = Element('img', dict(block['attrib']))
+            # Smaller copies of the image, if any were made
+            derived = Derivatives.lookup(card.context, e.attrib.get('src'))
+            if (derived is not None) and (derived['variants'] != []) and ('srcset' not in e.attrib):
+                e.attrib['srcset'] = image_srcset(e.attrib['src'], derived)
+                e.attrib['sizes'] = DerivativeSizes
+
+            if (block['first'] is True) and ('img' not in passed):
                 # Check image size. If it's the first line in the body and
                 # it's relatively small, display with the first paragraph.
-                # Add the dot in front to let the URIs look absolute, but the
-                # Python directories be relative to the image folder in the
-                # private contents directory (not exposed when auth is used)
-                img = Image.open("../private" + e.attrib['src'])
-                if ((img.size[0] > 300) and
-                    (img.size[1] > 220) and
+                # The URIs look absolute, but are found under the private
+                # contents directory (not exposed when auth is used)
+                if derived is not None:
+                    size = (derived['width'], derived['height'])
+                else:
+                    from PIL import Image
+                    size = Image.open(card.context.private_path(e.attrib['src'])).size
+                if ((size[0] > 300) and
+                    (size[1] > 220) and
                     (card.permalink is False) and
                     (card.search_result is False) and
                     (ptags >= 3)):
@@ -321,13 +345,13 @@ def create_medusa_textcard(card, display_state):
                 pass
 
             # Track that we saw an img tag, and write the tag out
-            output += unescape(tostring(e, encoding="unicode"))
+            output += unescape_tags(tostring(e, encoding="unicode"))
             passed.update({'img': True})
 
-        elif e.tag == 'p':
+        elif block['type'] == 'p':
             # If further than the first paragraph, write output
             if 'p' in passed:
-                output += unescape(tostring(e, encoding="unicode"))
+                output += block['html']
 
             # If more than three paragraphs, and it's a news entry,
             # start hiding extra paragraphs from view
@@ -337,20 +361,15 @@ def create_medusa_textcard(card, display_state):
                 # First <p> is OK, but follow it with a (Read More) link, and a
                 # div with showExtend that hides all the other elements
                 read_more = """ <a href="#%s" class="showShort" onclick="revealToggle('%s');">(Read&nbsp;More...)</a>""" % (anchor, anchor)
-                prep = unescape(tostring(e, encoding="unicode"))
-                output += prep.replace('</p>', read_more + '</p>')
+                output += block['html'].replace('</p>', read_more + '</p>')
                 output += """<div class="divExpand">\n"""
 
             else:
-                output += unescape(tostring(e, encoding="unicode"))
+                output += block['html']
 
             # Track that we saw an img tag, and write the tag out
             passed.update({'p': True})
 
-        else:
-            # pass all other tags unmodified
-            output += line + "\n"
-
     # End loop. now close the showExtend div if we
     # added it earlier during tag processing
     if ((ptags >= 3) and
@@ -388,7 +407,12 @@ def create_medusa_imagecard(card):
     uripath = "/" + "/".join(card.cfile.split('/')[0:])
 
     output = """<div class="card image" id="%s">\n""" % anchor
-    output += """   <img src="%s" />\n""" % uripath
+    derived = Derivatives.lookup(card.context, uripath)
+    if (derived is not None) and (derived['variants'] != []):
+        output += """   <img src="%s" srcset="%s" sizes="%s" />\n""" % (
+            uripath, image_srcset(uripath, derived), DerivativeSizes)
+    else:
+        output += """   <img src="%s" />\n""" % uripath
     output += """</div>\n"""
     return output
 
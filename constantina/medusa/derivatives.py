@@ -0,0 +1,412 @@
+import json
+import os
+import re
+from threading import Lock
+import logging
+
+from constantina.context import RequestContext
+from constantina.shared import GlobalConfig, header_qualities, opendir
+from constantina.state import ConstantinaState
+
+# PIL is imported by the functions that make images. Requests only read the
+# manifests, and never need it.
+log = logging.getLogger('constantina.medusa.derivatives')
+
+# Inline images in news and feature cards. Only local paths get derivatives.
+InlineImage = re.compile(r'''<img\b[^>]*?\bsrc=["'](/[^/"'][^"']*)["']''')
+
+# Derivatives keep their source's format. Other formats (like animated
+# GIFs) are left alone.
+CopyFormats = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG'}
+
+DerivativesEnabled = GlobalConfig.getboolean("derivatives", "enabled", fallback=False)
+DerivativeDirectory = GlobalConfig.get("derivatives", "directory", fallback="derived")
+DerivativeWidths = [int(width) for width in
+                    GlobalConfig.get("derivatives", "widths", fallback="320, 640, 960, 1440").split(',')]
+DerivativeQuality = GlobalConfig.getint("derivatives", "quality", fallback=82)
+DerivativeSizes = GlobalConfig.get("derivatives", "sizes", fallback="(min-width: 630px) 57vw, 90vw")
+
+# Modern formats each image is also encoded in, and the Content-Type,
+# PIL format, and save options for each of them
+ModernFormats = {
+    'webp': ('image/webp', 'WEBP', {'quality': GlobalConfig.getint("derivatives", "webp_quality", fallback=80),
+                                   'method': 6}),
+    'avif': ('image/avif', 'AVIF', {'quality': GlobalConfig.getint("derivatives", "avif_quality", fallback=60)}),
+}
+EncodedFormats = [name.strip() for name in
+                  GlobalConfig.get("derivatives", "formats", fallback="webp, avif").split(',')
+                  if name.strip() in ModernFormats]
+
+
+class DerivativeJob:
+    """
+    One source image to make derivatives of, in a worker process. The
+    source's entry in the last manifest tells the worker whether the
+    derivatives it made then are still current.
+    """
+    def __init__(self, src, previous=None):
+        self.src = src              # URI path of the source, i.e. /images/a.jpg
+        self.previous = previous    # From the last run's manifest
+
+
+class ImageDerivatives:
+    """
+    Constantina Image Derivatives.
+
+    Make smaller copies of picture cards, and of images inline in news
+    and feature cards, so that phones don't download the originals. Each
+    source gets a copy at every configured width narrower than itself,
+    with its EXIF orientation applied. Copies are written under the
+    private directory, so they're served like any other card file:
+        <directory>/<source path>/<name>-<width>.<ext>
+        <directory>/manifest.json    what was made from which source
+
+    A source's derivatives are only made again when its mtime changes, and
+    derivatives of sources that are gone get removed.
+
+    Every source and every copy can also be encoded in modern formats, like
+    WebP and AVIF, for the file trampoline to send to browsers that accept
+    them. Encoded files are only kept when they're smaller:
+        <directory>/<source path>/<name>.<ext>.<format>
+        <directory>/formats.json     every file's encoded sizes
+    """
+    def __init__(self, workers=None):
+        self.context = RequestContext()
+        self.root = self.context.private_path(DerivativeDirectory)
+        self.manifest_path = manifest_path(self.context)
+        if workers is None:
+            workers = GlobalConfig.getint("derivatives", "workers", fallback=4)
+        self.workers = workers
+        self.manifest = read_manifest(self.manifest_path)
+        self.formats_path = manifest_path(self.context, "formats.json")
+        self.formats = read_manifest(self.formats_path)
+
+    def sources(self):
+        """URI paths of every picture card, and every image inside a card"""
+        config = ConstantinaState(None, {}, self.context).medusa.config
+        sources = set()
+        for filename in opendir(config, 'images'):
+            sources.add("/" + config.get("paths", "images") + "/" + filename)
+        for ctype in ['news', 'features']:
+            base_path = self.context.private_path(config.get("paths", ctype))
+            for filename in opendir(config, ctype):
+                try:
+                    with open(base_path + "/" + filename, 'r', encoding='utf-8') as cfile:
+                        sources.update(InlineImage.findall(cfile.read()))
+                except (OSError, UnicodeDecodeError) as error:
+                    log.warning("derivatives: couldn't read %s/%s: %s", ctype, filename, error)
+        return sorted([src for src in sources if os.path.splitext(src)[1].lower() in CopyFormats])
+
+    def generate(self, force=False):
+        """
+        Make derivatives of every source on a pool of processes, and return
+        how many sources were processed, and how many were already current.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        jobs = [DerivativeJob(src, None if force is True else self.manifest.get(src))
+                for src in self.sources()]
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(make_derivatives, jobs, chunksize=8))
+
+        made = 0
+        current = {}
+        for job, (entry, was_made) in zip(jobs, results):
+            if entry is None:
+                continue
+            current[job.src] = entry
+            if was_made is True:
+                made += 1
+
+        # Remove derivatives of sources that changed size or are gone
+        kept = set([path for entry in current.values() for width, path in entry['variants']])
+        for entry in self.manifest.values():
+            for width, path in entry['variants']:
+                if path not in kept:
+                    try:
+                        os.remove(self.context.private_path(path))
+                    except OSError:
+                        pass
+
+        self.manifest = current
+        write_manifest(self.manifest_path, current)
+        log.info("derivatives: made %d of %d sources", made, len(jobs))
+        return made, len(jobs) - made
+
+    def encode(self, force=False):
+        """
+        Encode every source and every copy in the modern formats, on a pool
+        of processes, and return how many files were encoded, and how many
+        were already current.
+        """
+        files = set(self.sources())
+        for entry in self.manifest.values():
+            files.update([path for width, path in entry['variants']])
+        from concurrent.futures import ProcessPoolExecutor
+        jobs = [DerivativeJob(src, None if force is True else self.formats.get(src))
+                for src in sorted(files)]
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(encode_formats, jobs, chunksize=8))
+
+        encoded = 0
+        current = {}
+        for job, (entry, was_encoded) in zip(jobs, results):
+            if entry is None:
+                continue
+            current[job.src] = entry
+            if was_encoded is True:
+                encoded += 1
+
+        # Remove encoded files that aren't smaller anymore, or are of files
+        # that are gone
+        kept = set([path for entry in current.values() for path, size in entry['types'].values()])
+        for entry in self.formats.values():
+            for path, size in entry['types'].values():
+                if path not in kept:
+                    try:
+                        os.remove(self.context.private_path(path))
+                    except OSError:
+                        pass
+
+        self.formats = current
+        write_manifest(self.formats_path, current)
+        log.info("derivatives: encoded %d of %d files", encoded, len(jobs))
+        return encoded, len(jobs) - encoded
+
+    def report(self, report=print):
+        """Each file's size in every modern format, and the total savings"""
+        names = [name for name in ModernFormats if name in EncodedFormats]
+        report("%-48s %10s" % ("file", "original") +
+               "".join([" %10s %6s" % (name, "saved") for name in names]))
+        totals = {name: 0 for name in names}
+        original_total = 0
+        for src in sorted(self.formats.keys()):
+            entry = self.formats[src]
+            original_total += entry['bytes']
+            line = "%-48s %10d" % (src[-48:], entry['bytes'])
+            for name in names:
+                size = entry['encoded'].get(name)
+                if size is None:
+                    line += " %10s %6s" % ("-", "-")
+                    totals[name] += entry['bytes']
+                    continue
+                line += " %10d %5.1f%%" % (size, 100.0 * (entry['bytes'] - size) / max(entry['bytes'], 1))
+                # Files that aren't smaller are sent as they are
+                totals[name] += min(size, entry['bytes'])
+            report(line)
+        line = "%-48s %10d" % ("total (%d files)" % len(self.formats), original_total)
+        for name in names:
+            line += " %10d %5.1f%%" % (totals[name], 100.0 * (original_total - totals[name]) / max(original_total, 1))
+        report(line)
+
+
+def manifest_path(context, filename="manifest.json"):
+    """Where a derivative manifest is kept"""
+    return context.private_path(DerivativeDirectory + "/" + filename)
+
+
+def read_manifest(path):
+    """Every source's derivatives, from a manifest file"""
+    try:
+        with open(path, 'r', encoding='utf-8') as mfile:
+            return json.load(mfile)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(path, manifest):
+    """Save a manifest, so that no request reads it half-written"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", 'w', encoding='utf-8') as mfile:
+        json.dump(manifest, mfile, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def derivative_path(src, width):
+    """The URI path of a source's derivative at a width"""
+    name, ext = os.path.splitext(src)
+    return "/" + DerivativeDirectory + name + "-" + str(width) + ext.lower()
+
+
+def make_derivatives(job):
+    """
+    Make one source's derivatives in a worker process. Returns its
+    manifest entry, or None if it can't be read, and whether anything
+    had to be made.
+    """
+    from PIL import Image, ImageOps
+    context = RequestContext()
+    source = context.private_path(job.src)
+    try:
+        source_mtime = os.path.getmtime(source)
+    except OSError:
+        log.warning("derivatives: %s is missing", job.src)
+        return None, False
+
+    previous = job.previous
+    if ((previous is not None) and (previous['mtime'] == source_mtime) and
+        all([os.path.isfile(context.private_path(path)) for width, path in previous['variants']])):
+        return previous, False
+
+    try:
+        with Image.open(source) as original:
+            image = ImageOps.exif_transpose(original)
+            image_format = CopyFormats[os.path.splitext(job.src)[1].lower()]
+            # Palette images are resized in full color, then given a
+            # palette again, or their copies would be larger than they are
+            palette = image_format != 'JPEG' and image.mode == 'P'
+            if image_format == 'JPEG' and image.mode not in ['RGB', 'L']:
+                image = image.convert('RGB')
+            elif image.mode == 'P':
+                image = image.convert('RGBA')
+            source_size = os.path.getsize(source)
+
+            variants = []
+            for width in sorted(set(DerivativeWidths)):
+                if width >= image.size[0]:
+                    break
+                height = max(round(image.size[1] * width / image.size[0]), 1)
+                path = derivative_path(job.src, width)
+                target = context.private_path(path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                resized = image.resize((width, height), Image.LANCZOS)
+                if palette is True:
+                    resized = resized.quantize(256, method=Image.FASTOCTREE)
+                if image_format == 'JPEG':
+                    resized.save(target + ".tmp", image_format, quality=DerivativeQuality,
+                                 optimize=True, progressive=True)
+                else:
+                    resized.save(target + ".tmp", image_format, optimize=True)
+                if os.path.getsize(target + ".tmp") >= source_size:
+                    # Not worth sending. The original is smaller.
+                    os.remove(target + ".tmp")
+                    continue
+                os.replace(target + ".tmp", target)
+                variants.append([width, path])
+            entry = {'mtime': source_mtime, 'width': image.size[0],
+                     'height': image.size[1], 'variants': variants}
+    except (OSError, ValueError) as error:
+        log.warning("derivatives: couldn't make derivatives of %s: %s", job.src, error)
+        return None, False
+    return entry, True
+
+
+def encoded_path(src, name):
+    """The URI path of a file encoded in a modern format"""
+    if src.startswith("/" + DerivativeDirectory + "/"):
+        return src + "." + name
+    return "/" + DerivativeDirectory + src + "." + name
+
+
+def encode_formats(job):
+    """
+    Encode one file in every modern format, in a worker process. Returns
+    its formats entry, or None if it can't be read, and whether anything
+    had to be encoded.
+    """
+    from PIL import Image, ImageOps
+    context = RequestContext()
+    source = context.private_path(job.src)
+    try:
+        stat = os.stat(source)
+    except OSError:
+        log.warning("derivatives: %s is missing", job.src)
+        return None, False
+
+    previous = job.previous
+    if ((previous is not None) and (previous['mtime'] == stat.st_mtime) and
+        (sorted(previous['encoded'].keys()) == sorted(available_formats())) and
+        all([os.path.isfile(context.private_path(path)) for path, size in previous['types'].values()])):
+        return previous, False
+
+    entry = {'mtime': stat.st_mtime, 'bytes': stat.st_size, 'encoded': {}, 'types': {}}
+    try:
+        with Image.open(source) as original:
+            image = ImageOps.exif_transpose(original)
+            if image.mode not in ['RGB', 'RGBA', 'L', 'LA']:
+                image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+            for name in available_formats():
+                content_type, image_format, options = ModernFormats[name]
+                path = encoded_path(job.src, name)
+                target = context.private_path(path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                image.save(target + ".tmp", image_format, **options)
+                size = os.path.getsize(target + ".tmp")
+                entry['encoded'][name] = size
+                if size < stat.st_size:
+                    os.replace(target + ".tmp", target)
+                    entry['types'][content_type] = [path, size]
+                else:
+                    # Not worth sending. The original is smaller.
+                    os.remove(target + ".tmp")
+    except (OSError, ValueError) as error:
+        log.warning("derivatives: couldn't encode %s: %s", job.src, error)
+        return None, False
+    return entry, True
+
+
+def available_formats():
+    """The configured modern formats that this PIL can write"""
+    from PIL import Image
+    Image.init()
+    return [name for name in EncodedFormats if ModernFormats[name][1] in Image.SAVE]
+
+
+class DerivativeManifest:
+    """
+    A derivative manifest, as seen by the card renderers and the file
+    trampoline. It's read again whenever the manifest file changes.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.mtime = None
+        self.sources = {}
+        self.lock = Lock()
+
+    def generation(self, context):
+        """The manifest's mtime, reading it again if it changed"""
+        if DerivativesEnabled is False:
+            return 0
+        path = manifest_path(context, self.filename)
+        try:
+            current = os.path.getmtime(path)
+        except OSError:
+            current = 0
+        if current != self.mtime:
+            with self.lock:
+                if current != self.mtime:
+                    self.sources = read_manifest(path)
+                    self.mtime = current
+        return current
+
+    def lookup(self, context, src):
+        """A source's manifest entry, or None if it has no derivatives"""
+        if DerivativesEnabled is False:
+            return None
+        self.generation(context)
+        return self.sources.get(src)
+
+
+# The manifests for every request in this process
+Derivatives = DerivativeManifest("manifest.json")
+ImageFormats = DerivativeManifest("formats.json")
+
+
+def image_srcset(src, entry):
+    """A srcset for an image, from its derivatives and the original"""
+    candidates = ["%s %dw" % (path, width) for width, path in entry['variants']]
+    candidates.append("%s %dw" % (src, entry['width']))
+    return ", ".join(candidates)
+
+
+def choose_format(env, entry):
+    """
+    The smallest encoded version of a file that the client's Accept header
+    names, or None to send the file as it is. Wildcards don't count, since
+    browsers that can't show WebP or AVIF still accept image/*.
+    """
+    accepted = header_qualities(env.get('HTTP_ACCEPT'))
+    candidates = [(size, path) for content_type, (path, size) in entry['types'].items()
+                  if accepted.get(content_type, 0) > 0]
+    if candidates == []:
+        return None
+    return min(candidates)[1]
@@ -0,0 +1,244 @@
+import json
+import os
+import logging
+
+from defusedxml import DefusedXmlException
+from defusedxml.ElementTree import ParseError, fromstring, tostring
+
+from constantina.context import RequestContext
+from constantina.metrics import Metrics
+from constantina.shared import GlobalConfig, count_ptags, escape_amp, opendir, unescape_tags, unroll_newlines
+from constantina.state import ConstantinaState
+
+log = logging.getLogger('constantina.medusa.ingest')
+
+# Card types drawn by create_medusa_textcard
+TextTypes = ['news', 'features', 'topics']
+
+IngestEnabled = GlobalConfig.getboolean("ingest", "enabled", fallback=False)
+IngestDirectory = GlobalConfig.get("ingest", "directory", fallback="parsed")
+
+# Parsed cards from an older layout are parsed again when drawn
+IngestVersion = 1
+
+# The card body starts on the third line of the file, after the title and topics
+BodyLine = 3
+
+
+class CardError:
+    """A line of a text card that couldn't be parsed"""
+    def __init__(self, cfile, line, message):
+        self.cfile = cfile
+        self.line = line
+        self.message = message
+
+    def __str__(self):
+        return "%s:%d: %s" % (self.cfile, self.line, self.message)
+
+
+class CardIngest:
+    """
+    Constantina Card Ingest.
+
+    News, feature and topic cards are HTML fragments, parsed a line at a
+    time while they're drawn. A malformed line only shows up then, as an
+    error for every visitor the card is drawn for. Ingesting checks every
+    text card ahead of time, with the same rules the renderer uses, and
+    reports each bad line by file and line number.
+
+    Cards that parse cleanly are saved, already split into blocks, under
+    the private directory:
+        <directory>/<card path>.json
+
+    The renderer draws from the saved blocks instead of parsing the card
+    again, as long as the card's mtime still matches. Cards with errors
+    aren't saved, and saved cards whose source is gone get removed.
+    """
+    def __init__(self):
+        self.context = RequestContext()
+        self.root = self.context.private_path(IngestDirectory)
+        self.config = ConstantinaState(None, {}, self.context).medusa.config
+
+    def sources(self):
+        """The card path of every text card, hidden cards included"""
+        sources = []
+        for ctype in TextTypes:
+            for hidden in [False, True]:
+                directory = self.config.get("paths", ctype) + ("/hidden" if hidden is True else "")
+                try:
+                    sources.extend([directory + "/" + filename
+                                    for filename in opendir(self.config, ctype, hidden)])
+                except OSError:
+                    pass   # No directory for this card type
+        return sources
+
+    def ingest(self, force=False):
+        """
+        Check every text card, and save the ones that parse. Returns how
+        many cards were saved, how many were already current, and every
+        error that was found.
+        """
+        saved = 0
+        current = 0
+        errors = []
+        kept = set()
+        for cfile in self.sources():
+            source = self.context.private_path(cfile)
+            path = parsed_path(self.context, cfile)
+            try:
+                mtime = os.path.getmtime(source)
+                if force is False and read_parsed(path, mtime) is not None:
+                    kept.add(path)
+                    current += 1
+                    continue
+                record, card_errors = parse_card(cfile, source, mtime)
+            except (OSError, UnicodeDecodeError) as error:
+                errors.append(CardError(cfile, 0, str(error)))
+                continue
+            if card_errors != []:
+                errors.extend(card_errors)
+                continue
+            write_parsed(path, record)
+            kept.add(path)
+            saved += 1
+
+        # Remove saved cards whose source is gone, or no longer parses
+        for directory, subdirs, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = directory + "/" + filename
+                if filename.endswith(".json") and path not in kept:
+                    os.remove(path)
+
+        log.info("ingest: saved %d cards, %d errors", saved, len(errors))
+        return saved, current, errors
+
+
+def parsed_path(context, cfile):
+    """Where a card's parsed blocks are saved"""
+    return context.private_path(IngestDirectory + "/" + cfile + ".json")
+
+
+def read_parsed(path, mtime):
+    """A saved card, or None if it's missing or older than its source"""
+    try:
+        with open(path, 'r', encoding='utf-8') as pfile:
+            record = json.load(pfile)
+    except (OSError, ValueError):
+        return None
+    if record.get('version') != IngestVersion or record.get('mtime') != mtime:
+        return None
+    return record
+
+
+def write_parsed(path, record):
+    """Save a card's blocks, so that no request reads it half-written"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", 'w', encoding='utf-8') as pfile:
+        json.dump(record, pfile, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def line_numbers(body_lines, processed_lines):
+    """
+    The body line that each of unroll_newlines' processed lines started
+    on. Processed lines are the non-blank body lines, stripped, with a
+    space after each, and joined in order.
+    """
+    numbers = []
+    i = 0
+    for line in processed_lines:
+        while i < len(body_lines) and body_lines[i].strip() == '':
+            i += 1
+        numbers.append(i)
+        consumed = 0
+        while i < len(body_lines) and consumed < len(line):
+            if body_lines[i].strip() != '':
+                consumed += len(body_lines[i].strip()) + 1
+            i += 1
+    return numbers
+
+
+def parse_blocks(processed_lines, errors=None):
+    """
+    Split a text card's processed lines into blocks for the renderer. Only
+    lines that start with an img or a p tag are parsed, as they are when a
+    card is drawn:
+      text:  passed through as it is
+      img:   the tag's attributes in order, which the renderer adds to
+      p:     the paragraph, written back out
+    Without an errors list, parse errors are raised. With one, the index of
+    each line that fails and its error are added to it.
+    """
+    first_line = processed_lines[0]
+    blocks = []
+    for index, line in enumerate(processed_lines):
+        if line.find('<img') != 0 and line.find('<p') != 0:
+            blocks.append({'type': 'text', 'html': line + "\n"})
+            continue
+        try:
+            e = fromstring(escape_amp(line))
+        except (ParseError, DefusedXmlException) as error:
+            if errors is None:
+                raise
+            errors.append((index, str(error)))
+            continue
+        if e.tag == 'img':
+            block = {'type': 'img', 'attrib': list(e.attrib.items()), 'first': line == first_line}
+            if len(e) != 0 or e.text is not None:
+                # Images with contents are rare, and are parsed when drawn
+                block['line'] = line
+            blocks.append(block)
+        elif e.tag == 'p':
+            blocks.append({'type': 'p', 'html': unescape_tags(tostring(e, encoding="unicode"))})
+        else:
+            blocks.append({'type': 'text', 'html': line + "\n"})
+    return blocks
+
+
+def parse_card(cfile, source, mtime):
+    """
+    Read and parse a text card file the way MedusaCard and the renderer do.
+    Returns the card's record, and a CardError for each line that failed.
+    """
+    with open(source, 'r', encoding='utf-8') as card_file:
+        title = card_file.readline().replace("\n", "")
+        topics = card_file.readline().replace("\n", "").split(', ')
+        body = card_file.read()
+
+    body_lines = body.splitlines()
+    processed_lines = unroll_newlines(body_lines)
+    failures = []
+    blocks = parse_blocks(processed_lines, failures)
+    numbers = line_numbers(body_lines, processed_lines)
+    errors = [CardError(cfile, numbers[index] + BodyLine, message) for index, message in failures]
+
+    images = [dict(block['attrib']).get('src') for block in blocks if block['type'] == 'img']
+    record = {
+        'version': IngestVersion,
+        'mtime': mtime,
+        'title': title,
+        'topics': topics,
+        'paragraphs': count_ptags(processed_lines),
+        'first_image': images[0] if images != [] else None,
+        'blocks': blocks,
+    }
+    return record, errors
+
+
+def parsed_card(context, cfile):
+    """
+    A text card's saved blocks, or None if it hasn't been ingested since
+    it last changed, and must be parsed as it's drawn.
+    """
+    if IngestEnabled is False:
+        return None
+    try:
+        mtime = os.path.getmtime(context.private_path(cfile))
+    except OSError:
+        return None
+    record = read_parsed(parsed_path(context, cfile), mtime)
+    if record is None:
+        Metrics.inc("constantina_cache_misses_total", {'cache': 'parsed'})
+    else:
+        Metrics.inc("constantina_cache_hits_total", {'cache': 'parsed'})
+    return record
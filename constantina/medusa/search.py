@@ -7,12 +7,13 @@ from whooshjp.TinySegmenterTokenizer import TinySegmenterTokenizer
 import re
 from defusedxml.ElementTree import fromstring
 from xml.sax.saxutils import unescape
-import syslog
+import logging
 import configparser
 
+from constantina.metrics import Metrics
 from constantina.shared import GlobalConfig, BaseFiles, opendir, unroll_newlines, escape_amp
 
-syslog.openlog(ident='constantina.medusa.search')
+log = logging.getLogger('constantina.medusa.search')
 
 
 class MedusaSearch:
@@ -75,10 +76,10 @@ class MedusaSearch:
         self.filtered = state.filtered
 
         # File paths for loading things
-        card_root = GlobalConfig.get("paths", "data_root") + "/private"
-        self.index_dir = card_root + "/" + self.config.get('search', 'index_dir')
-        self.words_file = card_root + "/" + self.config.get('search', 'ignore_words')
-        self.symobls_file = card_root + "/" + self.config.get('search', 'ignore_symbols')
+        self.context = state.context
+        self.index_dir = self.context.private_path(self.config.get('search', 'index_dir'))
+        self.words_file = self.context.private_path(self.config.get('search', 'ignore_words'))
+        self.symobls_file = self.context.private_path(self.config.get('search', 'ignore_symbols'))
         self.search_types = self.config.get("card_properties", "search").replace(" ", "").split(",")
 
         unsafe_query_terms = state.medusa.search
@@ -96,10 +97,10 @@ class MedusaSearch:
         # If index doesn't exist, create it
         if index.exists_in(self.index_dir):
             self.index = index.open_dir(self.index_dir)
-            # syslog.syslog("Index exists")
+            # log.debug("Index exists")
         else:
             self.index = index.create_in(self.index_dir, schema=self.schema)
-            # syslog.syslog("Index not found -- creating one")
+            # log.debug("Index not found -- creating one")
         # Prepare for query searching (mtime update, search strings)
         self.searcher = self.index.searcher()
 
@@ -185,7 +186,7 @@ class MedusaSearch:
         # Index all words as lowercase, to make searching the blog cards simpler
         safe_input = safe_input.lower()
 
-        syslog.syslog("safe input query: " + safe_input)
+        log.debug("safe input query: %s", safe_input)
         # Did we sanitize a query, or a round of content? Infer by what
         # we're setting in the object itself.
         if safe_input != '':
@@ -210,8 +211,7 @@ class MedusaSearch:
         # Enable writing to our chosen index. To limit the index
         # locking, this is the only function that writes to the index.
         writer = self.index.writer()
-        card_root = GlobalConfig.get("paths", "data_root") + "/private"
-        card_path = card_root + "/" + self.config.get("paths", ctype)
+        card_path = self.context.private_path(self.config.get("paths", ctype))
 
         with open(card_path + "/" + filename, 'r', encoding='utf-8') as indexfh:
             body = ""
@@ -238,11 +238,10 @@ class MedusaSearch:
         """Take a file type, list all the files there, and add all the
         body contents to the index."""
         # Make sure BaseFiles is populated
-        opendir(self.config, ctype)
-        card_root = GlobalConfig.get("paths", "data_root") + "/private"
-        card_path = card_root + "/" + self.config.get("paths", ctype)
+        type_files = opendir(self.config, ctype)
+        card_path = self.context.private_path(self.config.get("paths", ctype))
 
-        for filename in BaseFiles[ctype]:
+        for filename in type_files:
             try:
                 fnmtime = int(os.path.getmtime(card_path + "/" + filename))
             except:
@@ -257,6 +256,7 @@ class MedusaSearch:
             # be accurate unless we reindex this file now
             if lastmtime < fnmtime:
                 self.__add_file_to_index(fnmtime, filename, ctype)
+                Metrics.inc("constantina_reindexed_documents_total", {'ctype': ctype})
 
 
     def __search_index(self):
@@ -303,3 +303,11 @@ class MedusaSearch:
                     self.hits[ctype].append(result['file'])
                 else:
                     self.filtered = self.filtered + 1
+
+
+def index_generation(state):
+    """The search index's generation, or -1 if there's no index yet"""
+    index_dir = state.context.private_path(state.medusa.config.get('search', 'index_dir'))
+    if index.exists_in(index_dir) is False:
+        return -1
+    return index.open_dir(index_dir).latest_generation()
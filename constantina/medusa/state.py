@@ -1,9 +1,11 @@
-import syslog
+from random import Random
+import logging
 import configparser
 
+from constantina.context import RequestContext
 from constantina.shared import GlobalConfig, BaseFiles, BaseCardType, BaseState, opendir
 
-syslog.openlog(ident='constantina.medusa.state')
+log = logging.getLogger('constantina.medusa.state')
 
 
 class MedusaState(BaseState):
@@ -20,15 +22,26 @@ class MedusaState(BaseState):
     It also provides a clean interface to global modes and settings that
     influence what content and appearances a Constantina page can take.
     """
-    def __init__(self, in_state=None):
+    def __init__(self, in_state=None, tokens=None, rng=None, context=None):
         # Open the config file, and set card type defaults per state variable
-        BaseState.__init__(self, in_state, 'medusa.ini')
+        BaseState.__init__(self, in_state, 'medusa.ini', tokens)
+        # Seeded random number generator and request context, shared with
+        # the aggregate state
+        if rng is None:
+            rng = Random()
+        self.rng = rng
+        if context is None:
+            context = RequestContext()
+        self.context = context
         # Process all state variables listed in medusa.ini
         self.__import_state()
 
-        # Now that we've imported, shuffle any card types we want to shuffle
-        for ctype in self.config.get("card_properties", "randomize").replace(" ", "").split(","):
-            getattr(self, ctype).shuffle()
+        # Now that we've imported, shuffle any card types we want to shuffle.
+        # Permalink pages show just one card, so they never need a shuffle
+        if self.permalink_mode() is False:
+            with self.context.timer.phase("shuffle"):
+                for ctype in self.config.get("card_properties", "randomize").replace(" ", "").split(","):
+                    getattr(self, ctype).shuffle(self.rng)
 
 
     def __import_card_state(self):
@@ -120,7 +133,7 @@ class MedusaState(BaseState):
                 hashtag_process = map(lambda x: "#" + x, filterterms)
                 [ newfilters, removeterms ] = BaseState._process_search_strings(self, '#', hashtag_process)
                 # Take off leading #-sigil for card type searches
-                self.card_filter = map(lambda x: x[1:], newfilters)
+                self.card_filter = list(map(lambda x: x[1:], newfilters))
                 # Record filters being set
                 for ctype in self.card_filter:
                     getattr(self, ctype).filtertype = True
@@ -254,6 +267,16 @@ class MedusaState(BaseState):
             return False
 
 
+    def permalink_mode(self):
+        """Is one of the news, feature, or topic permalinks set?"""
+        if ((self.news_permalink is not None) or
+            (self.features_permalink is not None) or
+            (self.topics_permalink is not None)):
+            return True
+        else:
+            return False
+
+
     def filter_processed_mode(self):
         """
         Is it a search state, and did we already convert #hashtag strings
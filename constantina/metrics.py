@@ -0,0 +1,244 @@
+import atexit
+import fcntl
+import json
+import os
+from threading import Lock
+from time import time
+import logging
+
+log = logging.getLogger('constantina.metrics')
+
+# Request latency histogram upper bounds, in seconds
+LatencyBuckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')]
+
+# Type and help text for every metric Constantina exposes
+Descriptions = {
+    'constantina_request_seconds': ('histogram', "Request latency, by page mode"),
+    'constantina_card_load_failures_total': ('counter', "Card files that couldn't be read, by card type"),
+    'constantina_reindexed_documents_total': ('counter', "Cards added to the search index, by card type"),
+    'constantina_cache_hits_total': ('counter', "Lookups answered from a cache, by cache"),
+    'constantina_cache_misses_total': ('counter', "Lookups that missed a cache, by cache"),
+    'constantina_not_modified_total': ('counter', "Requests answered with 304 Not Modified"),
+    'constantina_log_records_dropped_total': ('counter', "Log records dropped because the syslog writer fell behind"),
+    'constantina_cards': ('gauge', "Card files, by card type"),
+    'constantina_index_generation': ('gauge', "Search index generation"),
+}
+
+
+def metric_key(name, labels):
+    """A hashable key for a metric and its label values"""
+    return (name, tuple(sorted((labels or {}).items())))
+
+
+def label_text(labels, extra=()):
+    """Prometheus label text for a key's labels, i.e. {mode="fresh_mode"}"""
+    pairs = list(labels) + list(extra)
+    if pairs == []:
+        return ""
+    return "{" + ",".join(['%s="%s"' % (name, str(value).replace('"', '\\"'))
+                           for name, value in pairs]) + "}"
+
+
+class MetricsRegistry:
+    """
+    Constantina Metrics Registry.
+
+    Counters and latency histograms for this process, which are written
+    to a file of their own in the spool directory every flush_seconds.
+    App servers run several worker processes, so the metrics page adds
+    up every worker's file. When a worker exits, its counts are folded
+    into a retired file, so totals don't go backwards as workers are
+    recycled. Nothing is counted unless [metrics] is enabled.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def configure(self, config):
+        """Read the [metrics] settings from constantina.ini"""
+        self.enabled = config.getboolean("metrics", "enabled", fallback=False)
+        self.path = config.get("metrics", "path", fallback="/metrics")
+        self.allow = [address.strip() for address in
+                      config.get("metrics", "allow", fallback="127.0.0.1, ::1").split(',')]
+        self.spool = config.get("metrics", "spool", fallback="/var/tmp/constantina-metrics")
+        self.flush_seconds = config.getint("metrics", "flush_seconds", fallback=5)
+
+    def wanted(self, env):
+        """Is this a request for the metrics page?"""
+        if self.enabled is False:
+            return False
+        return env.get('REQUEST_URI', '').partition('?')[0] == self.path
+
+    def allowed(self, env):
+        """Metrics are only shown to the addresses in [metrics] allow"""
+        return env.get('REMOTE_ADDR') in self.allow
+
+    def reset(self):
+        """Start counting from zero, as a newly forked worker must"""
+        self.counters = {}     # Key -> count
+        self.histograms = {}   # Key -> count per bucket, plus the sum
+        self.flushed_at = 0
+        self.lock = Lock()
+
+    def inc(self, name, labels=None, amount=1):
+        """Add to a counter"""
+        if self.enabled is False:
+            return
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, seconds):
+        """Count a latency into a histogram"""
+        if self.enabled is False:
+            return
+        key = metric_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [0] * len(LatencyBuckets) + [0.0])
+            for i, bound in enumerate(LatencyBuckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-1] += seconds
+        if time() - self.flushed_at >= self.flush_seconds:
+            self.flush()
+
+    def dump(self):
+        """This process's metrics, in the form they're spooled in"""
+        with self.lock:
+            return spool_form({'counters': self.counters, 'histograms': self.histograms})
+
+    def flush(self):
+        """Write this process's metrics into its spool file"""
+        if self.enabled is False:
+            return
+        self.flushed_at = time()
+        try:
+            os.makedirs(self.spool, exist_ok=True)
+            path = "%s/%d.json" % (self.spool, os.getpid())
+            with open(path + ".tmp", 'w', encoding='utf-8') as sfile:
+                json.dump(self.dump(), sfile)
+            os.replace(path + ".tmp", path)
+        except OSError as error:
+            log.error("metrics: couldn't write to %s: %s", self.spool, error)
+
+    def collect(self):
+        """
+        Add up the spooled metrics of every worker, live or retired. Files
+        left by workers that have exited are folded into retired.json, with
+        the spool locked so two workers can't retire the same file. If the
+        spool can't be read, only this process's metrics are shown.
+        """
+        self.flush()
+        total = {'counters': {}, 'histograms': {}}
+        try:
+            with open(self.spool + "/lock", 'w') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                retired = read_spool(self.spool + "/retired.json")
+                retiring = False
+                for filename in os.listdir(self.spool):
+                    if not (filename.endswith(".json") and filename[:-5].isdigit()):
+                        continue
+                    spooled = read_spool(self.spool + "/" + filename)
+                    if process_alive(int(filename[:-5])) is True:
+                        add_metrics(total, spooled)
+                    else:
+                        add_metrics(retired, spooled)
+                        os.remove(self.spool + "/" + filename)
+                        retiring = True
+                if retiring is True:
+                    with open(self.spool + "/retired.json.tmp", 'w', encoding='utf-8') as rfile:
+                        json.dump(spool_form(retired), rfile)
+                    os.replace(self.spool + "/retired.json.tmp", self.spool + "/retired.json")
+        except OSError as error:
+            log.error("metrics: couldn't collect from %s: %s", self.spool, error)
+            with self.lock:
+                return {'counters': dict(self.counters),
+                        'histograms': {key: list(value) for key, value in self.histograms.items()}}
+        add_metrics(total, retired)
+        return total
+
+    def exposition(self, gauges):
+        """
+        Every worker's metrics, and the given (name, labels, value) gauges,
+        as Prometheus text.
+        """
+        total = self.collect()
+        samples = {}   # Metric name -> sample lines
+        for (name, labels), value in sorted(total['counters'].items()):
+            samples.setdefault(name, []).append("%s%s %s" % (name, label_text(labels), value))
+        for (name, labels), histogram in sorted(total['histograms'].items()):
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(LatencyBuckets, histogram):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append("%s_bucket%s %d" % (name, label_text(labels, [('le', le)]), cumulative))
+            lines.append("%s_sum%s %f" % (name, label_text(labels), histogram[-1]))
+            lines.append("%s_count%s %d" % (name, label_text(labels), cumulative))
+        for name, labels, value in gauges:
+            samples.setdefault(name, []).append("%s%s %s" % (name, label_text(sorted(labels.items())), value))
+
+        text = []
+        for name in sorted(samples.keys()):
+            kind, description = Descriptions.get(name, ('untyped', name))
+            text.append("# HELP %s %s" % (name, description))
+            text.append("# TYPE %s %s" % (name, kind))
+            text.extend(samples[name])
+        return "\n".join(text) + "\n"
+
+
+def spool_form(metrics):
+    """Keyed metrics as lists, the way they're written into spool files"""
+    return {
+        'counters': [[name, labels, value] for (name, labels), value in metrics['counters'].items()],
+        'histograms': [[name, labels, value] for (name, labels), value in metrics['histograms'].items()],
+    }
+
+
+def read_spool(path):
+    """One spooled metrics file, keyed for adding up"""
+    metrics = {'counters': {}, 'histograms': {}}
+    try:
+        with open(path, 'r', encoding='utf-8') as sfile:
+            add_metrics(metrics, json.load(sfile), spooled=True)
+    except (OSError, ValueError):
+        pass
+    return metrics
+
+
+def add_metrics(total, metrics, spooled=False):
+    """Add one set of metrics into a running total"""
+    counters = metrics['counters']
+    histograms = metrics['histograms']
+    if spooled is True:
+        counters = [(metric_key(name, dict(labels)), value) for name, labels, value in counters]
+        histograms = [(metric_key(name, dict(labels)), value) for name, labels, value in histograms]
+    else:
+        counters = counters.items()
+        histograms = histograms.items()
+    for key, value in counters:
+        total['counters'][key] = total['counters'].get(key, 0) + value
+    for key, value in histograms:
+        current = total['histograms'].setdefault(key, [0] * len(value))
+        total['histograms'][key] = [a + b for a, b in zip(current, value)]
+
+
+def process_alive(pid):
+    """Is this worker still running?"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Metrics for this process, configured when constantina.ini is read
+Metrics = MetricsRegistry()
+atexit.register(Metrics.flush)
+
+# Forked workers count for themselves, not with their parent's numbers
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=Metrics.reset)
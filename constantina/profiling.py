@@ -0,0 +1,136 @@
+import cProfile
+import hmac
+import json
+import os
+import random
+import re
+from threading import Lock
+from time import perf_counter, time
+import tracemalloc
+import logging
+
+from constantina.shared import GlobalConfig
+
+log = logging.getLogger('constantina.profiling')
+
+# Page modes, most specific first. A page that's none of these is a
+# scrolled page of the main feed.
+Modes = ["permalink_mode", "search_only_mode", "filter_only_mode", "search_mode",
+         "reshuffle_mode", "fresh_mode"]
+
+# Allocation sites kept from each tracemalloc profile
+TopAllocations = 25
+
+
+def request_mode(state):
+    """Name the kind of page a state asks for, like fresh_mode or search_mode"""
+    for mode in Modes:
+        if getattr(state, mode)() is True:
+            return mode
+    return "scroll_mode"
+
+
+class RequestProfiler:
+    """
+    Constantina Request Profiler.
+
+    Profile single requests in production, without profiling all of them.
+    A request is profiled if it's picked by the sample rate, if its state
+    matches the state_pattern, or if it was sent with an
+    X-Constantina-Profile header holding the configured secret. Profiling
+    is off unless it's turned on in [profiling].
+
+    Each profile is written into the spool directory as a pair of files:
+    <name>.prof holds cProfile stats, and <name>.json holds the state, the
+    page mode, how long the request took, and the top tracemalloc
+    allocation sites. Only one request per process is profiled at a time,
+    and the spool stops filling once it has max_files profiles in it.
+    """
+    def __init__(self):
+        self.enabled = GlobalConfig.getboolean("profiling", "enabled", fallback=False)
+        self.secret = GlobalConfig.get("profiling", "secret", fallback="")
+        self.sample = GlobalConfig.getfloat("profiling", "sample", fallback=0.0)
+        pattern = GlobalConfig.get("profiling", "state_pattern", fallback="")
+        self.pattern = re.compile(pattern) if pattern != "" else None
+        capture = GlobalConfig.get("profiling", "capture", fallback="cprofile")
+        self.cprofile = capture in ["cprofile", "both"]
+        self.tracemalloc = capture in ["tracemalloc", "both"]
+        self.spool = GlobalConfig.get("profiling", "spool", fallback="/var/tmp/constantina-profiles")
+        self.max_files = GlobalConfig.getint("profiling", "max_files", fallback=1000)
+
+        self.lock = Lock()    # cProfile and tracemalloc are one per process
+        self.profiled = 0
+
+    def wanted(self, env, in_state):
+        """Should this request be profiled?"""
+        if self.enabled is False:
+            return False
+        given = env.get('HTTP_X_CONSTANTINA_PROFILE')
+        if (self.secret != "") and (given is not None):
+            if hmac.compare_digest(given.encode('utf-8'), self.secret.encode('utf-8')):
+                return True
+        if (self.pattern is not None) and (self.pattern.search(in_state or "") is not None):
+            return True
+        return (self.sample > 0) and (random.random() < self.sample)
+
+    def profile(self, context, respond):
+        """
+        Run respond() under the profilers, and spool what they found.
+        respond() returns the response body and the request's state, and
+        so does this. If another request is already being profiled, this
+        one just runs.
+        """
+        if self.lock.acquire(blocking=False) is False:
+            return respond()
+        try:
+            # Card threads aren't seen by cProfile, so draw them here
+            context.profiling = True
+            profiler = cProfile.Profile() if self.cprofile is True else None
+            if self.tracemalloc is True:
+                tracemalloc.start()
+            start = perf_counter()
+            if profiler is not None:
+                profiler.enable()
+            try:
+                body, state = respond()
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                seconds = perf_counter() - start
+                allocations = []
+                if self.tracemalloc is True:
+                    snapshot = tracemalloc.take_snapshot()
+                    tracemalloc.stop()
+                    allocations = snapshot.statistics('lineno')[0:TopAllocations]
+            self.__spool(state, seconds, profiler, allocations)
+            return body, state
+        finally:
+            self.lock.release()
+
+    def __spool(self, state, seconds, profiler, allocations):
+        """Write a request's profile into the spool directory"""
+        try:
+            os.makedirs(self.spool, exist_ok=True)
+            if len(os.listdir(self.spool)) >= self.max_files * 2:
+                log.warning("profiling: spool %s is full", self.spool)
+                return
+
+            self.profiled += 1
+            name = "%d-%d-%d" % (time() * 1000, os.getpid(), self.profiled)
+            if profiler is not None:
+                profiler.dump_stats(self.spool + "/" + name + ".prof")
+            details = {
+                'state': state.in_state,
+                'mode': request_mode(state),
+                'seconds': seconds,
+                'phases': state.context.timer.phases,
+                'allocations': [[str(stat.traceback[0]), stat.size, stat.count]
+                                for stat in allocations],
+            }
+            temp_path = self.spool + "/" + name + ".json.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as jfile:
+                json.dump(details, jfile)
+            os.replace(temp_path, self.spool + "/" + name + ".json")
+            log.info("profiling: %s %s took %.1fms", details['mode'], state.in_state, seconds * 1000)
+        except (OSError, ValueError) as error:
+            log.error("profiling: couldn't write to %s: %s", self.spool, error)
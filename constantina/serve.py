@@ -0,0 +1,276 @@
+"""
+constantina-serve: run Constantina on a preforking HTTP server, for sites
+without uWSGI. Run it with the same INSTANCE environment variable as the
+other Constantina scripts.
+"""
+import argparse
+import importlib
+import os
+import signal
+import socket
+from socketserver import ThreadingMixIn
+import sys
+from threading import BoundedSemaphore, Thread
+import time
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+import logging
+
+from constantina.conditional import file_validators
+from constantina.context import RequestContext
+from constantina.files import send_file
+from constantina.shared import GlobalConfig, contained_path, safe_path, urldecode
+
+log = logging.getLogger('constantina.serve')
+
+# Libraries that requests otherwise load on first use. The master loads
+# them before forking, so that no worker has to.
+Preloaded = ["constantina.medusa.search", "magic", "mutagen.mp3", "PIL.Image"]
+
+
+def private_memory():
+    """
+    Bytes of memory this process doesn't share with the master. Forked
+    workers share the master's warmed caches until they write to them, so
+    only the private part grows. Outside of Linux, use the peak RSS.
+    """
+    try:
+        private = 0
+        with open("/proc/self/smaps_rollup", 'r') as smaps:
+            for line in smaps:
+                if line.startswith("Private_"):
+                    private += int(line.split()[1]) * 1024
+        return private
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class ConstantinaHandler(WSGIRequestHandler):
+    """
+    Requests, with the REQUEST_URI that Constantina reads, and logged to
+    syslog instead of stderr.
+    """
+    def get_environ(self):
+        env = WSGIRequestHandler.get_environ(self)
+        env['REQUEST_URI'] = self.path
+        return env
+
+    def log_message(self, format, *args):
+        log.debug("serve: %s " + format, self.address_string(), *args)
+
+
+class WorkerServer(ThreadingMixIn, WSGIServer):
+    """
+    One worker's HTTP server. Requests are answered on up to threads
+    threads at once, and each worker stops taking new connections once its
+    private memory grows past the ceiling. Requests already in flight are
+    finished first.
+    """
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, listener, threads, ceiling):
+        WSGIServer.__init__(self, listener.getsockname()[0:2], ConstantinaHandler, bind_and_activate=False)
+        self.socket = listener
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+        self.setup_environ()
+        self.slots = BoundedSemaphore(threads)
+        self.ceiling = ceiling
+        self.draining = False
+
+    def process_request(self, request, client_address):
+        # A busy worker stops accepting, and leaves connections to the others
+        self.slots.acquire()
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.slots.release()
+        if self.ceiling > 0 and self.draining is False and private_memory() > self.ceiling:
+            log.info("serve: worker %d is over %dMB, recycling", os.getpid(), self.ceiling // 1048576)
+            self.drain()
+
+    def drain(self):
+        """Stop taking connections, so the worker can exit"""
+        self.draining = True
+        Thread(target=self.shutdown, daemon=True).start()
+
+
+class PreforkServer:
+    """
+    Constantina Preforking Server.
+
+    The master loads the application and warms its caches: directory
+    listings, the card and theme fragment caches, and the fresh page pool.
+    Then it forks workers that start with all of that already in memory.
+    Each worker answers requests on a few threads, since most of a
+    request's time is spent in file reads and libraries that release the
+    GIL.
+
+    The master binds one socket that all the workers accept on. With
+    reuse_port, every worker binds its own listening socket with
+    SO_REUSEPORT instead, and the kernel spreads connections evenly across
+    them. Connections still queued on a worker's socket when it's recycled
+    are reset, though, so it's off by default.
+
+    Workers aren't recycled after a number of requests. A worker exits
+    once its private memory passes max_memory_mb, and the master forks a
+    replacement.
+    """
+    def __init__(self, address=None, port=None, workers=None):
+        self.address = address or GlobalConfig.get("serve", "address", fallback="127.0.0.1")
+        self.port = port or GlobalConfig.getint("serve", "port", fallback=9090)
+        if workers is None:
+            workers = GlobalConfig.getint("serve", "workers", fallback=0)
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.threads = GlobalConfig.getint("serve", "threads", fallback=4)
+        self.ceiling = GlobalConfig.getint("serve", "max_memory_mb", fallback=256) * 1048576
+        self.reuse_port = (GlobalConfig.getboolean("serve", "reuse_port", fallback=False) and
+                           hasattr(socket, "SO_REUSEPORT"))
+        self.standalone = GlobalConfig.getboolean("serve", "standalone", fallback=False)
+
+        self.children = {}    # Worker pid -> worker number
+        self.listener = None
+        self.stopping = False
+        self.application = None
+
+    def listen(self):
+        """A listening socket for this server's address and port"""
+        family = socket.AF_INET6 if ':' in self.address else socket.AF_INET
+        listener = socket.socket(family, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port is True:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind((self.address, self.port))
+        listener.listen(128)
+        return listener
+
+    def load(self):
+        """Load the application, and fill its caches before forking"""
+        from constantina import constantina
+        application = constantina.application
+        if self.standalone is True:
+            # No web server in front to send files for us
+            if GlobalConfig.has_section("files") is False:
+                GlobalConfig.add_section("files")
+            GlobalConfig.set("files", "accelerated", "no")
+            application = PublicFiles(application)
+        self.application = application
+
+        if GlobalConfig.getboolean("serve", "warm", fallback=True) is False:
+            return
+        start = time.perf_counter()
+        for module in Preloaded:
+            importlib.import_module(module)
+        # Directory listings, fragments and theme segments, and the pool
+        constantina.render_fresh()
+        constantina.FreshPages.warm()
+        log.info("serve: warmed caches in %.1fs", time.perf_counter() - start)
+
+    def spawn(self, number):
+        """Fork one worker"""
+        pid = os.fork()
+        if pid != 0:
+            self.children[pid] = number
+            return
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            listener = self.listener if self.reuse_port is False else self.listen()
+            server = WorkerServer(listener, self.threads, self.ceiling)
+            server.set_app(self.application)
+            signal.signal(signal.SIGTERM, lambda signum, frame: server.drain())
+            server.serve_forever()
+            server.server_close()
+        except Exception as error:
+            log.error("serve: worker %d failed: %s", os.getpid(), error)
+            status = 1
+        finally:
+            os._exit(status)
+
+    def stop(self, signum, frame):
+        """Ask every worker to finish its requests and exit"""
+        self.stopping = True
+        for pid in list(self.children.keys()):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        """Start the workers, and replace any that exit until stopped"""
+        # The master's socket is bound before loading, so a port that's in
+        # use fails quickly. With reuse_port it's only held as a check.
+        self.listener = self.listen()
+        self.load()
+        if self.reuse_port is True:
+            self.listener.close()
+            self.listener = None
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for number in range(0, self.workers):
+            self.spawn(number)
+        log.info("serve: %d workers on %s:%d", self.workers, self.address, self.port)
+
+        while self.children != {}:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            number = self.children.pop(pid, None)
+            if number is not None and self.stopping is False:
+                self.spawn(number)
+        log.info("serve: stopped")
+
+
+class PublicFiles:
+    """
+    Send files under the public directory, like themes and scripts, for
+    servers that have nothing in front of them to do it. Everything else
+    goes to the application.
+    """
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, env, start_response):
+        path = urldecode(env.get('REQUEST_URI', '/').partition('?')[0])
+        if path != '/' and safe_path(path) is True:
+            # Only files that are really under the public directory
+            public_file = contained_path(RequestContext(env).public_root, path)
+            validators = file_validators(public_file) if public_file is not None else None
+            if validators is not None:
+                headers = validators.headers()
+                if validators.not_modified(env) is True:
+                    start_response('304 Not Modified', headers)
+                    return []
+                return send_file(env, start_response, public_file, headers, validators)
+        return self.application(env, start_response)
+
+
+def serve_arguments():
+    """Command-line options for the server."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--address", help="address to listen on (default: [serve] address)")
+    parser.add_argument("-p", "--port", type=int, help="port to listen on (default: [serve] port)")
+    parser.add_argument("-w", "--workers", type=int,
+                        help="worker processes, or 0 for one per CPU (default: [serve] workers)")
+    return parser.parse_args()
+
+
+def main():
+    """The constantina-serve entry point"""
+    args = serve_arguments()
+    server = PreforkServer(args.address, args.port, args.workers)
+    print("constantina-serve: %d workers on %s:%d" % (server.workers, server.address, server.port))
+    server.run()
+
+
+if __name__ == '__main__':
+    main()
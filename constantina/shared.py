@@ -1,15 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import cached_property
 import os
 import sys
 import time
 from urllib.parse import unquote_plus
-import syslog
+import logging
 import configparser
 from math import floor
-from random import randint, shuffle
+from threading import Lock
 
+from constantina.codec import decode_state
+from constantina.logs import configure_logging
+from constantina.metrics import Metrics
 
-syslog.openlog(ident='constantina.shared')
+
+log = logging.getLogger('constantina.shared')
 
 Instance = os.environ.get("INSTANCE") or "default"
 GlobalConfig = configparser.SafeConfigParser()
@@ -21,27 +27,21 @@ ConfigOptions = [
     os.path.expanduser("~") + "/constantina/etc/constantina/default/constantina.ini"
 ]
 GlobalConfig.read(ConfigOptions, encoding='utf-8')
+configure_logging(GlobalConfig)
+Metrics.configure(GlobalConfig)
 
 # Only do opendir once per directory, and store results here
 # The other Constantina modules need access to this "globally".
+# Each listing is kept with its directory's mtime, and the time its
+# next future-dated card publishes, and is read again after either.
 BaseFiles = {}
 
-
-class GlobalClock:
-    """
-    Global clock that can be updated. Designed to help Constantina use
-    consistent timestamps through a single request, and not leak data about
-    how long components of Constantina take.
-    """
-    def __init__(self):
-        self.time = int(time.time())
-
-    def update(self):
-        """Set new time based on the current system time."""
-        self.time = int(time.time())
-
-
-GlobalTime = GlobalClock()
+# Cards on a page are opened and drawn on this many threads at once, since
+# each one blocks on file reads, libmagic, PIL, or mutagen. The pool is made
+# the first time it's used, so that forking app servers don't copy threads.
+CardWorkers = GlobalConfig.getint("concurrency", "card_workers", fallback=8)
+CardPool = None
+CardPoolLock = Lock()
 
 
 class BaseCardType:
@@ -70,33 +70,46 @@ class BaseCardType:
         self.spacing = spacing
 
         self.clist = []      # List of card indexes that appeared of this type
-        # Number of files of this type
-        self.file_count = len(opendir(self.config, self.ctype))
         # Files per page of this type
         self.per_page = config.getint("card_counts", self.ctype)
-        # How many ctype cards should we see before the same card
-        # appears again in the randomized view? This is a function
-        # of the number of available cards
+
+
+    @cached_property
+    def file_count(self):
+        """
+        Number of files of this type. The directory isn't listed until a
+        page needs the count, so permalink pages only list what they show.
+        It's counted once per state, since shuffling reads it in loops.
+        """
+        return len(opendir(self.config, self.ctype))
+
+
+    @cached_property
+    def page_distance(self):
+        """
+        How many ctype cards should we see before the same card
+        appears again in the randomized view? This is a function
+        of the number of available cards
+        """
         if self.per_page == 0:
-            self.page_distance = 0
-        else:
-            self.page_distance = self.file_count*2 // self.per_page
+            return 0
+        return self.file_count*2 // self.per_page
 
 
-    def shuffle(self):
+    def shuffle(self, rng):
         """
-        Once a fixed seed is set in the state object, run the shuffle method
-        to get the shuffled file listing for this ctype created.
+        Once a fixed seed is set in the state object's rng, run the shuffle
+        method to get the shuffled file listing for this ctype created.
         """
-        self.__shuffle_files()
-        # syslog.syslog("Shuffled list of " + self.ctype + ": " + str(self.clist))
+        self.__shuffle_files(rng)
+        # log.debug("Shuffled list of " + self.ctype + ": " + str(self.clist))
         self.__mark_uneven_distribution()
-        # syslog.syslog("Marked list of " + self.ctype + ": " + str(self.clist))
-        self.__replace_marked()
-        # syslog.syslog("Final list of " + self.ctype + ": " + str(self.clist))
+        # log.debug("Marked list of " + self.ctype + ": " + str(self.clist))
+        self.__replace_marked(rng)
+        # log.debug("Final list of " + self.ctype + ": " + str(self.clist))
 
 
-    def __shuffle_files(self):
+    def __shuffle_files(self, rng):
         """
         Take a card type, and create a shuffle array where we can preserve
         normal page-state numbering, using those page-state values as indexes
@@ -110,7 +123,7 @@ class BaseCardType:
         # Guarantee enough cards to choose from
         self.clist = list(range(0, self.file_count)) * total_ctype
         self.clist = self.clist[0:total_ctype]
-        shuffle(self.clist)
+        rng.shuffle(self.clist)
 
 
     def __mark_uneven_distribution(self):
@@ -134,7 +147,7 @@ class BaseCardType:
                     self.clist[j] = 'x'
 
 
-    def __replace_marked(self):
+    def __replace_marked(self, rng):
         """
         Given 'x' marked indexes from __mark_even_distribution, determine good
         replacement values.
@@ -151,7 +164,7 @@ class BaseCardType:
                 part_end = len(self.clist)
 
             choices = list(range(0, self.file_count))
-            shuffle(choices)
+            rng.shuffle(choices)
             for k in choices:
                 if k not in self.clist[part_start:part_end]:
                     self.clist[i] = k
@@ -175,7 +188,7 @@ class BaseState:
     It also provides a clean interface to global modes and settings that
     influence what content and appearances a Constantina page can take.
     """
-    def __init__(self, in_state=None, config_file=None):
+    def __init__(self, in_state=None, config_file=None, tokens=None):
         self.in_state = in_state   # Track the original state string
         self.ctypes = []           # Card types in this application
         self.searchtypes = []      # Cards that are indexed/searchable
@@ -185,11 +198,11 @@ class BaseState:
             self.__read_config(config_file)
             self.__set_state_defaults()
 
-        # Was there an initial state string? Process it if there was.
-        if self.in_state is not None:
-            self.state_vars = self.in_state.split(':')
-        else:
-            self.state_vars = []
+        # Was there an initial state string? Parse it once, unless an
+        # aggregate state already parsed it for us.
+        if tokens is None:
+            tokens = decode_state(self.in_state)
+        self.tokens = tokens
 
 
     def __read_config(self, config_file):
@@ -253,37 +266,11 @@ class BaseState:
     def _find_state_variable(self, query):
         """
         Leveraged by all the other state functions. Find the given state
-        variable, either by state variable name, or "number" to find the
-        random seed. Once a state variable is consumed, remove it from
-        the state_vars.
+        variable, either by state variable name, or "seed" to find the
+        random seed. The state string was already parsed into tokens, so
+        this is just a lookup.
         """
-        if self.state_vars == []:
-            return None
-        hits = []
-        output = None
-
-        # Random seed is the one all-numeric state variable
-        if query == "seed":
-            hits = [token for token in self.state_vars if token.isdigit()]
-            if len(hits) > 0:
-                output = hits[0]
-        # Special state variables are singleton values. Typically a
-        # two-letter value starting with "x" as the first letter.
-        elif self.config.has_option("special_states", query):
-            hits = [token for token in self.state_vars if token.find(query) == 0]
-            if len(hits) > 0:
-                output = unquote_plus(hits[0][2:])
-        # Individual content card state variables. Each one is a distance
-        # from the current page.
-        elif query in [s[0] for s in self.config.options("card_counts")]:
-            hits = [token for token in self.state_vars if token.find(query) == 0]
-            # syslog.syslog("query: %s  hits: %s" % (query, hits))
-            if len(hits) > 0:
-                output = int(hits[0][1:])
-
-        # Remove any matches for state variables, including extraneous duplicates
-        [self.state_vars.remove(x) for x in hits]
-        return output
+        return self.tokens.get(query)
 
 
     def _process_search_strings(self, sigil, searchterms):
@@ -301,7 +288,7 @@ class BaseState:
         removeterms = []
 
         for term in searchterms:
-            # syslog.syslog("searchterm: " + term + " ; allterms: " + str(searchterms))
+            # log.debug("searchterm: " + term + " ; allterms: " + str(searchterms))
             if term[0] == '#':
                 for ctype, filterlist in self.config.items("card_filters"):
                     filternames = filterlist.replace(" ", "").split(',')
@@ -358,8 +345,8 @@ class BaseState:
                 if common_seen is False:
                     getattr(self, common).distance = card.num
                     common_seen = True
-                    syslog.syslog("last_dist: %s dist: %d i: %d card-len: %d  eff-len: %d" %
-                                 (card.ctype, card.num, i, len(cards), len(cards) - hidden_cards))
+                    log.debug("last_dist: %s dist: %d i: %d card-len: %d  eff-len: %d",
+                              card.ctype, card.num, i, len(cards), len(cards) - hidden_cards)
                 continue
             if card.ctype == 'heading':
                 # Either a tombstone card or a "now loading" card
@@ -374,8 +361,8 @@ class BaseState:
             done_distance.sort()
 
             dist = len(cards) - hidden_cards - i
-            syslog.syslog("=> %s dist: %d i: %d card-len: %d  eff-len: %d" %
-                         (card.ctype, dist, i, len(cards), len(cards) - hidden_cards))
+            log.debug("=> %s dist: %d i: %d card-len: %d  eff-len: %d",
+                      card.ctype, dist, i, len(cards), len(cards) - hidden_cards)
             getattr(self, card.ctype).distance = str(dist)
             # Early break once we've seen all the card types
             if done_distance == all_ctypes:
@@ -471,6 +458,9 @@ def opendir(config, ctype, hidden=False, page=0):
     Return either cached directory information or open a dir and
     list all the files therein. Used for both searching and for the
     card reading functions, so it's part of the shared module.
+    Cards that are added or removed change the directory's mtime, so
+    the listing is only reused while the mtime is the same, and until
+    the next future-dated news card is due to publish.
     """
     card_root = GlobalConfig.get("paths", "data_root") + "/private"
 
@@ -486,14 +476,23 @@ def opendir(config, ctype, hidden=False, page=0):
         directory += "/hidden"
         ctype += "/hidden"
 
-    # If the directory wasn't previously cached
-    if ctype not in BaseFiles.keys():
+    # If the directory wasn't previously cached, or changed since. The
+    # listing is built up separately, so that requests served in other
+    # threads never see a partly-built listing in the cache.
+    dir_mtime = os.stat(directory).st_mtime_ns
+    cached = BaseFiles.get(ctype)
+    if ((cached is None) or
+        (cached[0] != dir_mtime) or
+        (cached[1] is not None and cached[1] <= time.time())):
+        Metrics.inc("constantina_cache_misses_total", {'cache': 'directory'})
         # Default value. If no files, keep the empty array
-        BaseFiles[ctype] = []
+        listing = []
+        publish = None
 
         dirlisting = os.listdir(directory)
         if dirlisting == []:
-            return BaseFiles[ctype]
+            BaseFiles[ctype] = (dir_mtime, publish, listing)
+            return listing
 
         # Any newly-generated list of paths should be weeded out
         # so that subdirectories don't get fopen'ed later. Also
@@ -503,27 +502,35 @@ def opendir(config, ctype, hidden=False, page=0):
             if os.path.isfile(os.path.join(directory, testpath)):
                 if testpath.find("placeholder") == -1:
                     if page == 0:
-                        BaseFiles[ctype].append(testpath)
+                        listing.append(testpath)
                     elif ((page > 0) and 
                           (idx > previous_items) and
                           (idx <= previous_items + card_count)):
-                        BaseFiles[ctype].append(testpath)
+                        listing.append(testpath)
                     else:
                         pass
 
         # Sort the output. Most directories should use
         # utimes for their filenames, which sort nicely. Use
         # reversed array for newest-first utime files
-        BaseFiles[ctype].sort()
-        BaseFiles[ctype].reverse()
+        listing.sort()
+        listing.reverse()
 
-        # For news items, remove any items newer than the current time
+        # For news items, remove any items newer than the current time,
+        # and read the directory again once the first of them is due
         if ctype == "news":
-            BaseFiles[ctype] = remove_future(BaseFiles[ctype])
+            unpublished = list(listing)
+            listing = remove_future(listing)
+            future = [int(name) for name in unpublished if name not in listing and name.isdigit()]
+            if future != []:
+                publish = min(future)
 
-        # syslog.syslog("ctype: %s   basefiles: %s" % (ctype, BaseFiles[ctype]))
+        # log.debug("ctype: %s   basefiles: %s" % (ctype, listing))
+        BaseFiles[ctype] = (dir_mtime, publish, listing)
+        return listing
 
-    return BaseFiles[ctype]
+    Metrics.inc("constantina_cache_hits_total", {'cache': 'directory'})
+    return cached[2]
 
 
 def escape_amp(in_str):
@@ -531,6 +538,34 @@ def escape_amp(in_str):
     return in_str.replace("&", "&amp;")
 
 
+def header_qualities(header):
+    """
+    The q-value of each item in an Accept-style header, keyed by the item
+    in lowercase. Items without a q-value have a quality of 1.
+    """
+    qualities = {}
+    for item in (header or '').split(','):
+        value, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[value.strip().lower()] = quality
+    return qualities
+
+
+def unescape_tags(in_str):
+    """
+    Undo the escaping of &, < and > that etree does when writing a tag out.
+    This is all xml.sax.saxutils.unescape does, without importing urllib's
+    HTTP client along with it.
+    """
+    return in_str.replace("&lt;", "<").replace("&gt;", ">").replace("&amp;", "&")
+
+
 def urldecode(in_uri):
     """TODO: Establish a standard by which authenticated files are read from disk."""
     return unquote_plus(in_uri)
@@ -547,4 +582,48 @@ def safe_path(in_uri):
     if in_uri.find("..") != -1 or in_uri.find("//") != -1:
         return False
     return True
-    
\ No newline at end of file
+
+
+def contained_path(root, path):
+    """
+    The real path of a file under root, with symlinks and .. resolved. Returns
+    None if the path leads anywhere outside of root.
+    """
+    real_root = os.path.realpath(root)
+    real_path = os.path.realpath(real_root + "/" + path.lstrip("/"))
+    if real_path == real_root or real_path.startswith(real_root + os.sep):
+        return real_path
+    return None
+    
+
+
+def card_map(function, items, serial=False):
+    """
+    Run function over each of the items on the shared card pool, and return
+    the results in the same order as the items. With card_workers set to 1
+    or less, for a single item, or if serial is set, just run them one
+    after another in this thread.
+    """
+    global CardPool
+    items = list(items)
+    if CardWorkers <= 1 or len(items) <= 1 or serial is True:
+        return [function(item) for item in items]
+    with CardPoolLock:
+        if CardPool is None:
+            CardPool = ThreadPoolExecutor(max_workers=CardWorkers,
+                                          thread_name_prefix="constantina-cards")
+    return list(CardPool.map(function, items))
+
+
+def reset_card_pool():
+    """
+    A forked process has none of its parent's pool threads, and the lock
+    might have been held when it forked. Make a new pool on first use.
+    """
+    global CardPool, CardPoolLock
+    CardPool = None
+    CardPoolLock = Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_card_pool)
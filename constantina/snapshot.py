@@ -0,0 +1,183 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+from random import Random
+import logging
+
+from constantina.conditional import permalink_validators, site_generation
+from constantina.constantina import render_page
+from constantina.context import RequestContext
+from constantina.shared import GlobalConfig, opendir
+from constantina.state import ConstantinaState
+
+log = logging.getLogger('constantina.snapshot')
+
+# Permalink state prefixes, for each card type that can be a permalink
+PermalinkTypes = {'news': 'xn', 'features': 'xf', 'topics': 'xt'}
+
+
+class SnapshotJob:
+    """
+    One piece of snapshot work, done in a worker process. Either a single
+    permalink page, or a seeded fresh page followed by its scroll pages.
+    The previous export's generation for the job tells the worker whether
+    it can skip rendering.
+    """
+    def __init__(self, kind, name, generation=None):
+        self.kind = kind              # "permalink" or "fresh"
+        self.name = name              # State string, or fresh page number
+        self.generation = generation  # From the last export's manifest
+
+
+class Snapshot:
+    """
+    Constantina Static Snapshot.
+
+    Render permalink pages and seeded fresh pages into static files under
+    the public directory, so that a web server can serve them without
+    Constantina. The layout is:
+        snapshot/fresh/<n>.html      fresh pages, one picked at random
+        snapshot/pages/<state>.html  permalinks and scroll pages, by the
+                                     exact query string that asks for them
+        snapshot/manifest.json       what each file was rendered from
+
+    Permalinks are re-rendered when their ETag changes. Fresh pages and
+    their scroll pages are re-rendered when any card or theme changes.
+    Files left over from cards that are gone get removed.
+    """
+    def __init__(self, workers=None):
+        self.context = RequestContext()
+        self.config = GlobalConfig
+        self.root = self.context.public_path(self.config.get("snapshot", "directory", fallback="snapshot"))
+        self.manifest_path = self.root + "/manifest.json"
+        self.fresh_pages = self.config.getint("snapshot", "fresh_pages", fallback=8)
+        self.scroll_pages = self.config.getint("snapshot", "scroll_pages", fallback=4)
+        if workers is None:
+            workers = self.config.getint("snapshot", "workers", fallback=4)
+        self.workers = workers
+        self.manifest = self.__read_manifest()
+
+    def __read_manifest(self):
+        """Generations of every job in the last export"""
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as mfile:
+                return json.load(mfile)
+        except (OSError, ValueError):
+            return {'jobs': {}, 'files': {}}
+
+    def __write_manifest(self):
+        """Save generations and files atomically, for the next export"""
+        write_file(self.manifest_path, json.dumps(self.manifest, indent=1, sort_keys=True))
+
+    def jobs(self):
+        """Every permalink, and every seeded fresh page"""
+        state = ConstantinaState(None, {}, self.context)
+        jobs = []
+        for ctype, prefix in PermalinkTypes.items():
+            for filename in opendir(state.medusa.config, ctype):
+                jobs.append(SnapshotJob("permalink", prefix + filename))
+        for i in range(0, self.fresh_pages):
+            jobs.append(SnapshotJob("fresh", str(i)))
+
+        for job in jobs:
+            job.generation = self.manifest['jobs'].get(job.kind + ":" + job.name, {}).get('generation')
+        return jobs
+
+    def export(self, force=False):
+        """
+        Render every job on a pool of processes, and return how many were
+        rendered, and how many were already current.
+        """
+        jobs = self.jobs()
+        if force is True:
+            for job in jobs:
+                job.generation = None
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(run_job, jobs, chunksize=8))
+
+        rendered = 0
+        current = {'jobs': {}, 'files': {}}
+        for job, (generation, files, was_rendered) in zip(jobs, results):
+            key = job.kind + ":" + job.name
+            if was_rendered is False:
+                files = self.manifest['jobs'][key]['files']
+            else:
+                rendered += 1
+            current['jobs'][key] = {'generation': generation, 'files': files}
+            for path in files:
+                current['files'][path] = key
+
+        # Remove files from cards or scroll pages that don't exist anymore
+        for path in self.manifest.get('files', {}):
+            if path not in current['files']:
+                try:
+                    os.remove(self.root + "/" + path)
+                except OSError:
+                    pass
+
+        self.manifest = current
+        self.__write_manifest()
+        log.info("snapshot: rendered %d of %d jobs", rendered, len(jobs))
+        return rendered, len(jobs) - rendered
+
+
+def write_file(path, contents):
+    """Write a file so that the web server never sees it half-written"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as tfile:
+        tfile.write(contents)
+    os.replace(temp_path, path)
+
+
+def page_file(in_state):
+    """Where a page for a state string is written, under the snapshot root"""
+    return "pages/" + in_state + ".html"
+
+
+def run_job(job):
+    """
+    Render one job in a worker process. Returns the job's new generation,
+    the files it wrote, and whether it had to render at all.
+    """
+    snapshot_root = RequestContext().public_path(GlobalConfig.get("snapshot", "directory", fallback="snapshot"))
+
+    if job.kind == "permalink":
+        # Themes are chosen from a seeded rng, so that a permalink's page is
+        # the same from one export to the next
+        context = RequestContext({'QUERY_STRING': job.name})
+        state = ConstantinaState(job.name, context.env, context, Random(job.name))
+        generation = permalink_validators(state).etag
+        if generation == job.generation:
+            return generation, [], False
+        html, page = render_page(state)
+        path = page_file(job.name)
+        write_file(snapshot_root + "/" + path, html)
+        return generation, [path], True
+
+    # A fresh page, and the scroll pages that follow it, all drawn with the
+    # same seeded jitter so each fresh page number always has the same seed
+    jitter = Random("fresh" + job.name)
+    context = RequestContext()
+    state = ConstantinaState(None, context.env, context, jitter)
+    generation = site_generation(state)
+    if generation == job.generation:
+        return generation, [], False
+
+    html, page = render_page(state)
+    path = "fresh/" + job.name + ".html"
+    write_file(snapshot_root + "/" + path, html)
+    files = [path]
+    for i in range(0, GlobalConfig.getint("snapshot", "scroll_pages", fallback=4)):
+        # The last page of content has no tombstone to load more from
+        if 'tombstone' not in [card.num for card in page.cards if card.ctype == 'heading']:
+            break
+        in_state = page.out_state
+        context = RequestContext({'QUERY_STRING': in_state})
+        state = ConstantinaState(in_state, context.env, context, jitter)
+        html, page = render_page(state)
+        path = page_file(in_state)
+        write_file(snapshot_root + "/" + path, html)
+        files.append(path)
+    return generation, files, True
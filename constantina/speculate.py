@@ -0,0 +1,154 @@
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import os
+from threading import Condition, Event, Lock, Thread
+import time
+import logging
+
+from constantina.metrics import Metrics
+from constantina.shared import GlobalConfig
+
+log = logging.getLogger('constantina.speculate')
+
+
+class SpeculativePage:
+    """One next page, waiting to be drawn, being drawn, or drawn"""
+    def __init__(self):
+        self.fragments = None     # The page's Fragments, once drawn
+        self.next_state = None    # The state of the page after this one
+        self.started = False
+        self.expires = 0
+        self.done = Event()
+
+
+class SpeculativePages:
+    """
+    Constantina Speculative Pages.
+
+    When a page is sent, the state of the page after it is already known,
+    and the visitor's script usually asks for it a few seconds later. A
+    background thread draws that next page ahead of time, and keeps it for
+    ttl_seconds, keyed by the exact state string, the variant it's sent as,
+    and the site's content generation. Added cards or edited themes change
+    the generation, and pages are dropped after ttl_seconds either way.
+
+    Only queue_depth pages wait to be drawn at once, and nothing is drawn
+    while more than max_active requests are in flight in this process, or
+    while the load average per CPU is above max_load. A request for a page
+    that's still being drawn waits up to wait_seconds for it, then draws
+    it itself. A request for a page that's only queued draws it itself,
+    and the queued page is dropped.
+    """
+    def __init__(self, render):
+        self.render = render    # Draws a key's page: (fragments, next_state)
+        self.enabled = GlobalConfig.getboolean("speculate", "enabled", fallback=False)
+        self.ttl = GlobalConfig.getint("speculate", "ttl_seconds", fallback=30)
+        self.wait = GlobalConfig.getfloat("speculate", "wait_seconds", fallback=1.0)
+        self.size = GlobalConfig.getint("speculate", "pages", fallback=64)
+        self.depth = GlobalConfig.getint("speculate", "queue_depth", fallback=8)
+        self.max_active = GlobalConfig.getint("speculate", "max_active", fallback=1)
+        self.max_load = GlobalConfig.getfloat("speculate", "max_load", fallback=0.75)
+        self.cpus = os.cpu_count() or 1
+        self.after_fork()
+
+    def after_fork(self):
+        """
+        A forked worker has none of its parent's threads, and the lock might
+        have been held when it forked. Start over with nothing queued.
+        """
+        self.entries = OrderedDict()   # Key -> SpeculativePage
+        self.queue = deque()
+        self.active = 0
+        self.lock = Lock()
+        self.waiting = Condition(self.lock)
+        self.thread = None
+
+    @contextmanager
+    def serving(self):
+        """Count a request as in flight while it's being answered"""
+        with self.lock:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def busy(self):
+        """Is this process or this machine too busy to draw pages early?"""
+        if self.active > self.max_active:
+            return True
+        try:
+            return os.getloadavg()[0] / self.cpus > self.max_load
+        except (AttributeError, OSError):
+            return False
+
+    def take(self, key):
+        """
+        A drawn page's (fragments, next_state), or None if it wasn't drawn
+        ahead of time. Waits up to wait_seconds for a page that's being
+        drawn right now.
+        """
+        if self.enabled is False:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.started is False:
+                # Queued but not started: the request draws it sooner
+                del self.entries[key]
+                self.queue.remove(key)
+                entry = None
+        if entry is not None and entry.done.wait(self.wait) is False:
+            entry = None   # Still drawing: the request draws it instead
+        if entry is None or entry.fragments is None or entry.expires < time.time():
+            Metrics.inc("constantina_cache_misses_total", {'cache': 'speculative'})
+            return None
+        Metrics.inc("constantina_cache_hits_total", {'cache': 'speculative'})
+        return entry.fragments, entry.next_state
+
+    def schedule(self, key):
+        """Queue a page to be drawn in the background, if there's room"""
+        if self.enabled is False or self.busy() is True:
+            return
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry.done.is_set() is False or entry.expires >= time.time()):
+                return
+            if len(self.queue) >= self.depth:
+                return
+            self.entries[key] = SpeculativePage()
+            self.entries.move_to_end(key)
+            self.queue.append(key)
+            self.__trim()
+            if self.thread is None:
+                self.thread = Thread(target=self.__draw, name="constantina-speculate", daemon=True)
+                self.thread.start()
+            self.waiting.notify()
+
+    def __trim(self):
+        """Drop the oldest drawn pages past size. Call with the lock held."""
+        for key in list(self.entries.keys()):
+            if len(self.entries) <= self.size:
+                return
+            if self.entries[key].done.is_set() is True:
+                del self.entries[key]
+
+    def __draw(self):
+        """Draw queued pages, one at a time, while the server isn't busy"""
+        while True:
+            with self.lock:
+                while len(self.queue) == 0:
+                    self.waiting.wait()
+                key = self.queue.popleft()
+                entry = self.entries[key]
+                if self.busy() is True:
+                    del self.entries[key]
+                    continue
+                entry.started = True
+            try:
+                entry.fragments, entry.next_state = self.render(key)
+                entry.expires = time.time() + self.ttl
+            except Exception as error:
+                log.error("speculate: failed to draw %s: %s", key[0], error)
+            finally:
+                entry.done.set()
@@ -1,16 +1,17 @@
 from math import floor
-from random import random, randint, seed, shuffle
+from random import Random
 from datetime import datetime
 import os
 from urllib.parse import unquote_plus
-import syslog
+import logging
 import configparser
 
+from constantina.codec import decode_state, encode_state
+from constantina.context import RequestContext
 from constantina.shared import GlobalConfig, BaseFiles, BaseState
-from constantina.themes import GlobalTheme
 from constantina.medusa.state import MedusaState
 
-syslog.openlog(ident='constantina.state')
+log = logging.getLogger('constantina.state')
 
 
 class ConstantinaState(BaseState):
@@ -29,11 +30,26 @@ class ConstantinaState(BaseState):
     things about the Constantina page are tracked here, since these conditions
     depend on properties of the various states
     """
-    def __init__(self, in_state=None, env={}):
+    def __init__(self, in_state=None, env={}, context=None, jitter=None):
         BaseState.__init__(self, in_state, None)
         self.config = GlobalConfig
         self.headers = []
 
+        # Paths and theme for this request
+        if context is None:
+            context = RequestContext(env)
+        self.context = context
+
+        # Each request has its own random number generators, so that requests
+        # served in parallel don't disturb each other's shuffles. The jitter
+        # generator is never seeded from the state, for choices that should
+        # differ every page load: theme choice, and card placement jitter.
+        # Snapshot exports pass in a seeded one, so their pages are repeatable.
+        if jitter is None:
+            jitter = Random()
+        self.jitter = jitter
+        self.rng = None
+
         # Getting defaults from the other states requires us to first import
         # any random seed value. Then, we can finish setting the imported state
         self.__import_random_seed()
@@ -57,7 +73,7 @@ class ConstantinaState(BaseState):
             setattr(self, spcfield, None)       # All state vals are expected to exist
 
         # Subapplication states are held in this object too
-        self.medusa = MedusaState(self.in_state)
+        self.medusa = MedusaState(self.in_state, self.tokens, self.rng, self.context)
         self.max_items += self.medusa.max_items
         self.filtered += self.medusa.filtered
 
@@ -121,18 +137,18 @@ class ConstantinaState(BaseState):
     def __import_random_seed(self):
         """
         Set the return seed based on a 14-digit string from the state variable.
-        As an input to seed(), this has to be a float between zero and one.
+        As an input to Random(), this has to be a float between zero and one.
 
-        This seed is used to consistently seed the shuffle function, so that
-        between page loads, we know the shuffled card functions give the same
-        shuffle ordering.
+        This seed is used to consistently seed this request's random number
+        generator, so that between page loads, we know the shuffled card
+        functions give the same shuffle ordering.
         """
         self.seed = BaseState._find_state_variable(self, "seed")
         if self.seed is None:
-            self.seed = round(random(), 14)
+            self.seed = round(self.jitter.random(), 14)
         else:
             self.seed = float(str("0." + self.seed))
-        seed(self.seed)   # Now the RNG is seeded with our consistent value
+        self.rng = Random(self.seed)   # Now the RNG is seeded with our consistent value
 
 
     def __import_theme_state(self):
@@ -153,11 +169,8 @@ class ConstantinaState(BaseState):
 
         # If the configuration supports a random theme, and we didn't have a
         # theme provided in the initial state, let's choose one randomly
-        seed()   # Enable non-seeded choice
-        GlobalTheme.set(self.appearance)
-        if self.seed:   # Re-enable seeded nonrandom choice
-            seed(self.seed)
-        self.theme = GlobalTheme.theme
+        self.context.theme.set(self.appearance, self.jitter)
+        self.theme = self.context.theme.theme
 
 
     def __import_state(self):
@@ -208,6 +221,11 @@ class ConstantinaState(BaseState):
 
         export_parts = filter(None, export_parts)
         export_string = ':'.join(export_parts)
+
+        # Optionally rewrite the state in the compact encoding, which leaves
+        # more room for search terms in the 512-character state limit.
+        if self.config.getboolean("miscellaneous", "compact_state", fallback=False) is True:
+            export_string = encode_state(decode_state(export_string), compact=True)
         return export_string
 
 
@@ -223,7 +241,8 @@ class ConstantinaState(BaseState):
 
     def reshuffle_mode(self):
         """An empty search was given, so reshuffle the page"""
-        syslog.syslog("reshuffle mode: " + str(self.all("card_filter")))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("reshuffle mode: %s", self.all("card_filter"))
 
         if ((self.all("reshuffle", "or") is True) and
             (self.all("card_filter") is None)):
@@ -233,14 +252,8 @@ class ConstantinaState(BaseState):
 
 
     def permalink_mode(self):
-        """Is one of the permalink modes on?"""
-	    # TODO: check other states for active permalinks!
-        if ((self.medusa.news_permalink is not None) or
-            (self.medusa.features_permalink is not None) or
-            (self.medusa.topics_permalink is not None)):
-            return True
-        else:
-            return False
+        """Is one of the permalink modes on, in any application?"""
+        return self.all("permalink_mode", "or")
 
 
     def filter_processed_mode(self):
@@ -295,7 +308,7 @@ class ConstantinaState(BaseState):
                     card_limit += self.page * app_state.config.getint("card_counts", ctype)
                 else:
                     card_limit = card_limit + getattr(app_state, ctype).file_count
-        syslog.syslog("card_limit: " + str(card_limit) + "   card_count: " + str(card_count))
+        log.debug("card_limit: %d   card_count: %d", card_limit, card_count)
         if card_count >= card_limit:
             return True
         else:
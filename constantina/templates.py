@@ -1,15 +1,15 @@
 from string import Template
 
-from constantina.themes import GlobalTheme
 
-def template_contents(raw):
+def template_contents(raw, theme):
     """
     Anything involving template generation on server-side for Constantina
-    is here. Currently it's just the $theme_directory to use.
+    is here. Currently it's just the $theme_directory to use, from the
+    request's chosen theme.
     """
     template = Template(raw)
     replacements = {}
-    replacements['theme_directory'] = GlobalTheme.theme
+    replacements['theme_directory'] = theme.theme
     # Returned output is the template transform
     output = template.safe_substitute(replacements)
     return output
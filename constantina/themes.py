@@ -1,9 +1,9 @@
-import syslog
-from random import randint, seed
+import logging
+from random import Random
 
 from constantina.shared import GlobalConfig
 
-syslog.openlog(ident='constantina.themes')
+log = logging.getLogger('constantina.themes')
 
 
 class ConstantinaTheme:
@@ -12,8 +12,8 @@ class ConstantinaTheme:
 
     With the non-cookie State, the forum-cookie State, as well as website
     template loading all doing checks of theme information, it made sense
-    to manage theme settings in a single place, and even a single Global
-    object.
+    to manage theme settings in a single place. Each request's context has
+    its own theme object, since themes are chosen per page load.
     """
     def __init__(self):
         """
@@ -39,18 +39,19 @@ class ConstantinaTheme:
             self.theme = self.default
             self.__choose_theme()
 
-    def set(self, desired_theme=None):
+    def set(self, desired_theme=None, rng=None):
         """
         The Global Theme is set during state loading, but we manage the
         attempted/imported values here, in case we need to deconflict between
         state-cookie theme settings and preferences theme settings.
+        Random theme choices are made with the given request's rng.
         """
         if desired_theme is None:
             # Choose the plain default value
             self.theme = self.default
         elif desired_theme == -1:
             # Random choice selected from the menu
-            self.__random_choice()
+            self.__random_choice(rng)
         else:
             # Choose based on user input, mod'ing to the number of themes
             # if the user input was some out-of-range number
@@ -59,28 +60,27 @@ class ConstantinaTheme:
             self.random = False
 
         # We either have index or "random" now. Make a final choice
-        self.__choose_theme(desired_theme)
+        self.__choose_theme(desired_theme, rng)
 
-    def __choose_theme(self, desired_theme=None):
+    def __choose_theme(self, desired_theme=None, rng=None):
         """
         Given a valid index or "random", properly set the theme value from
         one of the numbered-index values in constantina.ini.
         """
         if desired_theme is None and self.theme == "random":
-            self.__random_choice()
+            self.__random_choice(rng)
         else:
             self.index = [int(x[0]) for x in GlobalConfig.items("themes")[1:]
                           if x[1] == self.theme][0]
 
-    def __random_choice(self):
+    def __random_choice(self, rng=None):
         """
         If the configuration supports a random theme, and we didn't have a
         theme provided in the initial state, let's choose one randomly
         """
-        seed()   # Enable non-seeded choice
-        self.index = randint(0, self.count - 1)
+        if rng is None:
+            rng = Random()   # Enable non-seeded choice
+        self.index = rng.randint(0, self.count - 1)
         self.theme = GlobalConfig.get("themes", str(self.index))
         self.random = True
 
-
-GlobalTheme = ConstantinaTheme()
\ No newline at end of file
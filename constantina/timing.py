@@ -0,0 +1,119 @@
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+import logging
+
+from constantina.shared import GlobalConfig
+
+log = logging.getLogger('constantina.timing')
+
+# Histogram bucket upper bounds, in milliseconds
+Buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf')]
+
+
+class PhaseHistograms:
+    """
+    Constantina Phase Histograms.
+
+    How long each phase of a request took, counted into fixed buckets, for
+    every request this process has timed. Every log_every requests, a
+    summary of each phase is logged.
+    """
+    def __init__(self):
+        self.counts = {}     # Phase name -> count per bucket
+        self.requests = 0
+        self.log_every = GlobalConfig.getint("timing", "log_every", fallback=1000)
+        self.lock = Lock()
+
+    def observe(self, phases):
+        """Count one request's phase timings, given as (name, seconds)"""
+        with self.lock:
+            for name, seconds in phases:
+                counts = self.counts.setdefault(name, [0] * len(Buckets))
+                milliseconds = seconds * 1000
+                for i, bound in enumerate(Buckets):
+                    if milliseconds <= bound:
+                        counts[i] += 1
+                        break
+            self.requests += 1
+            if self.log_every > 0 and self.requests % self.log_every == 0:
+                for line in self.summary():
+                    log.info(line)
+
+    def percentile(self, name, fraction):
+        """The bucket bound that the given fraction of timings fall under"""
+        counts = self.counts[name]
+        wanted = fraction * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if seen >= wanted:
+                return Buckets[i]
+        return Buckets[-1]
+
+    def summary(self):
+        """One line per phase, with approximate p50, p95, and p99"""
+        lines = []
+        for name in sorted(self.counts.keys()):
+            lines.append("timing: %s n=%d p50<=%sms p95<=%sms p99<=%sms" % (
+                name, sum(self.counts[name]),
+                self.percentile(name, 0.50),
+                self.percentile(name, 0.95),
+                self.percentile(name, 0.99)))
+        return lines
+
+
+# Phase timings for all requests in this process
+Histograms = PhaseHistograms()
+
+
+class PhaseTimer:
+    """
+    Constantina Phase Timer.
+
+    Times the phases of a single request: state parsing, shuffling, card
+    loading, layout, searching, and drawing. Timing is off unless it's
+    turned on in [timing], since response times can leak details about a
+    site's content. When it's on, the timings are sent back in a
+    Server-Timing header, and counted into the process's Histograms.
+    """
+    def __init__(self, enabled=None):
+        if enabled is None:
+            enabled = GlobalConfig.getboolean("timing", "enabled", fallback=False)
+        self.enabled = enabled
+        self.phases = []   # (name, seconds), in the order they finished
+
+    @contextmanager
+    def phase(self, name):
+        """Time everything inside this with-block as the named phase"""
+        if self.enabled is False:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, perf_counter() - start))
+
+    def finish(self):
+        """
+        Count this request's timings, and return a Server-Timing header
+        value for them, or None if timing is off.
+        """
+        if self.enabled is False or self.phases == []:
+            return None
+        Histograms.observe(self.phases)
+        return ", ".join(["%s;dur=%.2f" % (name, seconds * 1000)
+                          for name, seconds in self.phases])
+
+
+def timed_phase(name):
+    """Time a method as the named phase, using its object's request context"""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.context.timer.phase(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
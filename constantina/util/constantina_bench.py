@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+"""
+Run this script at the shell to time Constantina's hot paths in isolation.
+Each subcommand prints the time per operation, so that changes in the
+state parsing, page layout and page building code can be compared before
+and after.
+"""
+import argparse
+import configparser
+from random import Random
+import string
+import sys
+from timeit import default_timer
+
+from constantina.codec import StateTokens, decode_state, encode_state
+from constantina.layout import CardLayout, LayoutRule
+
+
+# Card type letters and special states from the shipped medusa.ini
+CardLetters = "afimnqst"
+SpecialStates = ["xa", "xp", "xs", "xo", "xx"]
+# Card counts and spacing from the shipped medusa.ini, per ctype
+CardMix = {'news': (10, 0), 'images': (3, 4), 'quotes': (4, 3), 'songs': (1, 6)}
+
+
+class BenchCard:
+    """Stand-in for a MedusaCard, for benchmarks that only need card types"""
+    def __init__(self, ctype, num):
+        self.ctype = ctype
+        self.num = num
+
+
+def random_tokens(rng):
+    """Make a StateTokens object like one that a scrolled page would export"""
+    tokens = StateTokens()
+    tokens.seed = str(rng.randint(0, 10**14 - 1)).zfill(14)
+    for letter in rng.sample(CardLetters, rng.randint(0, len(CardLetters))):
+        tokens.set_card(letter, rng.randint(0, 120))
+    for special in rng.sample(SpecialStates, rng.randint(0, len(SpecialStates))):
+        value = ''.join([rng.choice(string.ascii_letters + string.digits + " #+:%")
+                         for i in range(0, rng.randint(0, 40))])
+        tokens.set_special(special, value)
+    return tokens
+
+
+def timed(label, count, function, per=1):
+    """
+    Run a function count times, and print the time per operation. If each
+    call does a batch of operations, per is the size of the batch.
+    """
+    start = default_timer()
+    for i in range(0, count):
+        function()
+    elapsed = default_timer() - start
+    print("%-24s %10.2f us/op" % (label, elapsed * 1000000 / (count * per)))
+
+
+def bench_state(args):
+    """
+    Time the state codec against randomly-generated states, in both the
+    legacy and the compact encodings. Every state is checked to make sure
+    it decodes back into the tokens it was encoded from.
+    """
+    rng = Random(args.seed)
+    samples = [random_tokens(rng) for i in range(0, args.samples)]
+    legacy = [encode_state(tokens) for tokens in samples]
+    compact = [encode_state(tokens, compact=True) for tokens in samples]
+
+    for tokens, legacy_string, compact_string in zip(samples, legacy, compact):
+        if decode_state(legacy_string) != tokens:
+            raise AssertionError("legacy round-trip failed: " + legacy_string)
+        if decode_state(compact_string) != tokens:
+            raise AssertionError("compact round-trip failed: " + compact_string)
+
+    print("average length: legacy %.1f, compact %.1f" %
+          (sum(map(len, legacy)) / len(legacy), sum(map(len, compact)) / len(compact)))
+    timed("decode legacy", args.count, lambda: [decode_state(s) for s in legacy], args.samples)
+    timed("decode compact", args.count, lambda: [decode_state(s) for s in compact], args.samples)
+    timed("encode legacy", args.count, lambda: [encode_state(t) for t in samples], args.samples)
+    timed("encode compact", args.count, lambda: [encode_state(t, True) for t in samples], args.samples)
+
+
+def bench_layout(args):
+    """
+    Time the card layout for a page of max_items new cards, mixed in the
+    same ratio as the shipped card_counts. The new cards follow a run of
+    prior-page placeholder cards, as they would deep into a scroll.
+    """
+    rng = Random(args.seed)
+    per_page = sum([count for count, spacing in CardMix.values()])
+    cards = []
+    for ctype, (count, spacing) in CardMix.items():
+        total = args.max_items * count // per_page
+        cards.extend([BenchCard(ctype, i) for i in range(0, total)])
+    news = iter([card for card in cards if card.ctype == 'news'])
+    rng.shuffle(cards)
+    cards = [next(news) if card.ctype == 'news' else card for card in cards]
+
+    rules = [LayoutRule(ctype, spacing, rng.randint(0, spacing))
+             for ctype, (count, spacing) in CardMix.items()]
+    prior = [BenchCard('news', i) for i in range(0, args.max_items * args.page)]
+    layout = CardLayout(rules, first_page=(args.page == 0), rng=rng)
+
+    def build_page():
+        page = prior + cards
+        new_cards = page[len(prior):]
+        del page[len(prior):]
+        page.extend(layout.distribute(new_cards))
+
+    print("%d new cards after %d prior cards" % (len(cards), len(prior)))
+    timed("distribute", args.count, build_page)
+
+
+def bench_pages(args):
+    """
+    Time whole requests through the WSGI application, for a fresh page and
+    for a permalink to the newest news card. This needs a configured
+    Constantina instance with cards in it. With --cold, the directory
+    listing cache is emptied before every request.
+    """
+    # Only this benchmark needs a configured instance, so only import the
+    # application here
+    from constantina import constantina
+    from constantina.shared import BaseFiles, GlobalConfig
+
+    medusa_config = configparser.ConfigParser()
+    medusa_config.read(GlobalConfig.get("paths", "config_root") + "/medusa.ini", encoding='utf-8')
+    newest = constantina.opendir(medusa_config, "news")[0]
+
+    def request(in_state):
+        if args.cold is True:
+            BaseFiles.clear()
+        uri = '/?' + in_state if in_state != '' else '/'
+        env = {'QUERY_STRING': in_state, 'REQUEST_URI': uri}
+        constantina.application(env, lambda status, headers: None)
+
+    timed("fresh page", args.count, lambda: request(''))
+    timed("permalink xn" + newest, args.count, lambda: request("xn" + newest))
+
+
+def bench_corpus(args):
+    """
+    Write a synthetic data root, for trying Constantina out against a site
+    with many more cards than the shipped examples. Themes and headers are
+    taken from the configured data root.
+    """
+    from constantina.bench.corpus import generate_corpus
+    from constantina.shared import GlobalConfig
+
+    template_root = args.template or GlobalConfig.get("paths", "data_root")
+    try:
+        news_files = generate_corpus(args.root, template_root, args.news, args.seed, args.force)
+    except ValueError as error:
+        print(error)
+        sys.exit(1)
+    print("wrote %d news cards to %s" % (len(news_files), args.root))
+
+
+def bench_suite(args):
+    """
+    Time whole requests for every kind of page, against synthetic corpora
+    of each size, and report latency percentiles, throughput and peak
+    memory. The configured data root is only used for its themes and
+    headers; the generated corpora are written under --root.
+    """
+    from constantina.bench.harness import BenchSuite, Modes
+    from constantina.shared import GlobalConfig
+
+    template_root = args.template or GlobalConfig.get("paths", "data_root")
+    suite = BenchSuite(args.root, template_root, args.count, args.page, args.seed, args.force)
+    try:
+        suite.run(args.sizes, args.modes or Modes)
+    except ValueError as error:
+        print(error)
+        sys.exit(1)
+
+
+def bench_replay(args):
+    """
+    Replay the page requests from nginx or uWSGI access logs through the
+    application, and report latencies for each page mode. Point --data-root
+    at a copy of the site, since searches update the search index.
+    """
+    from constantina.shared import BaseFiles, GlobalConfig
+    if args.data_root is not None:
+        GlobalConfig.set("paths", "data_root", args.data_root)
+        BaseFiles.clear()
+    from constantina.bench.replay import Replay, read_log
+    from constantina.constantina import FreshPages
+    if args.no_pool is True:
+        FreshPages.size = 0
+
+    entries = read_log(args.logs, args.files)
+    if args.limit is not None:
+        entries = entries[0:args.limit]
+    if entries == []:
+        print("no page requests found in " + ", ".join(args.logs))
+        return
+    replay = Replay(entries, args.concurrency, args.speed)
+    replay.report(replay.run())
+
+
+def bench_importtime(args):
+    """
+    Start a new interpreter for each run, as the CGI wrapper does for each
+    request or uWSGI does for each recycled worker, and answer one request
+    with python -X importtime. Reports how long the imports took, and which
+    heavy dependencies the request had to load.
+    """
+    from constantina.bench.importtime import cold_start, report_imports
+    report_imports(cold_start(args.state, args.runs), args.top)
+
+
+def bench_asgi(args):
+    """
+    Call the ASGI entry point in this process, as a server would, and
+    check the status, headers and streamed body of a fresh page, a JSON
+    scroll page, and the file trampoline. Exits non-zero if any check
+    fails. This needs a configured Constantina instance with cards in it.
+    """
+    from constantina.asgi import application
+    from constantina.bench.asgiclient import AsgiCheck
+    from constantina.constantina import FreshPages
+    FreshPages.size = 0   # Fresh pages are drawn and streamed on request
+
+    check = AsgiCheck(application, args.image)
+    passed = check.run()
+    check.report()
+    if passed is False:
+        sys.exit(1)
+
+
+def bench_arguments():
+    """Command-line options for each of the benchmark subcommands."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", type=int, default=1000, help="timed iterations")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="random seed for generated inputs")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    state = subparsers.add_parser("state", help="state string parsing and writing")
+    state.add_argument("--samples", type=int, default=100, help="states generated per iteration")
+    state.set_defaults(function=bench_state)
+
+    layout = subparsers.add_parser("layout", help="card distribution for one page")
+    layout.add_argument("--max-items", type=int, default=100, help="new cards on the page")
+    layout.add_argument("--page", type=int, default=0, help="prior pages of placeholder cards")
+    layout.set_defaults(function=bench_layout)
+
+    pages = subparsers.add_parser("pages", help="fresh page and permalink requests")
+    pages.add_argument("--cold", action="store_true", help="list card directories on every request")
+    pages.set_defaults(function=bench_pages)
+
+    corpus = subparsers.add_parser("corpus", help="write a synthetic data root")
+    corpus.add_argument("root", help="directory to write the data root into")
+    corpus.add_argument("--news", type=int, default=1000, help="news cards to write")
+    corpus.add_argument("--template", help="data root to copy themes and headers from")
+    corpus.add_argument("--force", action="store_true", help="replace a directory that isn't a generated corpus")
+    corpus.set_defaults(function=bench_corpus)
+
+    suite = subparsers.add_parser("suite", help="every page type, against synthetic corpora")
+    suite.add_argument("root", help="directory to write the data roots into")
+    suite.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+                       help="news cards in each corpus")
+    suite.add_argument("--modes", nargs="+", choices=["fresh", "scroll", "search", "filter", "permalink"],
+                       help="page types to time (default: all)")
+    suite.add_argument("--page", type=int, default=3, help="pages deep for the scroll mode")
+    suite.add_argument("--template", help="data root to copy themes and headers from")
+    suite.add_argument("--force", action="store_true", help="replace directories that aren't generated corpora")
+    suite.set_defaults(function=bench_suite)
+
+    replay = subparsers.add_parser("replay", help="requests from access logs, by page mode")
+    replay.add_argument("logs", nargs="+", help="nginx or uWSGI access logs, optionally gzipped")
+    replay.add_argument("-c", "--concurrency", type=int, default=4, help="requests in flight at once")
+    replay.add_argument("--speed", type=float, default=1.0,
+                        help="multiple of the logged request rate, or 0 for as fast as possible")
+    replay.add_argument("--limit", type=int, help="only replay this many requests")
+    replay.add_argument("--data-root", help="copy of the data root to replay against")
+    replay.add_argument("--files", action="store_true", help="also replay file requests")
+    replay.add_argument("--no-pool", action="store_true", help="draw every fresh page on request")
+    replay.set_defaults(function=bench_replay)
+
+    importtime = subparsers.add_parser("importtime", help="imports for one request in a new interpreter")
+    importtime.add_argument("--state", default="", help="state string to request (default: a fresh page)")
+    importtime.add_argument("--runs", type=int, default=5, help="new interpreters to start")
+    importtime.add_argument("--top", type=int, default=15, help="slowest imports to list")
+    importtime.set_defaults(function=bench_importtime)
+
+    asgi = subparsers.add_parser("asgi", help="check the ASGI entry point with an in-process client")
+    asgi.add_argument("--image", default="/images/example.png", help="private file to request")
+    asgi.set_defaults(function=bench_asgi)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = bench_arguments()
+    args.function(args)
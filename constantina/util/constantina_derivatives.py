@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+"""
+Run this script at the shell to make smaller copies of picture cards, and
+of images inside news and feature cards, for the srcset of each image.
+Images and copies are also encoded as WebP and AVIF, for browsers that
+accept them. Only images that changed since the last run are copied or
+encoded again. Run it from cron, or after adding new cards.
+"""
+import argparse
+
+from constantina.medusa.derivatives import ImageDerivatives
+
+
+def derivative_arguments():
+    """Command-line options for making image derivatives."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="image processes (default: [derivatives] workers)")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="copy every image, even if it's current")
+    parser.add_argument("-r", "--report", action="store_true",
+                        help="compare each image's size in every format")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = derivative_arguments()
+    derivatives = ImageDerivatives(args.workers)
+    made, current = derivatives.generate(args.force)
+    print("made derivatives of %d images, %d already current, in %s" % (made, current, derivatives.root))
+    encoded, current = derivatives.encode(args.force)
+    print("encoded %d images and copies, %d already current" % (encoded, current))
+    if args.report is True:
+        derivatives.report()
@@ -0,0 +1,27 @@
+#!/usr/bin/python3
+"""
+Run this script at the shell to write static snapshots of Constantina's
+permalink pages and seeded fresh pages into the public directory. Only
+pages whose cards or themes changed since the last export are rendered
+again. Run it from cron, or after adding new cards.
+"""
+import argparse
+
+from constantina.snapshot import Snapshot
+
+
+def export_arguments():
+    """Command-line options for the snapshot export."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="render processes (default: [snapshot] workers)")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="render every page, even if it's current")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = export_arguments()
+    snapshot = Snapshot(args.workers)
+    rendered, current = snapshot.export(args.force)
+    print("rendered %d pages, %d already current, in %s" % (rendered, current, snapshot.root))
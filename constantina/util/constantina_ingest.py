@@ -0,0 +1,31 @@
+#!/usr/bin/python3
+"""
+Run this script at the shell to check every news, feature and topic card
+for HTML that Constantina can't parse, before any visitor sees the error.
+Each bad line is reported with its file and line number. Cards that parse
+are saved already split into blocks, so they're drawn without parsing.
+Only cards that changed since the last run are parsed again.
+"""
+import argparse
+import sys
+
+from constantina.medusa.ingest import CardIngest
+
+
+def ingest_arguments():
+    """Command-line options for ingesting text cards."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="parse every card, even if it's current")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = ingest_arguments()
+    ingest = CardIngest()
+    saved, current, errors = ingest.ingest(args.force)
+    for error in errors:
+        print(error)
+    print("saved %d cards, %d already current, %d errors, in %s" % (saved, current, len(errors), ingest.root))
+    if errors != []:
+        sys.exit(1)
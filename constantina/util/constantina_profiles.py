@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+"""
+Run this script at the shell to sum up the request profiles that
+Constantina wrote into its [profiling] spool directory. It prints how many
+requests of each page mode were profiled and how long they took, then the
+top functions and allocation sites across all of the chosen profiles.
+"""
+import argparse
+import glob
+import json
+import pstats
+import re
+
+from constantina.shared import GlobalConfig
+
+
+def read_profiles(spool, mode=None, state_pattern=None):
+    """Details of each spooled profile, optionally only for one mode or state"""
+    profiles = []
+    for path in sorted(glob.glob(spool + "/*.json")):
+        try:
+            with open(path, 'r', encoding='utf-8') as jfile:
+                details = json.load(jfile)
+        except (OSError, ValueError):
+            continue
+        if mode is not None and details['mode'] != mode:
+            continue
+        if state_pattern is not None and re.search(state_pattern, details['state'] or "") is None:
+            continue
+        details['path'] = path[:-len(".json")]
+        profiles.append(details)
+    return profiles
+
+
+def print_modes(profiles):
+    """Profiled request counts and times, per page mode"""
+    modes = {}
+    for details in profiles:
+        modes.setdefault(details['mode'], []).append(details['seconds'])
+    print("%-18s %6s %10s %10s" % ("mode", "reqs", "mean ms", "max ms"))
+    for mode in sorted(modes.keys()):
+        seconds = modes[mode]
+        print("%-18s %6d %10.1f %10.1f" % (mode, len(seconds),
+              sum(seconds) * 1000 / len(seconds), max(seconds) * 1000))
+
+
+def print_functions(profiles, sort, count):
+    """The hottest functions across every cProfile dump"""
+    stats = None
+    for details in profiles:
+        try:
+            if stats is None:
+                stats = pstats.Stats(details['path'] + ".prof")
+            else:
+                stats.add(details['path'] + ".prof")
+        except OSError:
+            continue    # Profiled with tracemalloc only
+    if stats is None:
+        return
+    stats.strip_dirs().sort_stats(sort).print_stats(count)
+
+
+def print_allocations(profiles, count):
+    """The allocation sites holding the most memory, summed over requests"""
+    sites = {}
+    for details in profiles:
+        for site, size, blocks in details['allocations']:
+            total = sites.setdefault(site, [0, 0])
+            total[0] += size
+            total[1] += blocks
+    if sites == {}:
+        return
+    print("%12s %10s  %s" % ("KiB", "blocks", "allocated at"))
+    top = sorted(sites.items(), key=lambda item: item[1][0], reverse=True)[0:count]
+    for site, (size, blocks) in top:
+        print("%12.1f %10d  %s" % (size / 1024.0, blocks, site))
+
+
+def profiles_arguments():
+    """Command-line options for summing up profiles."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("spool", nargs="?", default=None,
+                        help="profile directory (default: [profiling] spool)")
+    parser.add_argument("-n", "--count", type=int, default=25, help="functions and sites to show")
+    parser.add_argument("-m", "--mode", help="only requests of this mode, i.e. search_mode")
+    parser.add_argument("-s", "--state", help="only requests whose state matches this regex")
+    parser.add_argument("--sort", default="tottime", choices=["tottime", "cumulative", "ncalls"],
+                        help="order of the function list")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = profiles_arguments()
+    spool = args.spool or GlobalConfig.get("profiling", "spool", fallback="/var/tmp/constantina-profiles")
+    profiles = read_profiles(spool, args.mode, args.state)
+    if profiles == []:
+        print("no profiles in %s" % spool)
+    else:
+        print_modes(profiles)
+        print_functions(profiles, args.sort, args.count)
+        print_allocations(profiles, args.count)
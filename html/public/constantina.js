@@ -19,6 +19,72 @@
 var clickMore = false;
 var wasFresh = [];
 
+// Scroll pages are fetched ahead of time as JSON, once a page of cards is
+// in place. The markers that load more content are copied from the first
+// page, since JSON scroll pages don't include them.
+var prefetched = null;
+var prefetchedState = null;
+var scrollTemplate = null;
+var tombstoneTemplate = null;
+
+// Start loading the next page of cards, before it's scrolled to. The
+// bundled Zepto has no deferreds, so the fetch keeps its own result, and
+// calls "then" if the page was scrolled to before the fetch finished.
+function prefetchContent() {
+   var tombstone = document.getElementById('tombstone');
+   if ( tombstone == null || tombstoneTemplate == null ) {
+      return;
+   }
+   var state = tombstone.querySelector('#state').innerHTML;
+   if ( state == prefetchedState ) {
+      return;
+   }
+   var pending = { data: null, failed: false, then: null };
+   prefetchedState = state;
+   prefetched = pending;
+   $.ajax({
+      url: "/?" + state,
+      dataType: "json",
+      headers: { Accept: "application/json" },
+      success: function (data) {
+         pending.data = data;
+         if ( pending.then != null ) {
+            pending.then();
+         }
+      },
+      error: function () {
+         pending.failed = true;
+         if ( pending.then != null ) {
+            pending.then();
+         }
+      }
+   });
+}
+
+// Fetch a scroll page as HTML, which already includes its markers
+function appendPage(state) {
+   $.get("/?" + state, function (data) {
+      $(".container").append(data);
+   });
+}
+
+// Add a JSON scroll page's cards, along with new markers to load the
+// page after it. The last page has no next state, and gets no markers.
+function insertCards(data) {
+   var cards = data.cards.slice();
+   if ( data.state != null ) {
+      var tombstone = tombstoneTemplate.clone();
+      tombstone.find('#state').html(data.state);
+      tombstone.find('#loadButton').css("display", "");
+      tombstone.find('#inProgress').css("display", "none");
+      if ( data.scroll != null && scrollTemplate != null ) {
+         cards.splice(data.scroll, 0, scrollTemplate.clone().prop('outerHTML'));
+      }
+      cards.push(tombstone.prop('outerHTML'));
+   }
+   $(".container").append(cards.join(""));
+}
+
 // The last headingCard in the page is a hidden marker. If it can't be hidden
 // by Javascript, it will display a "load more content" link that can be
 // clicked to load additional content into the page, based on the state
@@ -33,13 +99,27 @@ function addMoreContent(was_clicked) {
    // Replace tombstone with page contents
    var state = tombstone.querySelector('#state').innerHTML;
 
-   // Add content into the page
-   $.get(
-      "/?" + state,
-       function (data) {
-          $(".container").append(data);
-       }
-   );
+   // Use the prefetched cards if they're for this page. If fetching them
+   // as JSON fails, fall back to fetching the page's HTML.
+   if ( prefetched == null || prefetchedState != state ) {
+      prefetchContent();
+   }
+   var pending = prefetched;
+   prefetched = null;
+   if ( pending == null ) {
+      appendPage(state);
+   } else {
+      pending.then = function () {
+         if ( pending.data != null ) {
+            insertCards(pending.data);
+         } else {
+            appendPage(state);
+         }
+      };
+      if ( pending.data != null || pending.failed == true ) {
+         pending.then();
+      }
+   }
 
    tombstone.id = "old_tombstone";
 }
@@ -63,6 +143,14 @@ $(function() {
       loadingButton();
    }
 
+   // Keep copies of the markers, for pages of cards loaded as JSON
+   if ( document.getElementById('tombstone') != null ) {
+      tombstoneTemplate = $('#tombstone').clone();
+   }
+   if ( document.getElementById('scrollstone') != null ) {
+      scrollTemplate = $('#scrollstone').clone();
+   }
+
    // Add the search text pre-populated into the search bar
    document.getElementById("searchEntry").placeholder = searchPlaceholderText();
 
@@ -92,7 +180,10 @@ $(function() {
          $("#old_scrollstone").remove();
          // Any new divs should get topic links that are clickable
          activateTopicLinks();
-         loadingButton();
+         if ( document.getElementById('loadButton') != null ) {
+            loadingButton();
+         }
+         prefetchContent();
       }, 200);
    }, false );
 
@@ -100,7 +191,7 @@ $(function() {
    window.addEventListener( 'scroll', function() {
       var scrollstone = document.getElementById('scrollstone');
       // If scrolled past the scrollstone, start loading data
-      if ( document.body.scrollTop >= scrollstone.offsetTop ) {
+      if ( scrollstone != null && document.body.scrollTop >= scrollstone.offsetTop ) {
          scrollstone.id = "old_scrollstone";
          addMoreContent(false);
 
@@ -112,6 +203,9 @@ $(function() {
    // Make new topic links clickable and populate the search bar
    activateTopicLinks();
 
+   // Fetch the next page of cards once everything else has loaded
+   $(window).on('load', prefetchContent);
+
    // Process input into the search form
    $('#searchForm').submit(function() {
       $('#searchEntry').blur();   // Make iOS keyboard disappear after submitting
@@ -204,6 +204,7 @@ if __name__ == '__main__':
 Programming Language :: Python :: 3 :: Only""".splitlines(),
             'packages': [
                 'constantina',
+                'constantina.bench',
                 'constantina.medusa',
                 'constantina.util'
             ],
@@ -214,7 +215,17 @@ Programming Language :: Python :: 3 :: Only""".splitlines(),
             'scripts': [
                 'constantina/util/constantina_configure.py',
                 'constantina/util/constantina_index.py',
+                'constantina/util/constantina_bench.py',
+                'constantina/util/constantina_export.py',
+                'constantina/util/constantina_profiles.py',
+                'constantina/util/constantina_derivatives.py',
+                'constantina/util/constantina_ingest.py',
             ],
+            'entry_points': {
+                'console_scripts': [
+                    'constantina-serve = constantina.serve:main',
+                ]
+            },
             'install_requires': [
                 'lxml',
                 'mutagen',